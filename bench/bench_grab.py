@@ -0,0 +1,348 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""End to end grab benchmark against the fake SD server.
+
+For each lineup size `ccasdtv run` is run three times in a fresh home
+directory, as its own process, against a FakeSD serving that lineup:
+
+    cold    an empty cache, everything is downloaded
+    warm    nothing has changed since the cold run
+    churn   a fraction of the station days have changed
+
+and the time, requests, bytes transferred, peak RSS and files written of
+each run are emitted as JSON. Give an earlier result file to --compare to
+see the change from one commit to another:
+
+    python bench/bench_grab.py -o before.json
+    git checkout mybranch
+    python bench/bench_grab.py -o after.json --compare before.json
+"""
+
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import yaml
+
+BENCHDIR = Path(__file__).resolve().parent
+PKGDIR = BENCHDIR.parent
+sys.path.insert(0, str(BENCHDIR))
+
+from fakesd import FakeSD  # noqa: E402
+
+PHASES = ["cold", "warm", "churn"]
+# the metrics --compare shows, lower is better for all of them
+METRICS = ["seconds", "requests", "bytesout", "maxrsskb", "fileswritten"]
+
+
+def gitCommit():
+    """Returns the commit being benchmarked, with + if the tree is dirty."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PKGDIR,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=PKGDIR,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except OSError:
+        return "unknown"
+
+
+def writeConfig(home, url, settings):
+    """Write the ccasdtv config for a benchmark home directory."""
+    cfg = {
+        "username": "bench",
+        "password": hashlib.sha1(b"bench").hexdigest(),
+        "url": url,
+        # the benchmark measures the grab, not the request budget
+        "dailybudget": 10**9,
+    }
+    cfg.update(settings)
+    cfgdir = home.joinpath(".config")
+    cfgdir.mkdir(parents=True, exist_ok=True)
+    with open(cfgdir.joinpath("ccasdtv.yaml"), "w") as cfn:
+        yaml.dump(cfg, cfn, default_flow_style=False)
+
+
+def snapshot(home):
+    """Returns path: (mtime, size) of every file under home but the log."""
+    files = {}
+    for root, dirs, fns in os.walk(home):
+        for fn in fns:
+            path = os.path.join(root, fn)
+            if fn in (".ccasdtv.log", ".sdbench.peak"):
+                continue
+            st = os.stat(path)
+            files[path] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+# the grab reports its own peak RSS on exit: the rusage of a child counts
+# the pages of the parent it was forked from, and the fake server's can be
+# far larger than the grab's
+GRAB = """
+import atexit
+import os
+import resource
+
+
+def peakRss():
+    try:
+        with open("/proc/self/status") as ifn:
+            status = dict([x.split(":", 1) for x in ifn])
+        peak = int(status["VmHWM"].split()[0])
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.environ["SDBENCH_PEAKFILE"], "w") as ofn:
+        ofn.write(str(peak))
+
+
+atexit.register(peakRss)
+from sdjson.ccasdtv import cli
+
+cli()
+"""
+
+
+def runGrab(home):
+    """Run ccasdtv run in its own process.
+
+    Returns:
+        dict: the exit code, seconds taken and peak RSS of the run
+    """
+    peakfile = home.joinpath(".sdbench.peak")
+    env = dict(os.environ)
+    env["HOME"] = str(home)
+    env["PYTHONPATH"] = str(PKGDIR)
+    env["SDBENCH_PEAKFILE"] = str(peakfile)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", GRAB, "run"], env=env, stdout=subprocess.DEVNULL
+    )
+    seconds = time.perf_counter() - start
+    maxrsskb = int(peakfile.read_text()) if peakfile.exists() else 0
+    if peakfile.exists():
+        peakfile.unlink()
+    return {
+        "exitcode": proc.returncode,
+        "seconds": round(seconds, 3),
+        "maxrsskb": maxrsskb,
+    }
+
+
+def runPhase(fake, home, phase):
+    """Run one grab and gather its metrics."""
+    fake.resetStats()
+    before = snapshot(home)
+    res = runGrab(home)
+    after = snapshot(home)
+    written = [x for x in after if before.get(x) != after[x]]
+    totals = fake.totals()
+    res.update(
+        {
+            "phase": phase,
+            "requests": totals["requests"],
+            "bytesin": totals["bytesin"],
+            "bytesout": totals["bytesout"],
+            "status": totals["status"],
+            "routes": fake.stats,
+            "fileswritten": len(written),
+            "byteswritten": sum([after[x][1] for x in written]),
+            "cachefiles": len(after),
+            "cachebytes": sum([x[1] for x in after.values()]),
+        }
+    )
+    return res
+
+
+def benchSize(nstations, serveropts, settings, churn, keep):
+    """Run the cold, warm and churn grabs for a lineup of nstations."""
+    fake = FakeSD(stations=nstations, **serveropts)
+    url = fake.start()
+    home = Path(tempfile.mkdtemp(prefix=f"sdbench{nstations}."))
+    try:
+        writeConfig(home, url, settings)
+        results = []
+        for phase in PHASES:
+            if phase == "churn":
+                fake.churn(churn)
+            res = runPhase(fake, home, phase)
+            res["stations"] = nstations
+            results.append(res)
+            click.echo(
+                f"""{nstations:5d} stations {phase:5s} {res["seconds"]:8.2f}s """
+                f"""{res["requests"]:5d} requests {res["bytesout"] // 1024:8d} KB """
+                f"""{res["maxrsskb"] // 1024:5d} MB rss """
+                f"""{res["fileswritten"]:7d} files written"""
+                + ("" if res["exitcode"] == 0 else f""" exit {res["exitcode"]}"""),
+                err=True,
+            )
+        return results
+    finally:
+        fake.stop()
+        if keep:
+            click.echo(f"kept {home}", err=True)
+        else:
+            subprocess.run(["rm", "-rf", str(home)])
+
+
+def parseSettings(settings):
+    """Returns the key=value config settings as a dict, values parsed as yaml."""
+    xsettings = {}
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        xsettings[key] = yaml.safe_load(value)
+    return xsettings
+
+
+def compare(old, new):
+    """Print the change in each metric from the old results to the new."""
+    oldruns = {(x["stations"], x["phase"]): x for x in old["results"]}
+    click.echo(f"""{old["commit"]} -> {new["commit"]}""", err=True)
+    click.echo(
+        f"""{"stations":>8s} {"phase":5s} """
+        + " ".join([f"{x:>14s}" for x in METRICS]),
+        err=True,
+    )
+    for run in new["results"]:
+        oldrun = oldruns.get((run["stations"], run["phase"]))
+        if oldrun is None:
+            continue
+        cols = []
+        for metric in METRICS:
+            if oldrun[metric] == 0:
+                cols.append(f"{run[metric]:>14}")
+            else:
+                change = 100 * (run[metric] - oldrun[metric]) / oldrun[metric]
+                cols.append(f"{change:>+13.1f}%")
+        click.echo(
+            f"""{run["stations"]:8d} {run["phase"]:5s} """ + " ".join(cols), err=True
+        )
+
+
+@click.command()
+@click.option(
+    "--stations",
+    "sizes",
+    default="10,150,1000",
+    help="comma separated lineup sizes, default: 10,150,1000",
+)
+@click.option("--days", default=14, help="days of schedules, default: 14")
+@click.option("--airings", default=48, help="airings per station day, default: 48")
+@click.option(
+    "--unique", default=0.3, help="distinct programs per airing, default: 0.3"
+)
+@click.option("--desclen", default=200, help="program description length, default: 200")
+@click.option("--latency", default=0.05, help="seconds per response, default: 0.05")
+@click.option(
+    "--maxinflight",
+    default=0,
+    help="http 429 beyond this many requests in flight, default: 0, no limit",
+)
+@click.option("--throttle", default=0.0, help="chance of a http 429, default: 0")
+@click.option(
+    "--retryafter", default=None, type=int, help="Retry-After seconds on a 429"
+)
+@click.option(
+    "--queued", default=0.0, help="chance of a schedule or program being queued"
+)
+@click.option("--maxbatch", default=5000, help="most items per request, default: 5000")
+@click.option("--churn", default=0.1, help="station days changed, default: 0.1")
+@click.option(
+    "--set",
+    "settings",
+    multiple=True,
+    help="ccasdtv config setting key=value, may be repeated",
+)
+@click.option("--output", "-o", default="-", help="json file, default: stdout")
+@click.option("--compare", "baseline", default=None, help="json file to compare with")
+@click.option("--keep", is_flag=True, help="keep the benchmark home directories")
+def bench(
+    sizes,
+    days,
+    airings,
+    unique,
+    desclen,
+    latency,
+    maxinflight,
+    throttle,
+    retryafter,
+    queued,
+    maxbatch,
+    churn,
+    settings,
+    output,
+    baseline,
+    keep,
+):
+    """Benchmark ccasdtv run against a fake SD server."""
+    serveropts = {
+        "days": days,
+        "airings": airings,
+        "unique": unique,
+        "desclen": desclen,
+        "latency": latency,
+        "maxinflight": maxinflight,
+        "throttle": throttle,
+        "retryafter": retryafter,
+        "queued": queued,
+        "maxbatch": maxbatch,
+    }
+    xsettings = parseSettings(settings)
+    results = []
+    for nstations in [int(x) for x in sizes.split(",")]:
+        results.extend(benchSize(nstations, serveropts, xsettings, churn, keep))
+    report = {
+        "commit": gitCommit(),
+        "date": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": dict(serveropts, churn=churn),
+        "settings": xsettings,
+        "results": results,
+    }
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as ofn:
+            json.dump(report, ofn, indent=2)
+    if baseline is not None:
+        with open(baseline, "r") as ifn:
+            compare(json.load(ifn), report)
+    if any([x["exitcode"] != 0 for x in results]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
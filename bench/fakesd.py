@@ -0,0 +1,457 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""A local stand in for the Schedules Direct JSON API.
+
+FakeSD answers the token, status, lineups, lineups/<id>, schedules/md5,
+schedules and programs routes for one lineup of a given number of stations.
+Every response is generated from the station, day and slot numbers, so the
+server holds no guide data and the same options always give the same guide.
+
+Latency, payload size and SD's rate limiting (http 429 over a number of
+requests in flight, random throttling and queued schedules and programs)
+are configurable, and the requests and bytes of each route are counted.
+"""
+
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+LINEUPID = "GBR-1000001-DEFAULT"
+# SD codes
+PROGRAM_QUEUED = 6001
+SCHEDULE_QUEUED = 7100
+TOKEN_EXPIRED = 4006
+
+
+def sdMd5(text):
+    """Returns an md5 in SD's form, 22 characters of base64."""
+    return base64.b64encode(hashlib.md5(text.encode()).digest()).decode()[:22]
+
+
+def sdTime(epoch):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(epoch))
+
+
+class FakeSD:
+    def __init__(
+        self,
+        stations=10,
+        days=14,
+        airings=48,
+        unique=0.3,
+        desclen=200,
+        latency=0.0,
+        maxinflight=0,
+        throttle=0.0,
+        retryafter=None,
+        queued=0.0,
+        maxbatch=5000,
+        compress=True,
+        tokenlife=0,
+        seed=1,
+    ):
+        """Initialise the fake server's guide and behaviour.
+
+        Args:
+            stations: int: stations in the lineup, default: 10
+            days: int: days of schedules from today (UTC), default: 14
+            airings: int: airings per station day, default: 48
+            unique: float: distinct programs as a fraction of all the
+                airings, the rest are repeats, default: 0.3
+            desclen: int: characters in each program's long description, default: 200
+            latency: float: seconds added to every response, default: 0
+            maxinflight: int: answer http 429 to requests beyond this many
+                in flight, default: 0, no limit
+            throttle: float: chance of answering any request with http 429
+            retryafter: int: Retry-After seconds sent with a 429, default: none
+            queued: float: chance of a schedule or program being queued the
+                first time it is asked for
+            maxbatch: int: most items in one schedules or programs request,
+                more is answered with http 413, default: 5000
+            compress: bool: gzip responses if the client accepts it, default: True
+            tokenlife: int: requests a token is good for, default: 0, forever
+            seed: int: seed for the random throttling and queueing
+        """
+        self.nstations = stations
+        self.ndays = days
+        self.nairings = airings
+        self.npool = max(1, int(stations * days * airings * unique))
+        self.desclen = desclen
+        self.latency = latency
+        self.maxinflight = maxinflight
+        self.throttle = throttle
+        self.retryafter = retryafter
+        self.queued = queued
+        self.maxbatch = maxbatch
+        self.compress = compress
+        self.tokenlife = tokenlife
+        self.random = random.Random(seed)
+        self.today = datetime.datetime.utcnow().date()
+        self.lineupmodified = sdTime(time.time() - 86400)
+        # station day: version, bumped by churn
+        self.versions = {}
+        self.seenqueued = set()
+        self.token = None
+        self.tokenuses = 0
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.resetStats()
+
+    def resetStats(self):
+        with self.lock:
+            self.stats = {}
+
+    def count(self, route, status, bytesin, bytesout):
+        with self.lock:
+            xstat = self.stats.setdefault(
+                route, {"requests": 0, "bytesin": 0, "bytesout": 0, "status": {}}
+            )
+            xstat["requests"] += 1
+            xstat["bytesin"] += bytesin
+            xstat["bytesout"] += bytesout
+            xstat["status"][str(status)] = xstat["status"].get(str(status), 0) + 1
+
+    def totals(self):
+        """Returns the requests and bytes of every route added together."""
+        with self.lock:
+            xtot = {"requests": 0, "bytesin": 0, "bytesout": 0, "status": {}}
+            for xstat in self.stats.values():
+                for key in ("requests", "bytesin", "bytesout"):
+                    xtot[key] += xstat[key]
+                for code, n in xstat["status"].items():
+                    xtot["status"][code] = xtot["status"].get(code, 0) + n
+            return xtot
+
+    def stationIds(self):
+        return [str(20000 + i) for i in range(self.nstations)]
+
+    def dates(self):
+        return [
+            (self.today + datetime.timedelta(days=i)).isoformat()
+            for i in range(self.ndays)
+        ]
+
+    def churn(self, fraction):
+        """Change the schedules of a fraction of the station days.
+
+        Returns:
+            int: the number of station days changed
+        """
+        days = [(sid, date) for sid in self.stationIds() for date in self.dates()]
+        changed = self.random.sample(days, int(len(days) * fraction))
+        with self.lock:
+            for key in changed:
+                self.versions[key] = self.versions.get(key, 0) + 1
+        return len(changed)
+
+    def lineup(self):
+        sids = self.stationIds()
+        return {
+            "map": [
+                {"stationID": sid, "channel": str(i + 1)} for i, sid in enumerate(sids)
+            ],
+            "stations": [
+                {
+                    "stationID": sid,
+                    "name": f"Station {sid}",
+                    "callsign": f"ST{sid}",
+                    "affiliate": "Fake",
+                    "broadcastLanguage": ["en"],
+                    "stationLogo": [{"URL": f"https://example.com/logo/{sid}.png"}],
+                }
+                for sid in sids
+            ],
+            "metadata": {"lineup": LINEUPID, "modified": self.lineupmodified},
+        }
+
+    def status(self):
+        return {
+            "account": {"expires": sdTime(time.time() + 86400 * 365), "maxLineups": 4},
+            "lineups": [{"lineupID": LINEUPID, "modified": self.lineupmodified}],
+            "lastDataUpdate": sdTime(time.time()),
+            "systemStatus": [
+                {
+                    "date": sdTime(time.time() - 3600),
+                    "status": "Online",
+                    "message": "ok",
+                }
+            ],
+            "code": 0,
+        }
+
+    def programId(self, sid, date, slot):
+        """Returns the programID airing in a slot, repeats come from a shared pool."""
+        s = int(sid) - 20000
+        d = (datetime.date.fromisoformat(date) - self.today).days
+        version = self.versions.get((sid, date), 0)
+        idx = (s * self.ndays * self.nairings + d * self.nairings + slot) % self.npool
+        idx = (idx + version * 7919) % self.npool
+        return f"EP{idx // 100:08d}{idx % 100:04d}"
+
+    def dayMd5(self, sid, date):
+        return sdMd5(f"""{sid}{date}{self.versions.get((sid, date), 0)}""")
+
+    def scheduleMd5s(self, body):
+        out = {}
+        for req in body:
+            sid = req["stationID"]
+            dates = req.get("date", self.dates())
+            out[sid] = {
+                date: {
+                    "code": 0,
+                    "lastModified": self.lineupmodified,
+                    "md5": self.dayMd5(sid, date),
+                }
+                for date in dates
+                if date in self.dates()
+            }
+        return out
+
+    def isQueued(self, key):
+        """True the first time a key is chosen to be queued."""
+        with self.lock:
+            if key in self.seenqueued:
+                return False
+            if self.queued > 0 and self.random.random() < self.queued:
+                self.seenqueued.add(key)
+                return True
+            return False
+
+    def schedules(self, body):
+        out = []
+        slot = 86400 // self.nairings
+        for req in body:
+            sid = req["stationID"]
+            if self.isQueued(("schedule", sid)):
+                out.append(
+                    {"stationID": sid, "code": SCHEDULE_QUEUED, "response": "QUEUED"}
+                )
+                continue
+            for date in req.get("date", self.dates()):
+                start = datetime.datetime.fromisoformat(date).replace(
+                    tzinfo=datetime.timezone.utc
+                )
+                start = int(start.timestamp())
+                progs = []
+                for i in range(self.nairings):
+                    pid = self.programId(sid, date, i)
+                    progs.append(
+                        {
+                            "programID": pid,
+                            "airDateTime": sdTime(start + i * slot),
+                            "duration": slot,
+                            "md5": sdMd5(pid),
+                            "audioProperties": ["stereo"],
+                            "ratings": [{"body": "Fake", "code": "PG"}],
+                        }
+                    )
+                out.append(
+                    {
+                        "stationID": sid,
+                        "programs": progs,
+                        "metadata": {
+                            "modified": self.lineupmodified,
+                            "md5": self.dayMd5(sid, date),
+                            "startDate": date,
+                        },
+                    }
+                )
+        return out
+
+    def program(self, pid):
+        words = (f"{pid} is a programme about something. " * 40)[: self.desclen]
+        return {
+            "programID": pid,
+            "titles": [{"title120": f"Programme {pid[2:10]}"}],
+            "episodeTitle150": f"Episode {pid[10:]}",
+            "descriptions": {
+                "description100": [
+                    {"descriptionLanguage": "en", "description": words[:100]}
+                ],
+                "description1000": [
+                    {"descriptionLanguage": "en", "description": words}
+                ],
+            },
+            "originalAirDate": "2020-01-01",
+            "genres": ["Drama"],
+            "metadata": [
+                {
+                    "Gracenote": {
+                        "season": 1 + int(pid[2:10]) % 9,
+                        "episode": int(pid[10:]) + 1,
+                    }
+                }
+            ],
+            "cast": [
+                {
+                    "name": f"Actor {pid[-3:]}-{i}",
+                    "role": "Actor",
+                    "billingOrder": f"{i:02d}",
+                }
+                for i in range(4)
+            ],
+            "crew": [{"name": f"Director {pid[-2:]}", "role": "Director"}],
+            "showType": "Series",
+            "entityType": "Episode",
+            "md5": sdMd5(pid),
+        }
+
+    def programs(self, body):
+        out = []
+        for pid in body:
+            if self.isQueued(("program", pid)):
+                out.append(
+                    {"programID": pid, "code": PROGRAM_QUEUED, "response": "QUEUED"}
+                )
+            else:
+                out.append(self.program(pid))
+        return out
+
+    def newToken(self):
+        with self.lock:
+            self.token = sdMd5(f"token{time.time()}{self.random.random()}")
+            self.tokenuses = 0
+            return self.token
+
+    def useToken(self, token):
+        """True if the token is the current one and has not worn out."""
+        with self.lock:
+            if token is None or token != self.token:
+                return False
+            self.tokenuses += 1
+            return self.tokenlife == 0 or self.tokenuses <= self.tokenlife
+
+    def start(self):
+        """Start serving on a free local port in a daemon thread.
+
+        Returns:
+            str: the base url to give SDApi
+        """
+        fake = self
+
+        class Handler(FakeSDHandler):
+            sd = fake
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return f"http://127.0.0.1:{self.server.server_port}/20191022"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class FakeSDHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    sd = None
+
+    def log_message(self, *args):
+        pass
+
+    def route(self):
+        return self.path.split("?")[0].split("/", 2)[-1]
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def handle_request(self, method):
+        sd = self.sd
+        nbody = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(nbody) if nbody > 0 else b""
+        route = self.route()
+        name = "lineups/<id>" if route.startswith("lineups/") else route
+        with sd.lock:
+            sd.inflight += 1
+            inflight = sd.inflight
+        try:
+            if sd.latency > 0:
+                time.sleep(sd.latency)
+            status, obj = self.answer(method, route, raw, inflight)
+            self.send(name, status, obj, len(raw))
+        finally:
+            with sd.lock:
+                sd.inflight -= 1
+
+    def answer(self, method, route, raw, inflight):
+        """Returns the (http status, json object) for a request."""
+        sd = self.sd
+        body = json.loads(raw) if len(raw) > 0 else None
+        if route == "token" and method == "POST":
+            return (
+                200,
+                {"code": 0, "token": sd.newToken(), "datetime": sdTime(time.time())},
+            )
+        if sd.maxinflight > 0 and inflight > sd.maxinflight:
+            return (429, {"code": 1, "response": "TOO_MANY_REQUESTS"})
+        if sd.throttle > 0:
+            with sd.lock:
+                throttled = sd.random.random() < sd.throttle
+            if throttled:
+                return (429, {"code": 1, "response": "TOO_MANY_REQUESTS"})
+        if not sd.useToken(self.headers.get("token")):
+            return (403, {"code": TOKEN_EXPIRED, "response": "TOKEN_EXPIRED"})
+        if route == "status":
+            return (200, sd.status())
+        if route == "lineups":
+            return (200, {"code": 0, "lineups": [{"lineup": LINEUPID}]})
+        if route == f"lineups/{LINEUPID}":
+            return (200, sd.lineup())
+        if route in ("schedules", "programs") and len(body) > sd.maxbatch:
+            return (413, {"code": 1, "response": "TOO_MANY_ITEMS"})
+        if route == "schedules/md5":
+            return (200, sd.scheduleMd5s(body))
+        if route == "schedules":
+            return (200, sd.schedules(body))
+        if route == "programs":
+            return (200, sd.programs(body))
+        return (404, {"code": 1, "response": f"no such route {route}"})
+
+    def send(self, name, status, obj, bytesin):
+        sd = self.sd
+        data = json.dumps(obj).encode()
+        gzipped = sd.compress and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            data = gzip.compress(data, compresslevel=5)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        if status == 429 and sd.retryafter is not None:
+            self.send_header("Retry-After", str(sd.retryafter))
+        self.end_headers()
+        self.wfile.write(data)
+        sd.count(name, status, bytesin, len(data))
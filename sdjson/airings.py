@@ -0,0 +1,391 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Binary airing files for ccasdtv.
+
+Alongside each station's schedule.json the cache writes schedule.bin, the
+station's airings sorted by air time as fixed width records, so that the
+airings in a time window can be found by bisecting an mmap of the file
+instead of parsing the whole schedule.
+"""
+
+import bisect
+import calendar
+import mmap
+import struct
+import sys
+import threading
+import time
+
+import ccalogging
+
+log = ccalogging.log
+
+MAGIC = b"SDAIR001"
+# air time (epoch), duration (seconds), programID, binary md5 of the program
+AIRING = struct.Struct("<qi16s16s")
+
+
+def airTime(dt, dtformat="%Y-%m-%dT%H:%M:%SZ"):
+    """Returns the epoch timestamp for the SD UTC date time string dt."""
+    try:
+        return calendar.timegm(time.strptime(dt, dtformat))
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def scheduleAirings(chansched, programkey):
+    """Returns the sorted (airtime, duration, programID, key) tuples of a schedule.
+
+    Args:
+        chansched: list: the schedule days, as written to schedule.json
+        programkey: function: returns the hex key of a program md5
+    """
+    try:
+        airings = []
+        for day in chansched:
+            for prog in day.get("programs", []):
+                airings.append(
+                    (
+                        airTime(prog["airDateTime"]),
+                        int(prog.get("duration", 0)),
+                        prog["programID"],
+                        programkey(prog["md5"]),
+                    )
+                )
+        airings.sort()
+        return airings
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def packAirings(airings):
+    """Returns the schedule.bin contents for the sorted airings."""
+    try:
+        data = bytearray(MAGIC)
+        for airtime, duration, pid, key in airings:
+            data += AIRING.pack(
+                airtime, duration, pid.encode()[:16], bytes.fromhex(key)
+            )
+        return bytes(data)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+class SDScheduleReader:
+    """Reads the airings of one station from its mmapped schedule.bin."""
+
+    def __init__(self, filename, stationid=None):
+        try:
+            self.filename = filename
+            self.stationid = stationid
+            self.map = None
+            self.count = 0
+            with open(filename, "rb") as sfn:
+                if sfn.read(len(MAGIC)) != MAGIC:
+                    raise Exception(f"{filename} is not a schedule airings file")
+                size = sfn.seek(0, 2)
+                # the file is replaced whole, a partial record means damage
+                if (size - len(MAGIC)) % AIRING.size != 0:
+                    raise Exception(f"{filename} is truncated")
+                if size > len(MAGIC):
+                    self.map = mmap.mmap(sfn.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = (size - len(MAGIC)) // AIRING.size
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        """Returns the (airtime, duration, programID, md5) of airing i."""
+        try:
+            airtime, duration, pid, key = AIRING.unpack_from(
+                self.map, len(MAGIC) + i * AIRING.size
+            )
+            return (airtime, duration, pid.rstrip(b"\0").decode(), key.hex())
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def airing(self, i):
+        """Returns airing i as a dict."""
+        airtime, duration, pid, key = self.record(i)
+        return {
+            "stationID": self.stationid,
+            "airtime": airtime,
+            "duration": duration,
+            "programID": pid,
+            "md5": key,
+        }
+
+    def airTimeAt(self, i):
+        return struct.unpack_from("<q", self.map, len(MAGIC) + i * AIRING.size)[0]
+
+    def bisect(self, when):
+        """Returns the index of the first airing that starts after when."""
+        try:
+            lo = 0
+            hi = self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.airTimeAt(mid) <= when:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def airingsBetween(self, start, end):
+        """Returns the airings that overlap the epoch window start to end.
+
+        Returns:
+            list: of dicts with stationID, airtime, duration, programID and md5
+        """
+        try:
+            airings = []
+            # a station's airings do not overlap, so only the one airing
+            # before the first to start after start can still be on
+            i = max(0, self.bisect(start) - 1)
+            while i < self.count:
+                airing = self.airing(i)
+                if airing["airtime"] >= end:
+                    break
+                if airing["airtime"] + airing["duration"] > start:
+                    airings.append(airing)
+                i += 1
+            return airings
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def nowNext(self, when=None):
+        """Returns the airings on at when (default now) and the one after it."""
+        try:
+            if when is None:
+                when = int(time.time())
+            airings = self.airingsBetween(when, when + 1)
+            i = self.bisect(when)
+            if i < self.count:
+                airings.append(self.airing(i))
+            return airings
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+
+class SDAiringIndex:
+    """In memory index of the airings of every station, by time.
+
+    Airings are kept in hour long buckets, sorted by air time, and an airing
+    is entered in every bucket that it overlaps. A window query only looks
+    at the buckets that cover the window and bisects each of them for the
+    airings that start before the window ends and, in the first bucket,
+    could still be on at its start (no earlier than the start less the
+    bucket's longest airing). In later buckets it starts at the bucket
+    start, as each airing is reported from one bucket only.
+    """
+
+    def __init__(self, bucketsize=3600):
+        try:
+            self.bucketsize = bucketsize
+            # bucket number: sorted list of (airtime, duration, stationid, pid, md5)
+            self.buckets = {}
+            # bucket number: list of the airtimes in the bucket, for bisect
+            self.starts = {}
+            # bucket number: the longest duration in the bucket
+            self.longest = {}
+            # stationid: set of bucket numbers holding its airings
+            self.stationbuckets = {}
+            self.lock = threading.Lock()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def updateStation(self, stationid, airings):
+        """Replace the station's airings in the index.
+
+        Args:
+            stationid: str: the station
+            airings: list: (airtime, duration, programID, md5) tuples
+        """
+        try:
+            with self.lock:
+                touched = self.stationbuckets.pop(stationid, set())
+                for bucket in touched:
+                    self.buckets[bucket] = [
+                        x for x in self.buckets[bucket] if x[2] != stationid
+                    ]
+                added = set()
+                for airtime, duration, pid, key in airings:
+                    first = airtime // self.bucketsize
+                    last = (airtime + max(duration, 1) - 1) // self.bucketsize
+                    for bucket in range(first, last + 1):
+                        self.buckets.setdefault(bucket, []).append(
+                            (airtime, duration, stationid, pid, key)
+                        )
+                        added.add(bucket)
+                for bucket in touched | added:
+                    xbucket = self.buckets[bucket]
+                    if len(xbucket) == 0:
+                        del self.buckets[bucket]
+                        self.starts.pop(bucket, None)
+                        self.longest.pop(bucket, None)
+                    else:
+                        xbucket.sort()
+                        self.starts[bucket] = [x[0] for x in xbucket]
+                        self.longest[bucket] = max([x[1] for x in xbucket])
+                if len(added) > 0:
+                    self.stationbuckets[stationid] = added
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def airingsBetween(self, start, end, stations=None):
+        """Returns the airings of all (or the given) stations in the window.
+
+        Args:
+            start: int: epoch start of the window
+            end: int: epoch end of the window
+            stations: iterable: station ids to restrict to, default: all
+
+        Returns:
+            list: of dicts with stationID, airtime, duration, programID and md5,
+                ordered by bucket and then air time
+        """
+        try:
+            if stations is not None:
+                stations = set(stations)
+            airings = []
+            if end <= start:
+                return airings
+            first = start // self.bucketsize
+            last = (end - 1) // self.bucketsize
+            with self.lock:
+                for bucket in range(first, last + 1):
+                    xbucket = self.buckets.get(bucket)
+                    if xbucket is None:
+                        continue
+                    starts = self.starts[bucket]
+                    if bucket == first:
+                        lo = bisect.bisect_right(starts, start - self.longest[bucket])
+                    else:
+                        lo = bisect.bisect_left(starts, bucket * self.bucketsize)
+                    stop = bisect.bisect_left(starts, end)
+                    for i in range(lo, stop):
+                        airtime, duration, sid, pid, key = xbucket[i]
+                        if airtime + duration <= start:
+                            continue
+                        # report each airing from one bucket only, the one
+                        # holding the later of its start and the window start
+                        if max(airtime, start) // self.bucketsize != bucket:
+                            continue
+                        if stations is not None and sid not in stations:
+                            continue
+                        airings.append(
+                            {
+                                "stationID": sid,
+                                "airtime": airtime,
+                                "duration": duration,
+                                "programID": pid,
+                                "md5": key,
+                            }
+                        )
+            return airings
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def loadStation(self, reader):
+        """Add the airings from an SDScheduleReader to the index."""
+        try:
+            airings = [reader.record(i) for i in range(len(reader))]
+            self.updateStation(reader.stationid, airings)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
@@ -17,22 +17,211 @@
 #     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
 """Cache functions for ccasdtv."""
 
+import base64
+import binascii
+import datetime
+import gzip
+import hashlib
 import json
+import mmap
+import os
 from pathlib import Path
+import shutil
+import struct
 import sys
+import threading
+import time
 
 import ccalogging
 
+from sdjson.airings import packAirings
+from sdjson.airings import scheduleAirings
+from sdjson.airings import SDAiringIndex
+from sdjson.airings import SDScheduleReader
+from sdjson.cachestats import SDCacheStats
+from sdjson.cachestats import statsEnabled
+from sdjson.journal import SDJournal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 log = ccalogging.log
 
+# file name suffix for each cache codec
+CODECS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+# pack index record: md5 key, programID, codec number, pack number, offset, length
+PACKINDEX = struct.Struct("<16s16sBIQI")
+
+
 # TODO test this class
 class SDCache:
     """Cache class for the ccasdtv application."""
 
-    def __init__(self, appname="ccasdtv"):
+    def __init__(
+        self,
+        appname="ccasdtv",
+        fsync="batch",
+        codec="none",
+        programstore="tree",
+        searchdb=None,
+        cachestats=False,
+        journal=False,
+    ):
+        """Initialise the cache.
+
+        Args:
+            appname: str: the cache lives in ~/.<appname>
+            fsync: str: "always" to fsync every file and its directory as it is
+                written, "batch" to fsync every file as it is written and each
+                written directory once per batch (at flush), "none" to leave it
+                to the OS, default: "batch"
+            codec: str: compress cache files with "gzip" or "zstd" (needs the
+                zstandard package), default: "none"
+            programstore: str: "tree" to store each program in its own file
+                in the md5 sharded tree, "pack" to append them to pack files,
+                default: "tree"
+            searchdb: SDDb: database to mirror schedules and programs into,
+                so that they can be searched, default: None
+            cachestats: bool: time and count the cache I/O, also turned on
+                by the <APPNAME>_CACHESTATS environment variable, default: False
+            journal: bool: record what each run changes in the cache journal,
+                so that an export only regenerates that, default: False
+        """
         try:
             self.cachedict = None
             self.appname = appname
+            self.cachedir = None
+            self.journal = None
+            self.usejournal = journal
+            self.schedmd5 = None
+            self.fsync = fsync
+            self.dirtydirs = set()
+            self.lock = threading.Lock()
+            self.knowndirs = set()
+            self.mkdirs = 0
+            self.mkdirsavoided = 0
+            self.setCodec(codec)
+            self.programstore = programstore
+            self.packstore = None
+            self.airingindex = None
+            self.searchdb = searchdb
+            self.stats = None
+            if cachestats or statsEnabled(appname):
+                self.stats = SDCacheStats()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def setCodec(self, codec):
+        """Select the codec that new cache files are written with."""
+        try:
+            if codec not in CODECS:
+                raise Exception(f"Unknown cache codec {codec}")
+            if codec == "zstd" and zstandard is None:
+                raise Exception("The zstd cache codec needs the zstandard package")
+            self.codec = codec
+            # files are looked for with the current codec's suffix first
+            self.suffixes = [CODECS[codec]] + [
+                CODECS[xc] for xc in CODECS if xc != codec
+            ]
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def encode(self, data, codec):
+        """Returns data (bytes) compressed with codec."""
+        try:
+            if codec == "gzip":
+                return gzip.compress(data, compresslevel=6)
+            elif codec == "zstd":
+                return zstandard.ZstdCompressor(level=3).compress(data)
+            return data
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def decode(self, data, suffix):
+        """Returns the data from a cache file with suffix, decompressed."""
+        try:
+            if suffix == CODECS["gzip"]:
+                return gzip.decompress(data)
+            elif suffix == CODECS["zstd"]:
+                if zstandard is None:
+                    raise Exception("Reading zstd cache files needs zstandard")
+                return zstandard.ZstdDecompressor().decompress(data)
+            return data
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def findCacheFile(self, filename, newest=False):
+        """Returns the (path, suffix) of filename as stored by any codec, or None.
+
+        Args:
+            filename: Path: the cache file, without a codec suffix
+            newest: bool: if it is stored by more than one codec, return the
+                most recently written, default: the current codec's
+        """
+        try:
+            found = None
+            for suffix in self.suffixes:
+                xfn = filename.with_name(filename.name + suffix)
+                if not newest:
+                    if xfn.exists():
+                        return (xfn, suffix)
+                    continue
+                try:
+                    mtime = xfn.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if found is None or mtime > found[2]:
+                    found = (xfn, suffix, mtime)
+            return None if found is None else found[:2]
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def readJson(self, filename, dtype=None):
+        """Returns the data from the json cache file, whatever its codec, or None."""
+        try:
+            found = self.findCacheFile(filename)
+            if found is None:
+                return None
+            xfn, suffix = found
+            start = time.perf_counter() if self.stats is not None else 0
+            with open(xfn, "rb") as xf:
+                data = xf.read()
+            if self.stats is not None:
+                seconds = time.perf_counter() - start
+                self.stats.record("read", dtype, seconds, len(data), xfn)
+            return json.loads(self.decode(data, suffix))
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -44,10 +233,11 @@ class SDCache:
 
     def getCacheDir(self):
         try:
-            home = Path.home()
-            cachedir = home.joinpath(f".{self.appname}")
-            log.debug(f"setting cache directory to be: {cachedir}")
-            return cachedir
+            if self.cachedir is None:
+                home = Path.home()
+                self.cachedir = home.joinpath(f".{self.appname}")
+                log.debug(f"setting cache directory to be: {self.cachedir}")
+            return self.cachedir
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -80,27 +270,47 @@ class SDCache:
             log.error(msg)
             raise
 
+    def programKey(self, md5):
+        """Returns the hex form of a program md5, used to name its cache file.
+
+        SD supplies the md5 base64 encoded, which can contain "/", so it is
+        converted to hex to be safe to use as a file name.
+        """
+        try:
+            if len(md5) == 32 and all(c in "0123456789abcdefABCDEF" for c in md5):
+                return md5.lower()
+            xmd5 = md5.replace("-", "+").replace("_", "/")
+            xmd5 += "=" * (-len(xmd5) % 4)
+            return base64.b64decode(xmd5, validate=True).hex()
+        except (binascii.Error, ValueError):
+            return hashlib.md5(md5.encode()).hexdigest()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
     def makeCacheDir(self, name=None, dtype="program"):
         """Makes the cache directories for the ccasdtv application."""
         try:
             home = Path.home()
             cachedir = self.getCacheDir()
             if dtype == "cache":
-                log.debug(f"making directory {cachedir}")
-                cachedir.mkdir(parents=True, exist_ok=True)
+                self.ensureDir(cachedir)
                 return cachedir
             elif dtype == "channel":
                 chandir = cachedir.joinpath("channel")
-                log.debug(f"making directory {chandir}")
-                chandir.mkdir(parents=True, exist_ok=True)
+                self.ensureDir(chandir)
                 return chandir
             elif dtype == "program":
                 if name is not None:
-                    pdir = cachedir.joinpath("program", getDescendingDir(name))
+                    pdir = cachedir.joinpath("program", self.getDescendingDir(name))
                 else:
                     pdir = cachedir.joinpath("program")
-                log.debug(f"making directory {pdir}")
-                pdir.mkdir(parents=True, exist_ok=True)
+                self.ensureDir(pdir)
                 return pdir
         except Exception as e:
             exci = sys.exc_info()[2]
@@ -111,6 +321,48 @@ class SDCache:
             log.error(msg)
             raise
 
+    def ensureDir(self, xdir):
+        """Make the directory, unless this process already knows that it exists."""
+        try:
+            if xdir in self.knowndirs:
+                self.mkdirsavoided += 1
+                return
+            log.debug(f"making directory {xdir}")
+            start = time.perf_counter() if self.stats is not None else 0
+            xdir.mkdir(parents=True, exist_ok=True)
+            if self.stats is not None:
+                seconds = time.perf_counter() - start
+                self.stats.record("mkdir", self.dirType(xdir), seconds, name=xdir)
+            self.mkdirs += 1
+            self.knowndirs.add(xdir)
+            self.knowndirs.update(xdir.parents)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def primeKnownDirs(self, xdir, depth=5):
+        """Record every existing directory below xdir, down to depth levels."""
+        try:
+            self.knowndirs.add(xdir)
+            if depth > 0:
+                with os.scandir(xdir) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            self.primeKnownDirs(xdir.joinpath(entry.name), depth - 1)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
     def setupCache(self):
         """Sets up the cache directories for the ccasdtv application."""
         try:
@@ -120,6 +372,23 @@ class SDCache:
             self.cachedict["cachedir"] = self.makeCacheDir(dtype="cache")
             self.cachedict["chandir"] = self.makeCacheDir(dtype="channel")
             self.cachedict["progdir"] = self.makeCacheDir(dtype="program")
+            # one scan of the existing tree so that each directory is only
+            # ever created once per process
+            self.primeKnownDirs(self.cachedict["cachedir"])
+            journalfn = self.cachedict["cachedir"].joinpath("journal.json")
+            if self.usejournal:
+                self.journal = SDJournal(self, journalfn)
+            else:
+                # changes made now are not journalled, so a journal left from
+                # when it was on would be wrong if it were turned on again
+                found = self.findCacheFile(journalfn)
+                if found is not None:
+                    log.info("the cache journal is off, removing the old journal")
+                    found[0].unlink()
+            if self.programstore == "pack":
+                packdir = self.cachedict["progdir"].joinpath("packs")
+                self.ensureDir(packdir)
+                self.packstore = SDPackStore(self, packdir)
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -134,8 +403,7 @@ class SDCache:
             if self.cachedict is None:
                 raise Exception("Cache dictionary has not been setup")
             xdir = self.cachedict["chandir"].joinpath(stationid)
-            log.debug(f"creating directory {xdir}")
-            xdir.mkdir(exist_ok=True)
+            self.ensureDir(xdir)
             return xdir
         except Exception as e:
             exci = sys.exc_info()[2]
@@ -151,8 +419,33 @@ class SDCache:
             xdir = self.setupChannelDir(chandata["stationID"])
             channelfilename = xdir.joinpath(f"""{chandata["stationID"]}.json""")
             log.debug(f"saving channel data to {channelfilename}")
-            with open(channelfilename, "w") as cfn:
-                json.dump(chandata, cfn, separators=(",", ":"))
+            self.writeJson(channelfilename, chandata, dtype="channel")
+            if self.journal is not None:
+                self.journal.recordStation(chandata["stationID"])
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def removeChannelFromCache(self, stationid):
+        """Remove a station that is no longer in any lineup from the cache."""
+        try:
+            if self.cachedict is None:
+                raise Exception("Cache dictionary has not been setup")
+            xdir = self.cachedict["chandir"].joinpath(stationid)
+            log.debug(f"removing channel {stationid} from the cache")
+            if xdir.exists():
+                shutil.rmtree(xdir)
+                self.knowndirs.discard(xdir)
+            if self.airingindex is not None:
+                self.airingindex.updateStation(stationid, [])
+            self.readScheduleMd5Index().pop(stationid, None)
+            if self.journal is not None:
+                self.journal.recordRemoved(stationid)
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -162,13 +455,170 @@ class SDCache:
             log.error(msg)
             raise
 
-    def writeChannelScheduleToCache(self, stationid, chansched):
+    def writeChannelScheduleToCache(self, stationid, chansched, changed=None):
+        """Replace the station's cached schedule with chansched.
+
+        Args:
+            stationid: str: the station
+            chansched: list: the schedule days
+            changed: list: the days of chansched to journal as changed, default: all
+        """
         try:
             xdir = self.setupChannelDir(stationid)
             schedfilename = xdir.joinpath("schedule.json")
             log.debug(f"writing schedule data to {schedfilename}")
-            with open(schedfilename, "w") as cfn:
-                json.dump(chansched, cfn, separators=(",", ":"))
+            self.writeJson(schedfilename, chansched, dtype="schedule")
+            airings = scheduleAirings(chansched, self.programKey)
+            self.writeBytes(
+                xdir.joinpath("schedule.bin"), packAirings(airings), dtype="schedule"
+            )
+            if self.airingindex is not None:
+                self.airingindex.updateStation(stationid, airings)
+            if self.searchdb is not None:
+                self.searchdb.writeChannelScheduleToCache(stationid, chansched)
+            self.recordScheduleMd5s(stationid, chansched, replace=True)
+            if self.journal is not None:
+                days = chansched if changed is None else changed
+                self.journal.recordStation(
+                    stationid, [x["metadata"]["startDate"] for x in days]
+                )
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def getAiringIndex(self):
+        """Returns the all station airing index.
+
+        The index is built from the cached schedule.bin files the first time
+        it is asked for, then kept up to date as schedules are written.
+        """
+        try:
+            if self.airingindex is None:
+                if self.cachedict is None:
+                    raise Exception("Cache dictionary has not been setup")
+                xindex = SDAiringIndex()
+                with os.scandir(self.cachedict["chandir"]) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            reader = self.openScheduleReader(entry.name)
+                            if reader is not None:
+                                xindex.loadStation(reader)
+                                reader.close()
+                self.airingindex = xindex
+            return self.airingindex
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def openScheduleReader(self, stationid):
+        """Returns an SDScheduleReader for the station's airings, or None."""
+        try:
+            if self.cachedict is None:
+                raise Exception("Cache dictionary has not been setup")
+            binfn = self.cachedict["chandir"].joinpath(stationid, "schedule.bin")
+            if not binfn.exists():
+                return None
+            return SDScheduleReader(binfn, stationid)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def readChannelScheduleFromCache(self, stationid):
+        """Returns the list of cached schedule days for the station."""
+        try:
+            xdir = self.setupChannelDir(stationid)
+            chansched = self.readJson(xdir.joinpath("schedule.json"), dtype="schedule")
+            return chansched if chansched is not None else []
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def updateChannelScheduleCache(self, stationid, days):
+        """Merge schedule days into the station's cached schedule.
+
+        Days are keyed on their metadata startDate, new days replace cached
+        ones and days that have already passed are dropped.
+        """
+        try:
+            today = datetime.datetime.utcnow().date().isoformat()
+            xdays = {}
+            for day in self.readChannelScheduleFromCache(stationid) + days:
+                startdate = day["metadata"]["startDate"]
+                if startdate >= today:
+                    xdays[startdate] = day
+            merged = [xdays[startdate] for startdate in sorted(xdays)]
+            self.writeChannelScheduleToCache(stationid, merged, changed=days)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def readScheduleMd5Index(self):
+        """Returns the stationid: {date: md5} index of the cached schedules."""
+        try:
+            if self.schedmd5 is None:
+                indexfn = self.getCacheDir().joinpath("schedulemd5.json")
+                self.schedmd5 = self.readJson(indexfn) or {}
+            return self.schedmd5
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def writeScheduleMd5Index(self):
+        """Persist the schedule md5 index to the cache directory."""
+        try:
+            if self.schedmd5 is not None:
+                indexfn = self.getCacheDir().joinpath("schedulemd5.json")
+                log.debug(f"writing schedule md5 index to {indexfn}")
+                self.writeJson(indexfn, self.schedmd5)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def recordScheduleMd5s(self, stationid, days, replace=False):
+        """Record the md5 of each of the schedule days in the md5 index."""
+        try:
+            index = self.readScheduleMd5Index()
+            if replace or stationid not in index:
+                index[stationid] = {}
+            for day in days:
+                meta = day.get("metadata", {})
+                if "startDate" in meta and "md5" in meta:
+                    index[stationid][meta["startDate"]] = meta["md5"]
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -182,8 +632,7 @@ class SDCache:
         try:
             cachedir = self.getCacheDir()
             lineupfn = cachedir.joinpath(f"{lineupid}.json")
-            with open(lineupfn, "w") as lfn:
-                json.dump(ldata, lfn, separators=(",", ":"))
+            self.writeJson(lineupfn, ldata, dtype="lineup")
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -192,3 +641,746 @@ class SDCache:
             msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
             print(msg)
             raise
+
+    def readLineupData(self, lineupid):
+        """Returns the cached lineup data written by writeLineupData or None."""
+        try:
+            cachedir = self.getCacheDir()
+            return self.readJson(cachedir.joinpath(f"{lineupid}.json"), dtype="lineup")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def removeLineupData(self, lineupid):
+        """Remove the cached data of a lineup that is no longer in the account."""
+        try:
+            cachedir = self.getCacheDir()
+            found = self.findCacheFile(cachedir.joinpath(f"{lineupid}.json"))
+            if found is not None:
+                log.debug(f"removing lineup {lineupid} from the cache")
+                found[0].unlink()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def programFileName(self, md5):
+        """Returns the cache file name for the program with this md5."""
+        try:
+            key = self.programKey(md5)
+            cachedir = self.getCacheDir()
+            return cachedir.joinpath(
+                "program", self.getDescendingDir(key), f"{key}.json"
+            )
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def haveProgram(self, md5):
+        """Returns True if the program with this md5 is already cached."""
+        try:
+            if self.packstore is not None:
+                return self.packstore.have(md5)
+            return self.findCacheFile(self.programFileName(md5)) is not None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def writeProgramToCache(self, program):
+        try:
+            if self.searchdb is not None:
+                self.searchdb.writeProgramToCache(program)
+            key = self.programKey(program["md5"])
+            if self.journal is not None:
+                self.journal.recordProgram(key)
+            if self.packstore is not None:
+                return self.packstore.write(program)
+            pdir = self.makeCacheDir(name=key, dtype="program")
+            progfilename = pdir.joinpath(f"{key}.json")
+            log.debug(f"""saving program {program["programID"]} to {progfilename}""")
+            self.writeJson(progfilename, program, dtype="program")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def readProgramFromCache(self, md5):
+        """Returns the cached program with this md5 or None."""
+        try:
+            if self.packstore is not None:
+                return self.packstore.read(md5)
+            return self.readJson(self.programFileName(md5), dtype="program")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def writeJson(self, filename, data, dtype=None):
+        """Atomically replace filename with the json of data.
+
+        The data is written to a temporary file in the same directory which
+        is then renamed over filename, so a crash can never leave a
+        truncated file behind. The codec's suffix is added to filename and
+        any copy of it stored by another codec is removed, so that it can
+        never be read in place of this one.
+        """
+        try:
+            xfn = filename.with_name(filename.name + CODECS[self.codec])
+            xdata = json.dumps(data, separators=(",", ":")).encode()
+            self.writeBytes(xfn, self.encode(xdata, self.codec), dtype)
+            self.removeOtherCodecs(filename)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def removeOtherCodecs(self, filename):
+        """Remove the copies of filename stored by codecs other than the current one."""
+        try:
+            for suffix in self.suffixes[1:]:
+                try:
+                    filename.with_name(filename.name + suffix).unlink()
+                except FileNotFoundError:
+                    pass
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def writeBytes(self, filename, data, dtype=None):
+        """Atomically replace filename with data, via a temporary file.
+
+        Args:
+            filename: Path: the file to replace
+            data: bytes: its new contents
+            dtype: str: the type of data, for the cache statistics
+        """
+        try:
+            start = time.perf_counter() if self.stats is not None else 0
+            tmpfn = filename.with_name(
+                f".{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            try:
+                with open(tmpfn, "wb") as tfn:
+                    tfn.write(data)
+                    # the data must be on disk before the rename is, or a
+                    # crash can leave an empty file behind the new name
+                    if self.fsync in ("always", "batch"):
+                        tfn.flush()
+                        os.fsync(tfn.fileno())
+                os.replace(tmpfn, filename)
+            except BaseException:
+                if tmpfn.exists():
+                    tmpfn.unlink()
+                raise
+            if self.stats is not None:
+                seconds = time.perf_counter() - start
+                self.stats.record("write", dtype, seconds, len(data), filename)
+            if self.fsync == "always":
+                self.syncDir(filename.parent)
+            elif self.fsync == "batch":
+                with self.lock:
+                    self.dirtydirs.add(filename.parent)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def syncDir(self, dirname):
+        """fsync a directory so that the renames in it are durable."""
+        try:
+            start = time.perf_counter() if self.stats is not None else 0
+            fd = os.open(str(dirname), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if self.stats is not None:
+                seconds = time.perf_counter() - start
+                self.stats.record("fsync", self.dirType(dirname), seconds, name=dirname)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def flush(self):
+        """fsync each directory written to since the last flush, once."""
+        try:
+            with self.lock:
+                dirs = self.dirtydirs
+                self.dirtydirs = set()
+            for dirname in dirs:
+                self.syncDir(dirname)
+            if len(dirs) > 0:
+                log.debug(f"synced {len(dirs)} cache directories")
+            if self.packstore is not None:
+                self.packstore.flush()
+            if self.searchdb is not None:
+                self.searchdb.flush()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def dirType(self, xdir):
+        """Returns the type of data kept in a cache directory, for the statistics."""
+        if self.cachedict is not None:
+            for dtype, key in (("program", "progdir"), ("channel", "chandir")):
+                base = self.cachedict.get(key)
+                if base is not None and (xdir == base or base in xdir.parents):
+                    return dtype
+        return None
+
+    def logStats(self):
+        """Log the cache I/O statistics, if they are being kept, and reset them."""
+        if self.stats is not None:
+            self.stats.logSummary()
+            self.stats.reset()
+
+    def recompressCache(self, codec):
+        """Rewrite every json file in the cache with codec.
+
+        Where a file is stored by more than one codec, the most recently
+        written copy is kept.
+
+        Returns:
+            int: the number of files rewritten
+        """
+        try:
+            self.setCodec(codec)
+            count = 0
+            cachedir = self.getCacheDir()
+            for root, dirs, files in os.walk(cachedir):
+                for fn in files:
+                    if fn.startswith("."):
+                        continue
+                    for suffix in CODECS.values():
+                        if fn.endswith(f".json{suffix}"):
+                            break
+                    else:
+                        continue
+                    if suffix == CODECS[codec]:
+                        continue
+                    filename = Path(root).joinpath(fn[: len(fn) - len(suffix)])
+                    found = self.findCacheFile(filename, newest=True)
+                    if found is None:
+                        # already rewritten from a newer copy
+                        continue
+                    xfn, suffix = found
+                    if suffix == CODECS[codec]:
+                        self.removeOtherCodecs(filename)
+                        continue
+                    with open(xfn, "rb") as xf:
+                        data = json.loads(self.decode(xf.read(), suffix))
+                    self.writeJson(filename, data)
+                    count += 1
+            if self.packstore is not None:
+                count += self.packstore.compact()
+            self.flush()
+            log.info(f"recompressed {count} cache files with {codec}")
+            return count
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def iterPrograms(self):
+        """Yield every cached program."""
+        try:
+            if self.packstore is not None:
+                yield from self.packstore.iterPrograms()
+                return
+            progdir = self.getCacheDir().joinpath("program")
+            for root, dirs, files in os.walk(progdir):
+                if "packs" in dirs:
+                    dirs.remove("packs")
+                for fn in files:
+                    if fn.startswith("."):
+                        continue
+                    for suffix in CODECS.values():
+                        if fn.endswith(f".json{suffix}"):
+                            break
+                    else:
+                        continue
+                    filename = Path(root).joinpath(fn[: len(fn) - len(suffix)])
+                    if (
+                        suffix != self.suffixes[0]
+                        and filename.with_name(
+                            filename.name + self.suffixes[0]
+                        ).exists()
+                    ):
+                        # the same program, stored by the current codec too
+                        continue
+                    program = self.readJson(filename, dtype="program")
+                    if program is not None:
+                        yield program
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def rebuildSearchIndex(self):
+        """Copy every cached schedule and program into the search database.
+
+        Only what is written while searchdb is set is mirrored into it, so
+        listings cached before the search index was turned on are added by
+        this.
+
+        Returns:
+            tuple: the number of stations and of programs copied
+        """
+        try:
+            if self.searchdb is None:
+                raise Exception("The search index is not enabled (searchindex)")
+            nstations = nprograms = 0
+            with os.scandir(self.cachedict["chandir"]) as it:
+                stationids = [x.name for x in it if x.is_dir()]
+            for sid in sorted(stationids):
+                chansched = self.readChannelScheduleFromCache(sid)
+                if len(chansched) > 0:
+                    self.searchdb.writeChannelScheduleToCache(sid, chansched)
+                    nstations += 1
+            for program in self.iterPrograms():
+                self.searchdb.writeProgramToCache(program)
+                nprograms += 1
+            self.searchdb.flush()
+            log.info(
+                f"search index rebuilt from {nstations} stations "
+                f"and {nprograms} programs"
+            )
+            return (nstations, nprograms)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+
+class SDPackStore:
+    """Append only pack file store for program data.
+
+    Programs are appended to pack-NNNNN.dat files and their position is
+    recorded in an append only index of fixed width records, which is read
+    into memory when the store is opened. Reads go through an mmap of the
+    pack, so fetching a program is a dictionary lookup and a single slice.
+    """
+
+    def __init__(
+        self, sdc, packdir, maxpacksize=64 * 1024 * 1024, indexname="index.bin"
+    ):
+        """Open the pack store.
+
+        Args:
+            sdc: SDCache: the cache, supplies the codec and fsync settings
+            packdir: Path: the directory holding the packs and their index
+            maxpacksize: int: start a new pack when the current one is this big
+            indexname: str: file name of the index in packdir
+        """
+        try:
+            self.sdc = sdc
+            self.packdir = packdir
+            self.maxpacksize = maxpacksize
+            self.lock = threading.RLock()
+            self.indexfn = packdir.joinpath(indexname)
+            # key: (programid, codec number, pack number, offset, length)
+            self.index = {}
+            self.maps = {}
+            self.packno = 0
+            self.packfile = None
+            self.indexfile = None
+            self.dirty = False
+            self.readIndex()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def packFileName(self, packno):
+        return self.packdir.joinpath(f"pack-{packno:05d}.dat")
+
+    def readIndex(self):
+        """Load the index, dropping records for data that never reached a pack.
+
+        The index is cut back to the last record whose data is in its pack,
+        and a partly written final record is cut off. Otherwise, once later
+        appends had grown the pack past it, a dropped record would point at
+        another program's data, and appends after a partial record would be
+        out of step with the record size.
+        """
+        try:
+            self.index = {}
+            self.packno = 0
+            if not self.indexfn.exists():
+                return
+            packsizes = {}
+            with open(self.indexfn, "rb") as ifn:
+                data = ifn.read()
+            usable = len(data) - len(data) % PACKINDEX.size
+            valid = 0
+            for key, pid, codec, packno, offset, length in PACKINDEX.iter_unpack(
+                data[:usable]
+            ):
+                if packno not in packsizes:
+                    packfn = self.packFileName(packno)
+                    packsizes[packno] = packfn.stat().st_size if packfn.exists() else 0
+                if offset + length > packsizes[packno]:
+                    break
+                pid = pid.rstrip(b"\0").decode()
+                self.index[key] = (pid, codec, packno, offset, length)
+                self.packno = max(self.packno, packno)
+                valid += PACKINDEX.size
+            if valid < len(data):
+                log.warning(
+                    f"pack store index: dropping {len(data) - valid} bytes of "
+                    "records for data that never reached a pack"
+                )
+                os.truncate(self.indexfn, valid)
+            log.debug(f"pack store index has {len(self.index)} programs")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def indexKey(self, md5):
+        """Returns the 16 byte binary key for a program md5."""
+        try:
+            return bytes.fromhex(self.sdc.programKey(md5))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def have(self, md5):
+        try:
+            return self.indexKey(md5) in self.index
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def openForAppend(self):
+        """Open the current pack and the index for appending."""
+        try:
+            if self.packfile is None:
+                packfn = self.packFileName(self.packno)
+                if packfn.exists() and packfn.stat().st_size >= self.maxpacksize:
+                    self.packno += 1
+                    packfn = self.packFileName(self.packno)
+                self.packfile = open(packfn, "ab")
+                self.indexfile = open(self.indexfn, "ab")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def append(self, key, pid, codec, data):
+        """Append encoded data to the current pack and record it in the index."""
+        try:
+            with self.lock:
+                self.openForAppend()
+                offset = self.packfile.tell()
+                if offset > 0 and offset + len(data) > self.maxpacksize:
+                    self.closeFiles()
+                    self.packno += 1
+                    self.openForAppend()
+                    offset = self.packfile.tell()
+                start = time.perf_counter() if self.sdc.stats is not None else 0
+                self.packfile.write(data)
+                # the data must reach the pack before the index record that
+                # points at it, readIndex drops records beyond the pack end
+                self.packfile.flush()
+                record = PACKINDEX.pack(
+                    key, pid.encode()[:16], codec, self.packno, offset, len(data)
+                )
+                self.indexfile.write(record)
+                self.indexfile.flush()
+                self.index[key] = (pid, codec, self.packno, offset, len(data))
+                if self.sdc.stats is not None:
+                    seconds = time.perf_counter() - start
+                    packfn = self.packFileName(self.packno)
+                    self.sdc.stats.record(
+                        "write", "program", seconds, len(data), packfn
+                    )
+                self.dirty = True
+                if self.sdc.fsync == "always":
+                    self.flush()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def write(self, program):
+        try:
+            key = self.indexKey(program["md5"])
+            if key in self.index:
+                return
+            codec = list(CODECS).index(self.sdc.codec)
+            data = json.dumps(program, separators=(",", ":")).encode()
+            data = self.sdc.encode(data, self.sdc.codec)
+            self.append(key, program["programID"], codec, data)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def getMap(self, packno, end):
+        """Returns an mmap of the pack that covers at least end bytes."""
+        try:
+            with self.lock:
+                xmap = self.maps.get(packno)
+                if xmap is None or len(xmap) < end:
+                    if xmap is not None:
+                        xmap.close()
+                    with open(self.packFileName(packno), "rb") as pfn:
+                        xmap = mmap.mmap(pfn.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.maps[packno] = xmap
+                return xmap
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def readData(self, entry):
+        """Returns the decoded bytes of the program at this index entry."""
+        try:
+            pid, codec, packno, offset, length = entry
+            start = time.perf_counter() if self.sdc.stats is not None else 0
+            xmap = self.getMap(packno, offset + length)
+            data = xmap[offset : offset + length]
+            if self.sdc.stats is not None:
+                seconds = time.perf_counter() - start
+                packfn = self.packFileName(packno)
+                self.sdc.stats.record("read", "program", seconds, length, packfn)
+            return self.sdc.decode(data, list(CODECS.values())[codec])
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def iterPrograms(self):
+        """Yield every program in the store."""
+        try:
+            for entry in list(self.index.values()):
+                yield json.loads(self.readData(entry))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def read(self, md5):
+        """Returns the program with this md5 or None."""
+        try:
+            entry = self.index.get(self.indexKey(md5))
+            if entry is None:
+                return None
+            return json.loads(self.readData(entry))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def flush(self):
+        """fsync the current pack and index if they have been written to."""
+        try:
+            with self.lock:
+                if self.dirty and self.packfile is not None:
+                    start = time.perf_counter() if self.sdc.stats is not None else 0
+                    os.fsync(self.packfile.fileno())
+                    os.fsync(self.indexfile.fileno())
+                    self.dirty = False
+                    if self.sdc.stats is not None:
+                        seconds = time.perf_counter() - start
+                        packfn = self.packFileName(self.packno)
+                        self.sdc.stats.record("fsync", "program", seconds, name=packfn)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def closeFiles(self):
+        try:
+            with self.lock:
+                if self.packfile is not None:
+                    self.flush()
+                    self.packfile.close()
+                    self.indexfile.close()
+                    self.packfile = None
+                    self.indexfile = None
+                for packno in list(self.maps):
+                    self.maps.pop(packno).close()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def compact(self):
+        """Rewrite the packs keeping only the newest version of each program.
+
+        The kept programs are re-encoded with the cache's current codec into
+        new packs with a new index, which replaces the old index in a single
+        rename before the old packs are removed.
+
+        Returns:
+            int: the number of programs kept
+        """
+        try:
+            with self.lock:
+                self.closeFiles()
+                # the newest md5 for each programID, in index (write) order
+                latest = {}
+                for key in self.index:
+                    latest[self.index[key][0]] = key
+                keep = set(latest.values())
+                oldindex = self.index
+                oldpacks = sorted(self.packdir.glob("pack-*.dat"))
+                # an index left by a compaction that crashed points into
+                # packs that are about to be removed, it is started afresh
+                compactfn = self.packdir.joinpath(".index.compact")
+                if compactfn.exists():
+                    log.warning(f"removing {compactfn} left by an earlier compaction")
+                    compactfn.unlink()
+                newstore = SDPackStore(
+                    self.sdc, self.packdir, self.maxpacksize, compactfn.name
+                )
+                # the new packs must not be appended to any of the old ones,
+                # which may include packs from the crashed compaction
+                newstore.packno = 1 + max(
+                    [self.packno] + [int(x.stem.split("-")[1]) for x in oldpacks]
+                )
+                newcodec = list(CODECS).index(self.sdc.codec)
+                for key in oldindex:
+                    if key in keep:
+                        data = self.sdc.encode(
+                            self.readData(oldindex[key]), self.sdc.codec
+                        )
+                        newstore.append(key, oldindex[key][0], newcodec, data)
+                newstore.closeFiles()
+                self.closeFiles()
+                os.replace(newstore.indexfn, self.indexfn)
+                self.sdc.syncDir(self.packdir)
+                for packfn in oldpacks:
+                    packfn.unlink()
+                self.readIndex()
+                log.info(
+                    f"compacted program packs from {len(oldindex)} to "
+                    f"{len(self.index)} programs"
+                )
+                return len(self.index)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
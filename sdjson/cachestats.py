@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""I/O statistics for the ccasdtv cache.
+
+When enabled SDCache times each file write, read, directory creation and
+fsync and records it here with the bytes moved and the type of data
+(channel, schedule, lineup, program or other). The slowest operations are
+kept so that a slow disk or a slow directory stands out. When disabled
+the cache holds None in place of an SDCacheStats and pays only a test of
+that for each operation.
+"""
+
+import heapq
+import os
+import sys
+import threading
+
+import ccalogging
+
+log = ccalogging.log
+
+
+def statsEnabled(appname="ccasdtv"):
+    """Returns True if the <APPNAME>_CACHESTATS environment variable is set."""
+    value = os.environ.get(f"{appname.upper()}_CACHESTATS", "")
+    return value.lower() not in ("", "0", "false", "no", "off")
+
+
+class SDCacheStats:
+    def __init__(self, topn=10):
+        """Initialise the statistics.
+
+        Args:
+            topn: int: the number of slowest operations to keep, default: 10
+        """
+        try:
+            self.topn = topn
+            self.lock = threading.Lock()
+            # (op, dtype): [count, seconds, max seconds, bytes]
+            self.ops = {}
+            # min heap of (seconds, op, dtype, name), the slowest topn
+            self.slowest = []
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def record(self, op, dtype, seconds, nbytes=0, name=""):
+        """Record one operation.
+
+        Args:
+            op: str: "write", "read", "mkdir" or "fsync"
+            dtype: str: the type of data, None for other
+            seconds: float: time the operation took
+            nbytes: int: bytes written or read
+            name: the file or directory, kept if the operation is one of the slowest
+        """
+        with self.lock:
+            key = (op, dtype or "other")
+            xop = self.ops.get(key)
+            if xop is None:
+                xop = self.ops[key] = [0, 0.0, 0.0, 0]
+            xop[0] += 1
+            xop[1] += seconds
+            xop[2] = max(xop[2], seconds)
+            xop[3] += nbytes
+            if len(self.slowest) < self.topn:
+                heapq.heappush(self.slowest, (seconds, op, key[1], str(name)))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, op, key[1], str(name)))
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+            self.slowest = []
+
+    def summary(self):
+        """Returns the statistics table and the slowest operations as lines."""
+        try:
+            with self.lock:
+                ops = {k: list(v) for k, v in self.ops.items()}
+                slowest = sorted(self.slowest, reverse=True)
+            lines = [
+                f"""{"cache op":<8s} {"type":<9s} {"count":>7s} {"total s":>8s} """
+                f"""{"mean ms":>8s} {"max ms":>8s} {"KB":>9s}"""
+            ]
+            for (op, dtype), (count, seconds, maxseconds, nbytes) in sorted(
+                ops.items()
+            ):
+                lines.append(
+                    f"{op:<8s} {dtype:<9s} {count:>7d} {seconds:>8.2f} "
+                    f"{1000 * seconds / count:>8.3f} {1000 * maxseconds:>8.2f} "
+                    f"{nbytes // 1024:>9d}"
+                )
+            if len(slowest) > 0:
+                lines.append(f"slowest {len(slowest)} cache operations:")
+                for seconds, op, dtype, name in slowest:
+                    lines.append(f"{1000 * seconds:>8.2f} ms {op} {dtype} {name}")
+            return lines
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def logSummary(self):
+        if len(self.ops) > 0:
+            for line in self.summary():
+                log.info(line)
@@ -25,7 +25,7 @@ import ccalogging
 
 from sdjson.cache import SDCache
 import sdjson.config as CFG
-from sdjson.lineup import parseLineupData
+from sdjson.lineup import refreshLineup
 from sdjson.sdapi import SDApi
 from sdjson.sduser import confUser
 from sdjson.sduser import testCreds
@@ -40,19 +40,17 @@ ccalogging.setDebug()
 log = ccalogging.log
 
 
-def checkLineup(sd, sdc, cfglineup):
-    """Checks that the lineup is not out of date."""
+def checkLineup(sd, sdc, cfglineup, removed):
+    """Checks that the lineup is not out of date.
+
+    The stations dropped from the lineup are added to the removed set.
+    """
     try:
         for slu in sd.lineups:
             if cfglineup["lineupid"] == slu["lineupID"]:
-                lum = sd.getTimeStamp(slu["modified"])
-                if int(cfglineup["modified"]) < lum:
-                    log.info(
-                        f"""Lineup {slu["lineupID"]} is out of date, retrieving fresh data."""
-                    )
-                    ldata = parseLineupData(sd.getLineup(slu["lineupID"]))
-                    sdc.writeLineupData(slu["lineupID"], ldata)
-                    cfglineup["modified"] = lum
+                cfglineup, diff = refreshLineup(sd, sdc, slu, cfglineup)
+                if diff is not None:
+                    removed.update(diff["removed"])
         return cfglineup
     except Exception as e:
         exci = sys.exc_info()[2]
@@ -86,10 +84,19 @@ def configure():
         # check that the lineup is not out of date
         if "lineups" in cfg and sd.lineups is not None:
             xlineups = []
+            removed = set()
             for lineup in cfg["lineups"]:
-                xlineups.append(checkLineup(sd, sdc, lineup))
+                xlineups.append(checkLineup(sd, sdc, lineup, removed))
                 cfg["amdirty"] = True
             cfg["lineups"] = xlineups
+            # stations dropped from every lineup are removed from the cache
+            stations = set()
+            for slu in sd.lineups:
+                ldata = sdc.readLineupData(slu["lineupID"])
+                if ldata is not None:
+                    stations.update(ldata["channelsbyid"])
+            for stationid in removed - stations:
+                sdc.removeChannelFromCache(stationid)
         CFG.writeConfig(cfg, **ckwargs)
     except Exception as e:
         exci = sys.exc_info()[2]
@@ -1,41 +1,44 @@
 #!/usr/bin/env python3
-"""CLI for ccasdtv."""
+"""CLI for ccasdtv.
+
+The frontend runs the CLI many times a minute, so only click is imported
+up front. Each command imports the modules it needs (requests, yaml,
+sqlite) when it runs, and the log file is only opened once a command has
+been chosen, so --help does not touch it.
+"""
 
-import hashlib
 from pathlib import Path
 import sys
 
 import ccalogging
 import click
 
-from sdjson.cache import SDCache
-import sdjson.config as CFG
-from sdjson.lineup import parseLineupData
-from sdjson.sdapi import SDApi
 from sdjson import __version__
 
 appname = "ccasdtv"
 home = Path.home()
 
-logfilename = home.joinpath(f".{appname}.log")
-ccalogging.setLogFile(logfilename)
-ccalogging.setDebug()
 log = ccalogging.log
 
-# blank line to mark the beginning of a run in the log file
-log.info("")
-log.info(f"{appname} {__version__} CLI Starting")
 
-# TODO use the new cache class
+def setupLogging():
+    logfilename = home.joinpath(f".{appname}.log")
+    ccalogging.setLogFile(logfilename)
+    ccalogging.setDebug()
+    # blank line to mark the beginning of a run in the log file
+    log.info("")
+    log.info(f"{appname} {__version__} CLI Starting")
 
 
 @click.group()
 def cli():
-    pass
+    setupLogging()
 
 
 def askCredentials():
     try:
+        import hashlib
+
         uname = input("Schedules Direct username: ")
         password = input("SD Password: ")
         pword = hashlib.sha1(password.encode()).hexdigest()
@@ -53,6 +56,8 @@ def askCredentials():
 
 def testCreds(uname, pword):
     try:
+        from sdjson.sdapi import SDApi
+
         sd = SDApi(uname, pword)
         sd.apiOnline()
         if not sd.online:
@@ -74,6 +79,8 @@ def testCreds(uname, pword):
 @click.command()
 def doConfigure():
     try:
+        import sdjson.config as CFG
+
         kwargs = {"appname": appname}
         cfg = CFG.readConfig(**kwargs)
         cfg["amdirty"] = False
@@ -92,19 +99,35 @@ def doConfigure():
 
 def setupSD(cfg):
     try:
+        import sdjson.config as CFG
+        from sdjson.sdapi import SDApi
+
         kwargs = {"appname": appname}
         # keymap = {"password": "sha1password"}
-        keys = ["username", "password", "url", "token", "tokenexpires"]
+        keys = [
+            "username",
+            "password",
+            "url",
+            "token",
+            "tokenexpires",
+            "poolsize",
+            "retries",
+            "backoff",
+            "schedulebatch",
+            "programbatch",
+            "concurrency",
+            "stream",
+            "timeout",
+        ]
         for key in keys:
             # xkey = keymap[key] if key in keymap else key
             if key in cfg:
-                kwargs[xkey] = cfg[key]
+                kwargs[key] = cfg[key]
         sd = SDApi(**kwargs)
-        sd.apiOnline()
-        if cfg["token"] != sd.token:
-            cfg["token"] = sd.token
-            cfg["tokenexpires"] = sd.tokenexpires
-            cfg["amdirty"] = True
+        status = CFG.readStatusCache(appname=appname)
+        if not sd.loadStatusCache(status, cfg.get("statusttl", 3600)):
+            sd.apiOnline()
+            saveStatus(sd, status)
         return sd
     except Exception as e:
         exci = sys.exc_info()[2]
@@ -116,25 +139,14 @@ def setupSD(cfg):
         raise
 
 
-def getSchedules():
+def saveStatus(sd, status=None):
+    """Write the token and API status to the status cache if they changed."""
     try:
-        ckwargs = {"appname": appname}
-        cfg = CFG.readConfig(**ckwargs)
-        cfg["amdirty"] = False
-        sd = setupSD(cfg)
-        if cachedict is None:
-            setupCache(appname=appname)
-        if sd.lineups is not None:
-            for lineup in sd.lineups:
-                print(lineup)
-                break
-                ljson = sd.getLineup(lineup["lineupID"])
-                channeldict = parseLineupData(ljson)
-                byid = channeldict["channelsbyid"]
-                for chan in byid:
-                    writeChannelToCache(byid[chan])
+        import sdjson.config as CFG
 
-        CFG.writeConfig(cfg, **ckwargs)
+        xstatus = sd.statusCache()
+        if xstatus != status:
+            CFG.writeStatusCache(xstatus, appname=appname)
     except Exception as e:
         exci = sys.exc_info()[2]
         lineno = exci.tb_lineno
@@ -142,20 +154,187 @@ def getSchedules():
         ename = type(e).__name__
         msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
         log.error(msg)
-        print("An Error occurred, see log file for details")
-        sys.exit(1)
+        raise
 
 
-@click.command()
+def saveMetrics(sd, cfg):
+    """Write the SD request metrics to the metricsfile in the config, if any."""
+    try:
+        if cfg.get("metricsfile") is not None:
+            sd.metrics.write(Path(cfg["metricsfile"]).expanduser())
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def setupCache(cfg):
+    try:
+        from sdjson.cache import SDCache
+        from sdjson.db import SDDb
+
+        searchdb = None
+        if cfg.get("searchindex", False):
+            searchdb = SDDb(appname=appname, search=True)
+        sdc = SDCache(
+            appname=appname,
+            fsync=cfg.get("cachefsync", "batch"),
+            codec=cfg.get("cachecodec", "none"),
+            programstore=cfg.get("programstore", "tree"),
+            searchdb=searchdb,
+            cachestats=cfg.get("cachestats", False),
+            journal=cfg.get("cachejournal", False),
+        )
+        sdc.setupCache()
+        return sdc
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def refreshLineups(sd, sdc, cfg):
+    """Refreshes the cached lineups that have changed since the last run.
+
+    Stations dropped from every lineup, including the stations of lineups
+    that have been removed from the account, are removed from the cache.
+    Without a status from SD (sd.lineups is None) the configured lineups
+    are left as they are.
+
+    Returns:
+        list: the station ids of all the lineups
+    """
+    try:
+        from sdjson.lineup import refreshLineup
+
+        cfglineups = {x["lineupid"]: x for x in cfg.get("lineups", [])}
+        xlineups = []
+        stations = set()
+        removed = set()
+        if sd.lineups is None:
+            # without a status from SD nothing is known to have changed, the
+            # configured lineups and their cached stations are kept
+            for lineupid in cfglineups:
+                ldata = sdc.readLineupData(lineupid)
+                if ldata is not None:
+                    stations.update(ldata["channelsbyid"])
+            return sorted(stations)
+        for slu in sd.lineups:
+            cfglineup, diff = refreshLineup(
+                sd, sdc, slu, cfglineups.get(slu["lineupID"])
+            )
+            xlineups.append(cfglineup)
+            if diff is not None:
+                removed.update(diff["removed"])
+                cfg["amdirty"] = True
+            ldata = sdc.readLineupData(slu["lineupID"])
+            if ldata is not None:
+                stations.update(ldata["channelsbyid"])
+        current = [x["lineupID"] for x in sd.lineups]
+        for lineupid in [x for x in cfglineups if x not in current]:
+            log.info(f"Lineup {lineupid} is no longer in the account")
+            ldata = sdc.readLineupData(lineupid)
+            if ldata is not None:
+                removed.update(ldata["channelsbyid"])
+            sdc.removeLineupData(lineupid)
+        for stationid in removed - stations:
+            sdc.removeChannelFromCache(stationid)
+        if len(xlineups) != len(cfglineups):
+            cfg["amdirty"] = True
+        cfg["lineups"] = xlineups
+        return sorted(stations)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def setupPlanner(sd, sdc, cfg):
+    """Returns the SDPlanner for the request budget in the config."""
+    try:
+        from sdjson.planner import SDPlanner
+
+        return SDPlanner(
+            sd,
+            sdc,
+            budget=cfg.get("dailybudget", 1000),
+            interval=cfg.get("refreshinterval", 3600),
+            favourites=cfg.get("favourites", []),
+            neardays=cfg.get("neardays", 3),
+        )
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def refreshAll(sd, sdc, cfg, planner=None):
+    """Brings the lineups, schedules and programs in the cache up to date."""
+    try:
+        from sdjson.schedule import refreshPrograms
+        from sdjson.schedule import refreshSchedules
+
+        if planner is None:
+            planner = setupPlanner(sd, sdc, cfg)
+        if sdc.journal is not None:
+            sdc.journal.begin()
+        try:
+            stations = refreshLineups(sd, sdc, cfg)
+            progs = refreshSchedules(sd, sdc, stations, planner=planner)
+            received = refreshPrograms(sd, sdc, progs)
+            planner.record(len(received))
+            sdc.flush()
+        finally:
+            # once per run, and whatever was changed before a failure too
+            if sdc.journal is not None:
+                sdc.journal.save()
+        sdc.logStats()
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+@cli.command()
 def run():
     """Retrieves listings from Schedules Direct"""
     try:
+        import sdjson.config as CFG
+
         ckwargs = {"appname": appname}
         cfg = CFG.readConfig(**ckwargs)
         if "username" not in cfg:
             msg = f"You will need to configure {appname} before using it."
             print(msg)
             sys.exit(1)
+        cfg["amdirty"] = False
+        sd = setupSD(cfg)
+        sdc = setupCache(cfg)
+        refreshAll(sd, sdc, cfg)
+        sd.close()
+        saveMetrics(sd, cfg)
+        saveStatus(sd, CFG.readStatusCache(appname=appname))
+        CFG.writeConfig(cfg, **ckwargs)
     except Exception as e:
         exci = sys.exc_info()[2]
         lineno = exci.tb_lineno
@@ -171,6 +350,8 @@ def run():
 def configure():
     f"""Sets up the configuration for the {appname} application."""
     try:
+        import sdjson.config as CFG
+
         cfg = {"amdirty": True}
         ckwargs = {"appname": appname}
         cfg["username"], cfg["password"] = askCredentials()
@@ -184,3 +365,302 @@ def configure():
         msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
         print(msg)
         raise
+
+
+@cli.command()
+@click.option(
+    "--codec",
+    type=click.Choice(["none", "gzip", "zstd"]),
+    default=None,
+    help="codec to rewrite the cache with, default: cachecodec from the config",
+)
+def recompress(codec):
+    """Rewrites the existing cache with the configured codec."""
+    try:
+        import sdjson.config as CFG
+
+        ckwargs = {"appname": appname}
+        cfg = CFG.readConfig(**ckwargs)
+        if codec is None:
+            codec = cfg.get("cachecodec", "none")
+        sdc = setupCache(cfg)
+        count = sdc.recompressCache(codec)
+        print(f"{count} cache files rewritten with {codec}")
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print("An Error occurred, see log file for details")
+        sys.exit(1)
+
+
+@cli.command()
+def reindex():
+    """Adds the listings already cached to the program search index."""
+    try:
+        import sdjson.config as CFG
+
+        ckwargs = {"appname": appname}
+        cfg = CFG.readConfig(**ckwargs)
+        if not cfg.get("searchindex", False):
+            print("Set searchindex: true in the config to use the search index.")
+            sys.exit(1)
+        sdc = setupCache(cfg)
+        nstations, nprograms = sdc.rebuildSearchIndex()
+        sdc.searchdb.close()
+        print(f"search index rebuilt from {nstations} stations, {nprograms} programs")
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print("An Error occurred, see log file for details")
+        sys.exit(1)
+
+
+@cli.command()
+def plan():
+    """Shows the calls the coming runs will make, without fetching listings."""
+    try:
+        import sdjson.config as CFG
+        from sdjson.schedule import changedScheduleDays
+
+        ckwargs = {"appname": appname}
+        cfg = CFG.readConfig(**ckwargs)
+        if "username" not in cfg:
+            msg = f"You will need to configure {appname} before using it."
+            print(msg)
+            sys.exit(1)
+        sd = setupSD(cfg)
+        sdc = setupCache(cfg)
+        planner = setupPlanner(sd, sdc, cfg)
+        stations = set()
+        for slu in sd.lineups or []:
+            ldata = sdc.readLineupData(slu["lineupID"])
+            if ldata is not None:
+                stations.update(ldata["channelsbyid"])
+        md5s = sd.getScheduleMd5s(sorted(stations))
+        changed = changedScheduleDays(md5s, sdc.readScheduleMd5Index())
+        mdcalls = planner.batchCount(len(stations), sd.schedulebatch)
+        plans = planner.projection(changed, mdcalls=mdcalls)
+        planner.record()
+        sd.close()
+        saveStatus(sd, CFG.readStatusCache(appname=appname))
+        ledger = planner.readLedger()
+        print(
+            f"""{ledger["used"]} of {planner.budget} requests used on {ledger["day"]}"""
+        )
+        ndays = sum([len(x) for x in changed.values()])
+        print(f"{ndays} station days on {len(changed)} stations have changed")
+        for i, xplan in enumerate(plans):
+            xdays = sum([len(x) for x in xplan["now"].values()])
+            xcalls = xplan["calls"]
+            print(
+                f"""run {i + 1}: {xdays} station days, {mdcalls} md5 + """
+                f"""{xcalls["schedules"]} schedules + ~{xcalls["programs"]} programs calls, """
+                f"""share {xplan["share"]} of {xplan["remaining"]} remaining"""
+            )
+        if len(plans) > 0 and len(plans[-1]["deferred"]) > 0:
+            xdays = sum([len(x) for x in plans[-1]["deferred"].values()])
+            print(f"{xdays} station days deferred until tomorrow")
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print("An Error occurred, see log file for details")
+        sys.exit(1)
+
+
+@cli.command()
+@click.option(
+    "--norefresh",
+    is_flag=True,
+    help="serve the cache as it is, do not refresh until the first interval",
+)
+def serve(norefresh):
+    """Runs as a daemon, refreshing the listings and answering queries."""
+    try:
+        import signal
+        import time
+
+        import sdjson.config as CFG
+        from sdjson.daemon import SDDaemon
+        from sdjson.daemon import socketFileName
+
+        ckwargs = {"appname": appname}
+        cfg = CFG.readConfig(**ckwargs)
+        if "username" not in cfg:
+            msg = f"You will need to configure {appname} before using it."
+            print(msg)
+            sys.exit(1)
+        sd = setupSD(cfg)
+        sdc = setupCache(cfg)
+        statusttl = cfg.get("statusttl", 3600)
+        planner = setupPlanner(sd, sdc, cfg)
+
+        def refresh(sd, sdc):
+            if sd.statustime + statusttl < time.time():
+                sd.apiOnline()
+                saveStatus(sd)
+            cfg["amdirty"] = False
+            refreshAll(sd, sdc, cfg, planner)
+            # the daemon's metrics are cumulative, each refresh adds to them
+            saveMetrics(sd, cfg)
+            saveStatus(sd, CFG.readStatusCache(appname=appname))
+            CFG.writeConfig(cfg, **ckwargs)
+
+        daemon = SDDaemon(
+            sd,
+            sdc,
+            refresh,
+            cfg.get("socket", socketFileName(appname)),
+            interval=cfg.get("refreshinterval", 3600),
+            db=sdc.searchdb,
+        )
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        daemon.serve(refreshfirst=not norefresh)
+        sd.close()
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print("An Error occurred, see log file for details")
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("cmd")
+@click.argument("args", nargs=-1)
+def query(cmd, args):
+    """Sends a query to the running daemon and prints the json result.
+
+    ARGS are key=value pairs, values are parsed as json where possible,
+    e.g. ccasdtv query airings stations='["10001"]'
+    """
+    try:
+        import json
+
+        import sdjson.config as CFG
+        from sdjson.daemon import query as daemonQuery
+        from sdjson.daemon import socketFileName
+
+        cfg = CFG.readConfig(appname=appname)
+        kwargs = {}
+        for arg in args:
+            key, _, val = arg.partition("=")
+            try:
+                kwargs[key] = json.loads(val)
+            except ValueError:
+                kwargs[key] = val
+        result = daemonQuery(cfg.get("socket", socketFileName(appname)), cmd, **kwargs)
+        print(json.dumps(result, indent=2))
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print(f"{e}")
+        sys.exit(1)
+
+
+@cli.command("export-xmltv")
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    help="file to write to, - for stdout, default: stdout unless --fragments",
+)
+@click.option(
+    "--start",
+    default=None,
+    help="UTC date (YYYY-MM-DD) to start the guide, default: now",
+)
+@click.option("--days", default=14, help="number of days to export, default: 14")
+@click.option(
+    "--station",
+    "stations",
+    multiple=True,
+    help="station id to export, may be repeated, default: all",
+)
+@click.option(
+    "--fragments",
+    default=None,
+    help="directory of per-station fragments to update, only changed stations"
+    " are regenerated",
+)
+def exportXmltv(output, start, days, stations, fragments):
+    """Writes the cached listings as an XMLTV guide."""
+    try:
+        import calendar
+        import os
+        from pathlib import Path
+        import time
+
+        import sdjson.config as CFG
+        from sdjson.xmltv import concatFragments
+        from sdjson.xmltv import writeFragments
+        from sdjson.xmltv import writeXmltv
+
+        cfg = CFG.readConfig(appname=appname)
+        lineupids = [x["lineupid"] for x in cfg.get("lineups", [])]
+        if len(lineupids) == 0:
+            print(f"No lineups have been fetched yet, run {appname} run first.")
+            sys.exit(1)
+        if start is not None:
+            xstart = calendar.timegm(time.strptime(start, "%Y-%m-%d"))
+        elif fragments is not None:
+            # a window that moves every run would regenerate every fragment
+            xstart = int(time.time()) // 86400 * 86400
+        else:
+            xstart = int(time.time())
+        xend = xstart + days * 86400
+        sdc = setupCache(cfg)
+        xstations = set(stations) if len(stations) > 0 else None
+        if fragments is not None:
+            fragdir = Path(fragments).expanduser()
+            res = writeFragments(sdc, lineupids, fragdir, xstart, xend, xstations)
+            if output is None:
+                log.info(f"""{res["programmes"]} programmes exported to {fragdir}""")
+                sdc.logStats()
+                return
+
+        def writeGuide(ofn):
+            if fragments is not None:
+                concatFragments(fragdir, ofn)
+                return res["programmes"]
+            return writeXmltv(ofn, sdc, lineupids, xstart, xend, xstations)
+
+        if output is None or output == "-":
+            output = "stdout"
+            count = writeGuide(sys.stdout)
+        else:
+            # write to a temporary file so the PVR never reads a partial guide
+            tmpfn = f"{output}.{os.getpid()}.tmp"
+            with open(tmpfn, "w", encoding="utf-8") as ofn:
+                count = writeGuide(ofn)
+            os.replace(tmpfn, output)
+        log.info(f"{count} programmes exported to {output}")
+        sdc.logStats()
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        print("An Error occurred, see log file for details", file=sys.stderr)
+        sys.exit(1)
@@ -17,9 +17,10 @@
 #     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
 """Configuration routines for the ccasdtv application."""
 
+import json
+import os
 from pathlib import Path
 import sys
-import yaml
 
 import ccalogging
 
@@ -33,6 +34,8 @@ def writeConfig(config, appname="ccasdtv"):
             amdirty = config["amdirty"]
             del config["amdirty"]
         if amdirty:
+            import yaml
+
             log.info("writing config")
             yamlfn = f"{appname}.yaml"
             home = Path.home()
@@ -58,6 +61,8 @@ def readConfig(appname="ccasdtv"):
         configfn = home.joinpath(".config", yamlfn)
         log.debug(f"config file: {configfn}")
         if configfn.exists():
+            import yaml
+
             log.debug(f"reading config file {configfn}")
             with open(str(configfn), "r") as cfn:
                 config = yaml.safe_load(cfn)
@@ -71,3 +76,57 @@ def readConfig(appname="ccasdtv"):
         log.error(msg)
         # print(msg)
         raise
+
+
+def statusCacheFile(appname="ccasdtv"):
+    home = Path.home()
+    return home.joinpath(".cache", appname, "status.json")
+
+
+def readStatusCache(appname="ccasdtv"):
+    """Returns the cached token and API status, or an empty dict.
+
+    The status cache is kept apart from the yaml config so that it can be
+    rewritten on every token change without loading or dumping the config.
+    """
+    try:
+        statusfn = statusCacheFile(appname)
+        if statusfn.exists():
+            log.debug(f"reading status cache {statusfn}")
+            with open(str(statusfn), "r") as sfn:
+                return json.load(sfn)
+        return {}
+    except ValueError as e:
+        log.warning(f"ignoring unreadable status cache: {e}")
+        return {}
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        # print(msg)
+        log.error(msg)
+        raise
+
+
+def writeStatusCache(status, appname="ccasdtv"):
+    """Atomically replace the status cache, readable by the user only."""
+    try:
+        statusfn = statusCacheFile(appname)
+        statusfn.parent.mkdir(parents=True, exist_ok=True)
+        tmpfn = statusfn.with_name(f".{statusfn.name}.{os.getpid()}.tmp")
+        fd = os.open(str(tmpfn), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as sfn:
+            json.dump(status, sfn)
+        os.replace(tmpfn, statusfn)
+        log.debug(f"status cache written to {statusfn}")
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        # print(msg)
+        log.error(msg)
+        raise
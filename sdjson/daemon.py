@@ -0,0 +1,286 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Daemon mode for ccasdtv.
+
+The daemon keeps the SDApi session, token, lineups and cache indexes in
+memory, refreshes the listings itself every interval and answers queries
+from local clients over a Unix socket.
+
+The protocol is one json object per line each way. A request names a
+command in "cmd" and passes its arguments as the other keys, the reply has
+"ok" and either "result" or "error".
+"""
+
+import json
+import os
+from pathlib import Path
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import ccalogging
+
+log = ccalogging.log
+
+
+def socketFileName(appname="ccasdtv"):
+    home = Path.home()
+    return home.joinpath(".cache", appname, f"{appname}.sock")
+
+
+class SDRequestHandler(socketserver.StreamRequestHandler):
+    """Answers each json line request on the connection in turn."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                cmd = request.pop("cmd")
+                reply = {"ok": True, "result": self.server.daemon.command(cmd, request)}
+            except Exception as e:
+                log.error(f"daemon request {line[:100]} failed: {e}")
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class SDServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class SDDaemon:
+    """Holds the warm SDApi and cache and serves queries against them."""
+
+    def __init__(self, sd, sdc, refresh, socketpath, interval=3600, db=None):
+        """Initialise the daemon.
+
+        Args:
+            sd: SDApi: the online SDApi object
+            sdc: SDCache: the set up cache
+            refresh: function: refresh(sd, sdc) brings the cache up to date
+            socketpath: Path: the Unix socket to listen on
+            interval: int: seconds between refreshes, default: 3600
+            db: SDDb: optional database for program searches
+        """
+        try:
+            self.sd = sd
+            self.sdc = sdc
+            self.refresh = refresh
+            self.socketpath = Path(socketpath)
+            self.interval = interval
+            self.db = db
+            self.server = None
+            self.refreshlock = threading.Lock()
+            self.wake = threading.Event()
+            self.stopping = False
+            self.lastrefresh = 0
+            self.lasterror = None
+            self.started = time.time()
+            self.commands = {
+                "ping": self.cmdPing,
+                "status": self.cmdStatus,
+                "refresh": self.cmdRefresh,
+                "lineups": self.cmdLineups,
+                "airings": self.cmdAirings,
+                "nownext": self.cmdNowNext,
+                "program": self.cmdProgram,
+                "search": self.cmdSearch,
+            }
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def command(self, cmd, args):
+        if cmd not in self.commands:
+            raise Exception(f"unknown command {cmd}")
+        return self.commands[cmd](**args)
+
+    def cmdPing(self):
+        return "pong"
+
+    def cmdStatus(self):
+        return {
+            "online": self.sd.online,
+            "statusmsg": self.sd.statusmsg,
+            "uptime": int(time.time() - self.started),
+            "lastrefresh": int(self.lastrefresh),
+            "nextrefresh": int(self.lastrefresh + self.interval),
+            "refreshing": self.refreshlock.locked(),
+            "lasterror": self.lasterror,
+        }
+
+    def cmdRefresh(self):
+        self.wake.set()
+        return "refresh scheduled"
+
+    def cmdLineups(self):
+        return self.sd.lineups
+
+    def cmdAirings(self, start=None, end=None, stations=None):
+        if start is None:
+            start = int(time.time())
+        if end is None:
+            end = start + 3 * 3600
+        xindex = self.sdc.getAiringIndex()
+        return xindex.airingsBetween(int(start), int(end), stations)
+
+    def cmdNowNext(self, stationid, when=None):
+        reader = self.sdc.openScheduleReader(stationid)
+        if reader is None:
+            return []
+        try:
+            return reader.nowNext(when)
+        finally:
+            reader.close()
+
+    def cmdProgram(self, md5):
+        return self.sdc.readProgramFromCache(md5)
+
+    def cmdSearch(self, query, start=None, end=None, limit=100):
+        if self.db is None:
+            raise Exception("searching needs searchindex set in the config")
+        return [dict(x) for x in self.db.searchPrograms(query, start, end, limit)]
+
+    def doRefresh(self):
+        """Run one refresh, a failed refresh is logged and retried next interval."""
+        with self.refreshlock:
+            try:
+                log.info("daemon refresh starting")
+                start = time.time()
+                self.refresh(self.sd, self.sdc)
+                self.lasterror = None
+                log.info(f"daemon refresh completed in {time.time() - start:.1f}s")
+            except Exception as e:
+                self.lasterror = f"{type(e).__name__}: {e}"
+                log.error(f"daemon refresh failed: {self.lasterror}")
+            self.lastrefresh = time.time()
+
+    def startServer(self):
+        """Listen on the socket, replacing a stale socket file."""
+        try:
+            self.socketpath.parent.mkdir(parents=True, exist_ok=True)
+            if self.socketpath.exists():
+                if ping(self.socketpath):
+                    raise Exception(
+                        f"a daemon is already listening on {self.socketpath}"
+                    )
+                self.socketpath.unlink()
+            # the socket is created 0600 by bind, a chmod after it would
+            # leave a moment when other users could connect
+            umask = os.umask(0o177)
+            try:
+                self.server = SDServer(str(self.socketpath), SDRequestHandler)
+            finally:
+                os.umask(umask)
+            self.server.daemon = self
+            thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+            thread.start()
+            log.info(f"daemon listening on {self.socketpath}")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def stop(self, *args):
+        """Stop the daemon, safe to call from a signal handler."""
+        self.stopping = True
+        self.wake.set()
+
+    def serve(self, refreshfirst=True):
+        """Serve queries and refresh every interval until stopped."""
+        try:
+            self.startServer()
+            if not refreshfirst:
+                self.lastrefresh = time.time()
+            # build the airing index from the cache before the first query
+            self.sdc.getAiringIndex()
+            while not self.stopping:
+                wait = self.lastrefresh + self.interval - time.time()
+                if wait <= 0 or self.wake.is_set():
+                    self.wake.clear()
+                    self.doRefresh()
+                    continue
+                self.wake.wait(wait)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+        finally:
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+                if self.socketpath.exists():
+                    self.socketpath.unlink()
+            log.info("daemon stopped")
+
+
+def sendRequest(socketpath, request, timeout):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socketpath))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as sfn:
+            return json.loads(sfn.readline())
+
+
+def query(socketpath, cmd, timeout=30, **args):
+    """Send one command to the daemon and return its result.
+
+    Raises:
+        Exception: if the daemon reports that the command failed
+    """
+    try:
+        request = dict(args)
+        request["cmd"] = cmd
+        reply = sendRequest(socketpath, request, timeout)
+        if not reply["ok"]:
+            raise Exception(reply["error"])
+        return reply["result"]
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def ping(socketpath):
+    """Returns True if a daemon is answering on the socket."""
+    try:
+        return sendRequest(socketpath, {"cmd": "ping"}, 2)["result"] == "pong"
+    except Exception:
+        return False
@@ -1,15 +1,110 @@
-"""Database class for the ccasdtv application."""
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Database class for the ccasdtv application.
 
-import sqlite3
+SDDb stores the EPG in SQLite and has the same write methods as SDCache,
+so either can be handed to the SDApi fetch routines as the cache.
+"""
+
+import calendar
+import datetime
+import json
 from pathlib import Path
+import sqlite3
+import sys
+import threading
+import time
+
+import ccalogging
+
+log = ccalogging.log
+
+SCHEMA = [
+    """create table if not exists stations (
+        stationid text primary key,
+        name text,
+        callsign text,
+        channelnumber text,
+        data text
+    )""",
+    """create table if not exists lineups (
+        lineupid text primary key,
+        modified integer,
+        data text
+    )""",
+    """create table if not exists scheduledays (
+        stationid text,
+        startdate text,
+        md5 text,
+        primary key (stationid, startdate)
+    )""",
+    """create table if not exists airings (
+        stationid text,
+        startdate text,
+        airdatetime integer,
+        duration integer,
+        programid text,
+        md5 text,
+        data text
+    )""",
+    """create index if not exists airings_station_time
+        on airings (stationid, airdatetime)""",
+    "create index if not exists airings_programid on airings (programid)",
+    "create index if not exists airings_md5 on airings (md5)",
+    """create table if not exists programs (
+        md5 text primary key,
+        programid text,
+        data text
+    )""",
+    "create index if not exists programs_programid on programs (programid)",
+]
+
+# only created when search is enabled, not every SQLite is built with FTS5
+SEARCHSCHEMA = """create virtual table if not exists programsearch using fts5 (
+    md5 unindexed,
+    title,
+    description,
+    cast
+)"""
 
 
 class SDDb:
-    def __init__(self, appname="ccasdtv"):
+    def __init__(self, appname="ccasdtv", dbpath=None, batchsize=1000, search=False):
+        """Initialise the database.
+
+        Args:
+            appname: str: the database is ~/.config/<appname>.db
+            dbpath: Path: the database file, instead of the default
+            batchsize: int: programs to queue before inserting them
+            search: bool: keep the full text search index of the programs,
+                turned off if SQLite has no FTS5, default: False
+        """
         try:
-            dbfn = f"{appname}.db"
-            home = Path.home()
-            self.dbpath = home.joinpath(".config", dbfn)
+            if dbpath is None:
+                dbfn = f"{appname}.db"
+                home = Path.home()
+                dbpath = home.joinpath(".config", dbfn)
+            self.dbpath = Path(dbpath)
+            self.connection = None
+            self.lock = threading.RLock()
+            self.pending = []
+            self.batchsize = batchsize
+            self.search = search
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -20,8 +115,31 @@ class SDDb:
             raise
 
     def getConnection(self):
+        """Open the persistent connection and create the schema, once."""
         try:
-            self.connection = sqlite3.connect(self.dbpath)
+            with self.lock:
+                if self.connection is None:
+                    self.dbpath.parent.mkdir(parents=True, exist_ok=True)
+                    log.debug(f"opening database {self.dbpath}")
+                    self.connection = sqlite3.connect(
+                        str(self.dbpath), check_same_thread=False
+                    )
+                    self.connection.row_factory = sqlite3.Row
+                    self.connection.execute("pragma journal_mode=WAL")
+                    self.connection.execute("pragma synchronous=NORMAL")
+                    with self.connection:
+                        for sql in SCHEMA:
+                            self.connection.execute(sql)
+                    if self.search:
+                        try:
+                            with self.connection:
+                                self.connection.execute(SEARCHSCHEMA)
+                        except sqlite3.OperationalError as e:
+                            log.warning(
+                                f"program search disabled, this SQLite lacks FTS5: {e}"
+                            )
+                            self.search = False
+            return self.connection
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -31,19 +149,38 @@ class SDDb:
             print(msg)
             raise
 
-    def doSql(self, sql, dictionary=True, one=False):
+    def close(self):
         try:
-            self.get_connection()
-            with self.connection:
-                if dictionary:
-                    self.connection.row_factory = sqlite3.Row
-                cursor = self.connection.cursor()
-                cursor.execute(sql)
+            with self.lock:
+                self.flush()
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def doSql(self, sql, params=(), dictionary=True, one=False):
+        try:
+            with self.lock:
+                conn = self.getConnection()
+                with conn:
+                    cursor = conn.cursor()
+                    cursor.execute(sql, params)
+                    if one:
+                        rows = cursor.fetchone()
+                    else:
+                        rows = cursor.fetchall()
+            if not dictionary:
                 if one:
-                    rows = cursor.fetchone()
+                    rows = tuple(rows) if rows is not None else None
                 else:
-                    rows = cursor.fetchall()
-            self.connection.close()
+                    rows = [tuple(row) for row in rows]
             return rows
         except Exception as e:
             exci = sys.exc_info()[2]
@@ -53,3 +190,378 @@ class SDDb:
             msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
             print(msg)
             raise
+
+    def doMany(self, statements):
+        """Run a list of (sql, rows) executemany statements in one transaction."""
+        try:
+            with self.lock:
+                conn = self.getConnection()
+                with conn:
+                    for sql, rows in statements:
+                        conn.executemany(sql, rows)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def getTimeStamp(self, dt, dtformat="%Y-%m-%dT%H:%M:%SZ"):
+        """Returns the integer epoch timestamp for the UTC date time dt."""
+        try:
+            return calendar.timegm(time.strptime(dt, dtformat))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def airingRows(self, stationid, days):
+        """Returns the scheduledays and airings rows for the schedule days."""
+        try:
+            dayrows = []
+            airrows = []
+            for day in days:
+                meta = day.get("metadata", {})
+                startdate = meta.get("startDate")
+                dayrows.append((stationid, startdate, meta.get("md5")))
+                for prog in day.get("programs", []):
+                    airrows.append(
+                        (
+                            stationid,
+                            startdate,
+                            self.getTimeStamp(prog["airDateTime"]),
+                            prog.get("duration", 0),
+                            prog["programID"],
+                            prog["md5"],
+                            json.dumps(prog, separators=(",", ":")),
+                        )
+                    )
+            return (dayrows, airrows)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeChannelToCache(self, chandata):
+        try:
+            row = (
+                chandata["stationID"],
+                chandata.get("name"),
+                chandata.get("callsign"),
+                chandata.get("channelnumber"),
+                json.dumps(chandata, separators=(",", ":")),
+            )
+            sql = "insert or replace into stations values (?,?,?,?,?)"
+            self.doMany([(sql, [row])])
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeLineupData(self, lineupid, ldata):
+        try:
+            row = (
+                lineupid,
+                ldata.get("modified", 0),
+                json.dumps(ldata, separators=(",", ":")),
+            )
+            sql = "insert or replace into lineups values (?,?,?)"
+            self.doMany([(sql, [row])])
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeChannelScheduleToCache(self, stationid, chansched):
+        """Replace the station's schedule with these days."""
+        try:
+            dayrows, airrows = self.airingRows(stationid, chansched)
+            self.doMany(
+                [
+                    ("delete from scheduledays where stationid=?", [(stationid,)]),
+                    ("delete from airings where stationid=?", [(stationid,)]),
+                    ("insert into scheduledays values (?,?,?)", dayrows),
+                    ("insert into airings values (?,?,?,?,?,?,?)", airrows),
+                ]
+            )
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def updateChannelScheduleCache(self, stationid, days):
+        """Merge these days into the station's schedule, dropping past days."""
+        try:
+            today = datetime.datetime.utcnow().date().isoformat()
+            dayrows, airrows = self.airingRows(stationid, days)
+            dates = [(stationid, row[1]) for row in dayrows]
+            self.doMany(
+                [
+                    (
+                        "delete from scheduledays where stationid=? and startdate=?",
+                        dates,
+                    ),
+                    ("delete from airings where stationid=? and startdate=?", dates),
+                    (
+                        "delete from scheduledays where stationid=? and startdate<?",
+                        [(stationid, today)],
+                    ),
+                    (
+                        "delete from airings where stationid=? and startdate<?",
+                        [(stationid, today)],
+                    ),
+                    ("insert into scheduledays values (?,?,?)", dayrows),
+                    ("insert into airings values (?,?,?,?,?,?,?)", airrows),
+                ]
+            )
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def readScheduleMd5Index(self):
+        """Returns the stationid: {date: md5} index of the stored schedules."""
+        try:
+            index = {}
+            for row in self.doSql("select * from scheduledays"):
+                index.setdefault(row["stationid"], {})[row["startdate"]] = row["md5"]
+            return index
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeScheduleMd5Index(self):
+        """The md5 index is stored with the schedule days, nothing to write."""
+        pass
+
+    def haveProgram(self, md5):
+        try:
+            with self.lock:
+                if any(prog["md5"] == md5 for prog in self.pending):
+                    return True
+            row = self.doSql("select 1 from programs where md5=?", (md5,), one=True)
+            return row is not None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeProgramToCache(self, program):
+        """Queue the program, they are inserted batchsize at a time."""
+        try:
+            with self.lock:
+                self.pending.append(program)
+                if len(self.pending) >= self.batchsize:
+                    self.flush()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def writeProgramsToCache(self, programs):
+        """Insert a batch of programs, and their search text, in one transaction."""
+        try:
+            rows = [
+                (
+                    prog["md5"],
+                    prog["programID"],
+                    json.dumps(prog, separators=(",", ":")),
+                )
+                for prog in programs
+            ]
+            statements = [("insert or replace into programs values (?,?,?)", rows)]
+            # the connection decides whether search is available
+            self.getConnection()
+            if self.search:
+                md5s = [(prog["md5"],) for prog in programs]
+                textrows = [
+                    (prog["md5"],) + self.programText(prog) for prog in programs
+                ]
+                statements.append(("delete from programsearch where md5=?", md5s))
+                statements.append(
+                    ("insert into programsearch values (?,?,?,?)", textrows)
+                )
+            self.doMany(statements)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def flush(self):
+        """Insert any queued programs."""
+        try:
+            with self.lock:
+                if len(self.pending) > 0:
+                    self.writeProgramsToCache(self.pending)
+                    self.pending = []
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def programText(self, program):
+        """Returns the (title, description, cast) search text of an SD program."""
+        try:
+            titles = [t.get("title120", "") for t in program.get("titles", [])]
+            if "episodeTitle150" in program:
+                titles.append(program["episodeTitle150"])
+            descs = []
+            xdescs = program.get("descriptions", {})
+            for dtype in xdescs:
+                for desc in xdescs[dtype]:
+                    if desc.get("description", "") not in descs:
+                        descs.append(desc.get("description", ""))
+            people = [p.get("name", "") for p in program.get("cast", [])]
+            people += [p.get("name", "") for p in program.get("crew", [])]
+            return (" ".join(titles), " ".join(descs), " ".join(people))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def searchPrograms(self, query, start=None, end=None, limit=100):
+        """Find the airings of programs matching an FTS5 query.
+
+        Args:
+            query: str: FTS5 query, e.g. "doctor who" or "cast:tennant"
+            start: int: only airings ending after this epoch, default: now
+            end: int: only airings starting before this epoch, default: a week on
+            limit: int: maximum number of airings to return
+
+        Returns:
+            list: rows of stationid, airdatetime, duration, programid, md5, title
+        """
+        try:
+            self.getConnection()
+            if not self.search:
+                raise Exception("program search is not enabled in this database")
+            if start is None:
+                start = int(time.time())
+            if end is None:
+                end = start + 7 * 86400
+            if end <= start:
+                return []
+            sql = """select a.stationid, a.airdatetime, a.duration, a.programid,
+                a.md5, s.title
+                from programsearch s join airings a on a.md5 = s.md5
+                where programsearch match ?
+                and a.airdatetime < ? and a.airdatetime + a.duration > ?
+                order by a.airdatetime limit ?"""
+            return self.doSql(sql, (query, end, start, limit))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def readProgramFromCache(self, md5):
+        try:
+            row = self.doSql("select data from programs where md5=?", (md5,), one=True)
+            return json.loads(row["data"]) if row is not None else None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def getAirings(self, stationid, start, end):
+        """Returns the station's airings that overlap the start to end epoch window.
+
+        Each row has the airing and the program's json data, if it is stored.
+        An empty window has no airings, as with SDAiringIndex.
+        """
+        try:
+            if end <= start:
+                return []
+            # airings are never longer than a day, so the lower bound on
+            # airdatetime keeps this a range scan of the station/time index
+            sql = """select a.stationid, a.airdatetime, a.duration, a.programid,
+                a.md5, p.data as program
+                from airings a left join programs p on p.md5 = a.md5
+                where a.stationid = ? and a.airdatetime >= ? and a.airdatetime < ?
+                and a.airdatetime + a.duration > ?
+                order by a.airdatetime"""
+            return self.doSql(sql, (stationid, start - 86400, end, start))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
+
+    def getStationId(self, name):
+        """Returns the station id for the station name or callsign, or None."""
+        try:
+            row = self.doSql(
+                "select stationid from stations where name=? or callsign=?",
+                (name, name),
+                one=True,
+            )
+            return row["stationid"] if row is not None else None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            print(msg)
+            raise
@@ -0,0 +1,314 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Change journal for the ccasdtv cache.
+
+The cache records each station, schedule day and program that it writes
+in the journal, so that an export can regenerate only what has changed
+since the last export rather than the whole guide. The journal is kept in
+the cache directory, so changes made by one process (ccasdtv run) are seen
+by another (ccasdtv export-xmltv).
+
+Each run holds its changes in memory and adds them to the journal file
+once, at its end. The file is only read and rewritten under an flock, so
+a run saving and an export consuming at the same time cannot lose each
+other's changes. When the journal cannot say what has changed, because it
+has only just been turned on, a run died before saving or too many
+programs have changed to be worth listing, it says that everything has.
+"""
+
+import contextlib
+import fcntl
+import os
+import sys
+import threading
+
+import ccalogging
+
+log = ccalogging.log
+
+# beyond this many changed programs the journal just says everything changed
+MAXPROGRAMS = 50000
+
+
+def pidAlive(pid):
+    """Returns True if the process pid is still running."""
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+class SDJournal:
+    def __init__(self, sdc, filename, maxprograms=MAXPROGRAMS):
+        """Initialise the journal.
+
+        Args:
+            sdc: SDCache: the cache, used to read and write the journal file
+            filename: Path: the journal file
+            maxprograms: int: most changed programs to list, default: MAXPROGRAMS
+        """
+        try:
+            self.sdc = sdc
+            self.filename = filename
+            # the journal file is replaced by a rename, so it is the lock
+            # file beside it that is flocked
+            self.lockfn = filename.with_name(f"{filename.name}.lock")
+            self.maxprograms = maxprograms
+            self.lock = threading.Lock()
+            self.running = False
+            self.reset()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def reset(self):
+        with self.lock:
+            # the changes recorded since the last save, stationid: set of dates
+            self.stations = {}
+            self.removed = set()
+            # hex keys of the changed programs
+            self.programs = set()
+            self.dirty = False
+
+    @contextlib.contextmanager
+    def fileLock(self):
+        """Hold the lock on the journal file against other processes."""
+        with open(self.lockfn, "a") as lfn:
+            fcntl.flock(lfn.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lfn.fileno(), fcntl.LOCK_UN)
+
+    def read(self):
+        """Returns the changes saved in the journal file, the file lock must be held.
+
+        A missing or unreadable file says that everything has changed, it
+        is not known what changed before the journal was there.
+        """
+        try:
+            try:
+                data = self.sdc.readJson(self.filename)
+            except (ValueError, OSError, EOFError) as e:
+                log.warning(f"the cache journal is unreadable: {e}")
+                data = None
+            if not isinstance(data, dict):
+                data = {"all": True}
+            return {
+                "all": data.get("all", False),
+                "stations": {
+                    sid: set(dates) for sid, dates in data.get("stations", {}).items()
+                },
+                "removed": set(data.get("removed", [])),
+                "programs": set(data.get("programs", [])),
+                "running": set(data.get("running", [])),
+            }
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def write(self, changes):
+        self.sdc.writeJson(
+            self.filename,
+            {
+                "all": changes["all"],
+                "stations": {
+                    sid: sorted(dates) for sid, dates in changes["stations"].items()
+                },
+                "removed": sorted(changes["removed"]),
+                "programs": sorted(changes["programs"]),
+                "running": sorted(changes["running"]),
+            },
+        )
+
+    def takeChanges(self):
+        """Returns the changes recorded since the last save and forgets them.
+
+        The lock must be held.
+        """
+        unsaved = {
+            "stations": self.stations,
+            "removed": self.removed,
+            "programs": self.programs,
+        }
+        self.stations = {}
+        self.removed = set()
+        self.programs = set()
+        self.dirty = False
+        return unsaved
+
+    def restoreChanges(self, unsaved):
+        """Put back changes taken for a save that failed, the lock must be held."""
+        for sid, dates in unsaved["stations"].items():
+            if sid not in self.removed:
+                self.stations.setdefault(sid, set()).update(dates)
+        for sid in unsaved["removed"]:
+            if sid not in self.stations:
+                self.removed.add(sid)
+        self.programs |= unsaved["programs"]
+        self.dirty = True
+
+    def merged(self, changes, unsaved):
+        """Returns the saved changes with the later, unsaved, ones added to them.
+
+        A station removed after it changed is only listed as removed and a
+        station changed after it was removed only as changed.
+        """
+        for sid, dates in unsaved["stations"].items():
+            changes["stations"].setdefault(sid, set()).update(dates)
+        for sid in unsaved["removed"]:
+            changes["stations"].pop(sid, None)
+        changes["removed"] -= set(unsaved["stations"])
+        changes["removed"] |= unsaved["removed"]
+        changes["programs"] |= unsaved["programs"]
+        if len(changes["programs"]) > self.maxprograms:
+            log.info(
+                f"""{len(changes["programs"])} programs changed, the cache """
+                "journal now says that everything has"
+            )
+            changes["all"] = True
+        if changes["all"]:
+            changes["stations"] = {}
+            changes["programs"] = set()
+        return changes
+
+    def recordStation(self, stationid, dates=()):
+        with self.lock:
+            self.stations.setdefault(stationid, set()).update(dates)
+            self.removed.discard(stationid)
+            self.dirty = True
+
+    def recordRemoved(self, stationid):
+        with self.lock:
+            self.stations.pop(stationid, None)
+            self.removed.add(stationid)
+            self.dirty = True
+
+    def recordProgram(self, key):
+        with self.lock:
+            if key not in self.programs:
+                self.programs.add(key)
+                self.dirty = True
+
+    def begin(self):
+        """Note in the journal file that this process is about to change the cache.
+
+        If the process dies before it saves, the changes it made are not in
+        the journal, and the next consume says that everything has changed.
+        """
+        try:
+            with self.lock:
+                with self.fileLock():
+                    changes = self.read()
+                    changes["running"].add(os.getpid())
+                    self.write(changes)
+                self.running = True
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def save(self):
+        """Add the changes recorded since the last save to the journal file."""
+        try:
+            with self.lock:
+                if not self.dirty and not self.running:
+                    return
+                unsaved = self.takeChanges()
+                try:
+                    with self.fileLock():
+                        changes = self.merged(self.read(), unsaved)
+                        changes["running"].discard(os.getpid())
+                        self.write(changes)
+                except BaseException:
+                    self.restoreChanges(unsaved)
+                    raise
+                self.running = False
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def consume(self):
+        """Returns all the recorded changes and empties the journal.
+
+        Returns:
+            dict: "all" True if everything must be taken to have changed,
+                otherwise "stations" stationid: set of dates, "removed" set
+                of station ids and "programs" set of program keys
+        """
+        try:
+            with self.lock:
+                unsaved = self.takeChanges()
+                try:
+                    with self.fileLock():
+                        changes = self.merged(self.read(), unsaved)
+                        running = set()
+                        for pid in changes.pop("running"):
+                            if pidAlive(pid):
+                                running.add(pid)
+                            else:
+                                log.warning(
+                                    f"process {pid} died before saving its cache "
+                                    "changes to the journal"
+                                )
+                                changes["all"] = True
+                        self.write(
+                            {
+                                "all": False,
+                                "stations": {},
+                                "removed": set(),
+                                "programs": set(),
+                                "running": running,
+                            }
+                        )
+                except BaseException:
+                    self.restoreChanges(unsaved)
+                    raise
+            return self.merged(
+                changes, {"stations": {}, "removed": set(), "programs": set()}
+            )
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
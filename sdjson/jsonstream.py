@@ -0,0 +1,99 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Incremental JSON parsing for large Schedules Direct responses."""
+
+import codecs
+import json
+
+import ccalogging
+
+log = ccalogging.log
+
+WHITESPACE = " \t\n\r"
+
+
+def iterJsonArray(chunks):
+    """Yield each element of a top level JSON array as soon as it is complete.
+
+    Only the text of the element currently being parsed is held in memory,
+    so memory use is bounded by the largest element rather than the whole
+    document. If the document is not an array (SD returns a single object
+    for some errors) it is parsed whole and yielded as one element.
+
+    Args:
+        chunks: iterable of bytes, e.g. requests Response.iter_content()
+
+    Raises:
+        ValueError: if the document is truncated or is not valid JSON
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    state = "start"
+    whole = []
+    eof = False
+    chunks = iter(chunks)
+    while not eof:
+        try:
+            text = utf8.decode(next(chunks))
+        except StopIteration:
+            text = utf8.decode(b"", final=True)
+            eof = True
+        if state == "whole":
+            whole.append(text)
+            continue
+        buf = buf[pos:] + text
+        pos = 0
+        while state != "done":
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos >= len(buf):
+                break
+            if state == "start":
+                if buf[pos] != "[":
+                    state = "whole"
+                    whole.append(buf[pos:])
+                    break
+                pos += 1
+                state = "items"
+            elif buf[pos] == "]":
+                pos += 1
+                state = "done"
+            elif buf[pos] == ",":
+                pos += 1
+            else:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    break
+                # a number at the end of the buffer may have more digits to come
+                if end == len(buf) and not eof and not isinstance(obj, (dict, list)):
+                    break
+                pos = end
+                yield obj
+    if state == "whole":
+        obj = json.loads("".join(whole))
+        if isinstance(obj, list):
+            yield from obj
+        else:
+            yield obj
+    elif state != "done":
+        raise ValueError("Truncated JSON array")
@@ -81,3 +81,79 @@ def parseLineupData(jdata):
         msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
         log.error(msg)
         raise
+
+
+def diffLineups(old, new):
+    """Compares the stations of two parsed lineups.
+
+    Args:
+        old: dict: the cached lineup data, or None
+        new: dict: the lineup data as returned by parseLineupData
+
+    Returns:
+        dict: with "added", "changed" and "removed" lists of station ids
+    """
+    try:
+        oldchans = old["channelsbyid"] if old is not None else {}
+        newchans = new["channelsbyid"] if new is not None else {}
+        diff = {"added": [], "changed": [], "removed": []}
+        for stationid, station in newchans.items():
+            if stationid not in oldchans:
+                diff["added"].append(stationid)
+            elif oldchans[stationid] != station:
+                diff["changed"].append(stationid)
+        diff["removed"] = [x for x in oldchans if x not in newchans]
+        return diff
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def refreshLineup(sd, sdc, slu, cfglineup=None):
+    """Brings the cached copy of a lineup up to date.
+
+    The lineup is only fetched if its modified stamp in the status response
+    is newer than the one recorded in the config, and only the stations that
+    were added or changed are rewritten to the cache.
+
+    Args:
+        sd: SDApi: an online SDApi object
+        sdc: SDCache: the cache
+        slu: dict: the lineup entry from the status response (sd.lineups)
+        cfglineup: dict: the lineupid/modified entry from the config, or None
+
+    Returns:
+        tuple: (cfglineup, diff), diff is None if the lineup was unchanged
+    """
+    try:
+        lineupid = slu["lineupID"]
+        lum = sd.getTimeStamp(slu["modified"])
+        old = sdc.readLineupData(lineupid)
+        if cfglineup is not None and old is not None:
+            if int(cfglineup["modified"]) >= lum:
+                log.debug(f"Lineup {lineupid} is unchanged")
+                return (cfglineup, None)
+        log.info(f"Lineup {lineupid} is out of date, retrieving fresh data.")
+        ldata = parseLineupData(sd.getLineup(lineupid))
+        diff = diffLineups(old, ldata)
+        for stationid in diff["added"] + diff["changed"]:
+            sdc.writeChannelToCache(ldata["channelsbyid"][stationid])
+        sdc.writeLineupData(lineupid, ldata)
+        log.info(
+            f"""Lineup {lineupid}: {len(diff["added"])} stations added, """
+            f"""{len(diff["changed"])} changed, {len(diff["removed"])} removed"""
+        )
+        return ({"lineupid": lineupid, "modified": lum}, diff)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
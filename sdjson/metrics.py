@@ -0,0 +1,312 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Per-route request metrics for the SD API.
+
+SDApi records every request it makes here: the time until the response
+in a latency histogram, the http status, the response bytes and, for
+streamed responses, the time spent reading the body. Retries and token
+renewals are counted as well. At the end of a run the metrics are logged
+as a table and can be written out as json or as a Prometheus textfile for
+the node_exporter textfile collector.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+import ccalogging
+
+log = ccalogging.log
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def routeName(route):
+    """Returns the route with any lineup id replaced, for use as a label."""
+    if route.startswith("lineups/preview/"):
+        return "lineups/preview/<id>"
+    if route.startswith("lineups/"):
+        return "lineups/<id>"
+    return route
+
+
+class SDMetrics:
+    def __init__(self, prefix="ccasdtv"):
+        """Initialise the metrics.
+
+        Args:
+            prefix: str: prefix for the Prometheus metric names, default: ccasdtv
+        """
+        try:
+            self.prefix = prefix
+            self.lock = threading.Lock()
+            self.started = time.time()
+            self.routes = {}
+            self.tokens = 0
+            self.tokenrenewals = 0
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def route(self, route):
+        """Returns the metrics of a route, the lock must be held."""
+        name = routeName(route)
+        if name not in self.routes:
+            self.routes[name] = {
+                "requests": 0,
+                "status": {},
+                "bytes": 0,
+                "seconds": 0.0,
+                "maxseconds": 0.0,
+                "buckets": [0] * len(BUCKETS),
+                "bodyseconds": 0.0,
+                "retries": {},
+            }
+        return self.routes[name]
+
+    def observe(self, route, status, seconds, nbytes=0):
+        """Record a request.
+
+        Args:
+            route: str: the SD route, e.g. "schedules"
+            status: int: the http status, or "error" if there was no response
+            seconds: float: time until the response (all of it, unless streamed)
+            nbytes: int: response bytes, streamed bodies are added by observeBody
+        """
+        with self.lock:
+            xroute = self.route(route)
+            xroute["requests"] += 1
+            status = str(status)
+            xroute["status"][status] = xroute["status"].get(status, 0) + 1
+            xroute["bytes"] += nbytes
+            xroute["seconds"] += seconds
+            xroute["maxseconds"] = max(xroute["maxseconds"], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    xroute["buckets"][i] += 1
+                    break
+
+    def observeBody(self, route, seconds, nbytes):
+        """Record the reading of a streamed response body."""
+        with self.lock:
+            xroute = self.route(route)
+            xroute["bytes"] += nbytes
+            xroute["bodyseconds"] += seconds
+
+    def retry(self, route, outcome):
+        """Count a request that is to be retried, by why."""
+        with self.lock:
+            retries = self.route(route)["retries"]
+            retries[outcome] = retries.get(outcome, 0) + 1
+
+    def token(self):
+        """Count a new token."""
+        with self.lock:
+            self.tokens += 1
+
+    def tokenRenewal(self):
+        """Count a token renewed because SD rejected the old one."""
+        with self.lock:
+            self.tokenrenewals += 1
+
+    def snapshot(self):
+        """Returns a copy of the metrics as a dict."""
+        with self.lock:
+            return json.loads(
+                json.dumps(
+                    {
+                        "started": self.started,
+                        "time": time.time(),
+                        "buckets": BUCKETS,
+                        "routes": self.routes,
+                        "tokens": self.tokens,
+                        "tokenrenewals": self.tokenrenewals,
+                    }
+                )
+            )
+
+    def quantile(self, xroute, q):
+        """Estimates a latency quantile from the histogram buckets."""
+        target = q * xroute["requests"]
+        count = 0
+        for bound, n in zip(BUCKETS, xroute["buckets"]):
+            count += n
+            if count >= target:
+                return min(bound, xroute["maxseconds"])
+        return xroute["maxseconds"]
+
+    def summary(self):
+        """Returns the end of run table as a list of lines."""
+        try:
+            snap = self.snapshot()
+            lines = [
+                f"""{"route":<20s} {"reqs":>5s} {"errors":>6s} {"retries":>7s} """
+                f"""{"KB":>9s} {"total s":>8s} {"mean s":>7s} {"p95 s":>7s} """
+                f"""{"max s":>7s} {"body s":>7s}"""
+            ]
+            for name in sorted(snap["routes"]):
+                xroute = snap["routes"][name]
+                errors = sum(
+                    [
+                        n
+                        for status, n in xroute["status"].items()
+                        if not status.isdigit() or int(status) >= 400
+                    ]
+                )
+                retries = sum(xroute["retries"].values())
+                mean = xroute["seconds"] / max(1, xroute["requests"])
+                lines.append(
+                    f"""{name:<20s} {xroute["requests"]:>5d} {errors:>6d} """
+                    f"""{retries:>7d} {xroute["bytes"] // 1024:>9d} """
+                    f"""{xroute["seconds"]:>8.2f} {mean:>7.3f} """
+                    f"""{self.quantile(xroute, 0.95):>7.3f} """
+                    f"""{xroute["maxseconds"]:>7.3f} {xroute["bodyseconds"]:>7.2f}"""
+                )
+            lines.append(
+                f"""{snap["tokens"]} tokens obtained, """
+                f"""{snap["tokenrenewals"]} renewed after being rejected"""
+            )
+            return lines
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def logSummary(self):
+        if len(self.routes) > 0:
+            for line in self.summary():
+                log.info(line)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        try:
+            snap = self.snapshot()
+            p = self.prefix
+            lines = [
+                f"# HELP {p}_sd_request_duration_seconds Time until the SD response.",
+                f"# TYPE {p}_sd_request_duration_seconds histogram",
+            ]
+            for name in sorted(snap["routes"]):
+                xroute = snap["routes"][name]
+                label = f'route="{name}"'
+                count = 0
+                for bound, n in zip(BUCKETS, xroute["buckets"]):
+                    count += n
+                    lines.append(
+                        f'{p}_sd_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'{p}_sd_request_duration_seconds_bucket{{{label},le="+Inf"}} '
+                    f"""{xroute["requests"]}"""
+                )
+                lines.append(
+                    f"{p}_sd_request_duration_seconds_sum{{{label}}} "
+                    f"""{xroute["seconds"]}"""
+                )
+                lines.append(
+                    f"{p}_sd_request_duration_seconds_count{{{label}}} "
+                    f"""{xroute["requests"]}"""
+                )
+            counters = [
+                ("requests_total", "SD requests by http status.", "status"),
+                ("retries_total", "SD requests retried, by reason.", "retries"),
+            ]
+            for metric, text, key in counters:
+                lines.append(f"# HELP {p}_sd_{metric} {text}")
+                lines.append(f"# TYPE {p}_sd_{metric} counter")
+                xlabel = "status" if key == "status" else "reason"
+                for name in sorted(snap["routes"]):
+                    for value, n in sorted(snap["routes"][name][key].items()):
+                        lines.append(
+                            f'{p}_sd_{metric}{{route="{name}",{xlabel}="{value}"}} {n}'
+                        )
+            sums = [
+                ("response_bytes_total", "SD response bytes.", "bytes"),
+                (
+                    "body_seconds_total",
+                    "Time spent reading streamed SD responses.",
+                    "bodyseconds",
+                ),
+            ]
+            for metric, text, key in sums:
+                lines.append(f"# HELP {p}_sd_{metric} {text}")
+                lines.append(f"# TYPE {p}_sd_{metric} counter")
+                for name in sorted(snap["routes"]):
+                    lines.append(
+                        f'{p}_sd_{metric}{{route="{name}"}} {snap["routes"][name][key]}'
+                    )
+            lines.extend(
+                [
+                    f"# HELP {p}_sd_tokens_total SD tokens obtained.",
+                    f"# TYPE {p}_sd_tokens_total counter",
+                    f"""{p}_sd_tokens_total {snap["tokens"]}""",
+                    f"# HELP {p}_sd_token_renewals_total SD tokens renewed after being rejected.",
+                    f"# TYPE {p}_sd_token_renewals_total counter",
+                    f"""{p}_sd_token_renewals_total {snap["tokenrenewals"]}""",
+                    f"# HELP {p}_sd_metrics_timestamp_seconds When the metrics were written.",
+                    f"# TYPE {p}_sd_metrics_timestamp_seconds gauge",
+                    f"""{p}_sd_metrics_timestamp_seconds {snap["time"]:.0f}""",
+                ]
+            )
+            return "\n".join(lines) + "\n"
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def write(self, filename):
+        """Write the metrics to filename, as a Prometheus textfile if it ends .prom.
+
+        The file is replaced atomically, the textfile collector must never
+        read a partly written file.
+        """
+        try:
+            if filename.suffix == ".prom":
+                text = self.prometheus()
+            else:
+                text = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            tmpfn = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+            with open(tmpfn, "w") as ofn:
+                ofn.write(text)
+            os.replace(tmpfn, filename)
+            log.debug(f"SD metrics written to {filename}")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
@@ -0,0 +1,310 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Refresh planning against the Schedules Direct daily request budget.
+
+SD limits the requests each account may make in a (UTC) day. The planner
+keeps a ledger of the requests used today in the cache directory and gives
+each run an equal share of what is left of the budget, spread over the
+runs still to come today. The changed station days are then taken in
+priority order, near term days first and favourite stations before the
+rest, until the run's share is used up; the remaining days are deferred
+to later runs, which find them still changed by their md5.
+"""
+
+import datetime
+import sys
+
+import ccalogging
+
+log = ccalogging.log
+
+
+class SDPlanner:
+    def __init__(
+        self,
+        sd,
+        sdc,
+        budget=1000,
+        interval=3600,
+        favourites=None,
+        neardays=3,
+        programsperday=20,
+    ):
+        """Initialise the planner.
+
+        Args:
+            sd: SDApi: the api object, its requestcount is charged to the budget
+            sdc: SDCache: the cache, the ledger is kept in its directory
+            budget: int: requests allowed per UTC day, default: 1000
+            interval: int: seconds between runs, default: 3600
+            favourites: list: station ids to refresh before the others
+            neardays: int: days from today that are always refreshed, default: 3
+            programsperday: int: initial guess at the new programs per station day
+        """
+        try:
+            self.sd = sd
+            self.sdc = sdc
+            self.budget = budget
+            self.interval = interval
+            self.favourites = set(favourites or [])
+            self.neardays = neardays
+            self.programsperday = programsperday
+            self.startcount = sd.requestcount
+            self.lastplan = None
+            self.ledger = None
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def ledgerFileName(self):
+        return self.sdc.getCacheDir().joinpath("budget.json")
+
+    def loadLedger(self):
+        """Returns the ledger file's contents, or {} if it is missing or damaged."""
+        try:
+            ledger = self.sdc.readJson(self.ledgerFileName())
+        except (ValueError, OSError, EOFError) as e:
+            log.warning(f"ignoring the unreadable budget ledger: {e}")
+            ledger = None
+        if ledger is None:
+            return {}
+        types = {"day": str, "used": int, "runs": int, "programsperday": (int, float)}
+        if not isinstance(ledger, dict) or not all(
+            [isinstance(ledger.get(k), types[k]) for k in types]
+        ):
+            log.warning("ignoring the damaged budget ledger")
+            return {}
+        return ledger
+
+    def readLedger(self, now=None):
+        """Returns today's ledger, starting a new one at UTC midnight."""
+        try:
+            if now is None:
+                now = datetime.datetime.utcnow()
+            today = now.date().isoformat()
+            if self.ledger is None:
+                self.ledger = self.loadLedger()
+            if self.ledger.get("day") != today:
+                self.ledger = {
+                    "day": today,
+                    "used": 0,
+                    "runs": 0,
+                    "programsperday": self.ledger.get(
+                        "programsperday", self.programsperday
+                    ),
+                }
+            return self.ledger
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def spent(self):
+        """Returns the requests made by this run that are not yet recorded."""
+        return self.sd.requestcount - self.startcount
+
+    def allowance(self, used, now):
+        """Returns (remaining, share) of the budget for a run at now.
+
+        The share is what is left of today's budget divided by the number
+        of runs still to come today, including this one.
+        """
+        try:
+            remaining = max(0, self.budget - used)
+            tomorrow = datetime.datetime.combine(
+                now.date() + datetime.timedelta(days=1), datetime.time()
+            )
+            secondsleft = (tomorrow - now).total_seconds()
+            runsleft = max(1, -(-int(secondsleft) // self.interval))
+            return (remaining, remaining // runsleft)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def batchCount(self, nitems, size):
+        """Returns the number of batches SDApi.makeBatches makes of nitems."""
+        if nitems == 0:
+            return 0
+        if self.sd.concurrency > 1:
+            size = min(size, max(1, -(-nitems // self.sd.concurrency)))
+        return -(-nitems // size)
+
+    def estimate(self, nstations, ndays, programsperday):
+        """Returns the schedules and programs calls needed for the station days.
+
+        Args:
+            nstations: int: stations with days to fetch
+            ndays: int: station days to fetch
+            programsperday: float: expected new programs per station day
+        """
+        nprogs = int(ndays * programsperday + 0.5)
+        return {
+            "schedules": self.batchCount(nstations, self.sd.schedulebatch),
+            "programs": self.batchCount(nprogs, self.sd.programbatch),
+        }
+
+    def priority(self, sid, date, today):
+        """Sort key for a station day, lowest first."""
+        daysahead = (datetime.date.fromisoformat(date) - today).days
+        near = 0 if daysahead < self.neardays else 1
+        favourite = 0 if sid in self.favourites else 1
+        return (near, favourite, daysahead, sid)
+
+    def plan(self, changed, used=None, now=None):
+        """Decide which of the changed station days to fetch in this run.
+
+        Near term days are fetched whenever the budget has anything left,
+        the other days only while the run's share of the budget allows.
+
+        Args:
+            changed: dict: stationid: list of changed dates
+            used: int: requests already used today, default: from the ledger
+            now: datetime: UTC time of the run, default: now
+
+        Returns:
+            dict: with "now" and "deferred" dicts of stationid: list of dates,
+                "calls" the estimated calls for "now" and the budget figures
+        """
+        try:
+            if now is None:
+                now = datetime.datetime.utcnow()
+            ledger = self.readLedger(now)
+            if used is None:
+                used = ledger["used"] + self.spent()
+            remaining, share = self.allowance(used, now)
+            ppd = ledger["programsperday"]
+            today = now.date()
+            days = sorted(
+                [
+                    (self.priority(sid, date, today), sid, date)
+                    for sid in changed
+                    for date in changed[sid]
+                ]
+            )
+            xnow = {}
+            deferred = {}
+            ndays = 0
+            calls = self.estimate(0, 0, ppd)
+            for key, sid, date in days:
+                limit = remaining if key[0] == 0 else share
+                nstations = len(xnow) if sid in xnow else len(xnow) + 1
+                xcalls = self.estimate(nstations, ndays + 1, ppd)
+                if sum(xcalls.values()) <= limit:
+                    xnow.setdefault(sid, []).append(date)
+                    ndays += 1
+                    calls = xcalls
+                else:
+                    deferred.setdefault(sid, []).append(date)
+            xplan = {
+                "day": ledger["day"],
+                "budget": self.budget,
+                "used": used,
+                "remaining": remaining,
+                "share": share,
+                "now": xnow,
+                "deferred": deferred,
+                "calls": calls,
+            }
+            self.lastplan = xplan
+            return xplan
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def projection(self, changed, now=None, mdcalls=1):
+        """Plan the runs to come today as if nothing else changes.
+
+        Args:
+            changed: dict: stationid: list of changed dates
+            now: datetime: UTC time of the first run, default: now
+            mdcalls: int: calls each run spends on the md5 check before planning
+
+        Returns:
+            list: of plans, one per run, until nothing is deferred or the day ends
+        """
+        try:
+            if now is None:
+                now = datetime.datetime.utcnow()
+            ledger = self.readLedger(now)
+            used = ledger["used"] + self.spent()
+            plans = []
+            while len(changed) > 0 and now.date().isoformat() == ledger["day"]:
+                used += mdcalls
+                xplan = self.plan(changed, used=used, now=now)
+                plans.append(xplan)
+                used += sum(xplan["calls"].values())
+                changed = xplan["deferred"]
+                now += datetime.timedelta(seconds=self.interval)
+            return plans
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def record(self, nprograms=None, now=None):
+        """Charge the requests made since the last record to today's ledger.
+
+        Args:
+            nprograms: int: programs downloaded for the last plan's days, used
+                to refine the programs per station day estimate
+            now: datetime: UTC time of the run, default: now
+        """
+        try:
+            ledger = self.readLedger(now)
+            ledger["used"] += self.spent()
+            ledger["runs"] += 1
+            self.startcount = self.sd.requestcount
+            if nprograms is not None and self.lastplan is not None:
+                ndays = sum([len(x) for x in self.lastplan["now"].values()])
+                if ndays > 0:
+                    ledger["programsperday"] = (
+                        0.8 * ledger["programsperday"] + 0.2 * nprograms / ndays
+                    )
+            self.sdc.writeJson(self.ledgerFileName(), ledger)
+            log.info(f"""{ledger["used"]} of {self.budget} SD requests used today""")
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
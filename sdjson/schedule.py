@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Schedules Direct schedule refresh functions for ccasdtv."""
+
+import sys
+
+import ccalogging
+
+log = ccalogging.log
+
+
+def changedScheduleDays(md5s, index):
+    """Compare the SD schedule md5 table with the cached md5 index.
+
+    Args:
+        md5s: dict: stationid: {date: md5} as returned by SDApi.getScheduleMd5s
+        index: dict: stationid: {date: md5} of the cached schedules
+
+    Returns:
+        dict: stationid: list of dates whose md5 has changed or is not cached
+    """
+    try:
+        changed = {}
+        for sid in md5s:
+            cached = index.get(sid, {})
+            dates = [
+                date
+                for date in sorted(md5s[sid])
+                if cached.get(date) != md5s[sid][date]
+            ]
+            if len(dates) > 0:
+                changed[sid] = dates
+        return changed
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def refreshSchedules(sd, sdc, stationids, dates=None, incremental=True, planner=None):
+    """Bring the cached schedules for the stations up to date.
+
+    In incremental mode only the station days whose SD md5 differs from the
+    cached md5 index are downloaded and merged into the cached schedules.
+
+    Args:
+        sd: SDApi: the api object
+        sdc: SDCache: the cache to write the schedules into
+        stationids: list: the station ids to refresh
+        dates: list: "YYYY-MM-DD" dates to restrict to, default: all available
+        incremental: bool: only fetch changed days, default: True
+        planner: SDPlanner: defers changed days the request budget cannot cover
+
+    Returns:
+        dict: programID: md5 for every airing that was downloaded
+    """
+    try:
+        if incremental:
+            md5s = sd.getScheduleMd5s(stationids, dates)
+            changed = changedScheduleDays(md5s, sdc.readScheduleMd5Index())
+            ndays = sum([len(md5s[sid]) for sid in md5s])
+            nchanged = sum([len(changed[sid]) for sid in changed])
+            log.info(f"{nchanged} of {ndays} station days have changed")
+            if planner is not None:
+                xplan = planner.plan(changed)
+                changed = xplan["now"]
+                ndeferred = sum([len(x) for x in xplan["deferred"].values()])
+                if ndeferred > 0:
+                    log.info(f"{ndeferred} station days deferred to a later run")
+            progs = {}
+            if len(changed) > 0:
+                progs = sd.getSchedules(changed, sdc=sdc, merge=True)
+        else:
+            # load the index before any worker threads write to it
+            sdc.readScheduleMd5Index()
+            progs = sd.getSchedules(stationids, dates, sdc=sdc)
+        sdc.writeScheduleMd5Index()
+        sdc.flush()
+        return progs
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def refreshPrograms(sd, sdc, progs):
+    """Download the programs that are not already in the cache.
+
+    Programs are cached by their md5, so a program whose md5 is already
+    cached is unchanged and is not downloaded again.
+
+    Args:
+        sd: SDApi: the api object
+        sdc: SDCache: the cache to write the programs into
+        progs: dict: programID: md5 as returned by refreshSchedules
+
+    Returns:
+        list: the program ids that were downloaded
+    """
+    try:
+        wanted = [pid for pid in progs if not sdc.haveProgram(progs[pid])]
+        log.info(f"{len(wanted)} of {len(progs)} programs need downloading")
+        received = []
+        if len(wanted) > 0:
+            received = sd.getPrograms(wanted, sdc=sdc)
+        return received
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
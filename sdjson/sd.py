@@ -59,3 +59,5 @@ if cfg["token"] != sd.token:
 
 if cfgdirty:
     writeConfig(cfg, appname=appname)
+
+sd.close()
@@ -22,18 +22,34 @@ re-written in my coding style, with added token caching/renewing
 Thankyou Steven T. Smith.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
 import json
 import sys
+import threading
 import time
 
 import ccalogging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from sdjson import __version__
+from sdjson.jsonstream import iterJsonArray
+from sdjson.metrics import SDMetrics
+from sdjson.throttle import classify
+from sdjson.throttle import FATAL
+from sdjson.throttle import OK
+from sdjson.throttle import PROGRAM_QUEUED
+from sdjson.throttle import RETRY
+from sdjson.throttle import SCHEDULE_QUEUED
+from sdjson.throttle import SDThrottle
+from sdjson.throttle import TOKEN
 
 log = ccalogging.log
 
+
 # when the 20191022 api is out of beta the default url should be:
 # https://json.schedulesdirect.org/20191022
 class SDApi:
@@ -48,6 +64,14 @@ class SDApi:
         debug=False,
         token=None,
         tokenexpires=0,
+        poolsize=10,
+        retries=3,
+        backoff=0.5,
+        schedulebatch=5000,
+        programbatch=5000,
+        concurrency=1,
+        stream=True,
+        timeout=(10, 60),
     ):
         """Initialise the SDApi Class.
 
@@ -59,6 +83,16 @@ class SDApi:
             debug: bool: print api calls and responses
             token: str: cached token from previous runs, default: None
             tokenexpires: float: timestamp for when the cached token expires, default: 0
+            poolsize: int: number of keep-alive connections to hold open, default: 10
+            retries: int: times to retry a failed or throttled request, default: 3
+            backoff: float: base delay in seconds for the jittered backoff, default: 0.5
+            schedulebatch: int: max stations per schedules request, default: 5000
+            programbatch: int: max programs per programs request, default: 5000
+            concurrency: int: max batch requests in flight at once, the number
+                in flight is cut back while SD is throttling us, default: 1
+            stream: bool: parse schedule/program responses as they arrive, default: True
+            timeout: tuple: (connect, read) seconds to wait for SD before the
+                request is retried, or one number for both, default: (10, 60)
         """
         try:
             self.username = username
@@ -66,12 +100,31 @@ class SDApi:
             self.appname = appname
             self.url = url
             self.debug = debug
-            self.headers = {"User-Agent": f"{appname} / {__version__}"}
+            self.headers = {
+                "User-Agent": f"{appname} / {__version__}",
+                "Accept-Encoding": "gzip, deflate",
+            }
             self.token = token
             self.tokenexpires = tokenexpires
             self.online = False
             self.statusmsg = "initialising"
             self.lineups = None
+            self.statustime = 0
+            self.requestcount = 0
+            self.countlock = threading.Lock()
+            self.concurrency = max(1, concurrency)
+            self.poolsize = max(poolsize, self.concurrency)
+            self.retries = retries
+            self.backoff = backoff
+            self.schedulebatch = schedulebatch
+            self.programbatch = programbatch
+            self.stream = stream
+            self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+            self.tokenlock = threading.Lock()
+            self.local = threading.local()
+            self.session = self.makeSession()
+            self.throttle = SDThrottle(self.concurrency, backoff=self.backoff)
+            self.metrics = SDMetrics(appname)
             log.debug("SDApi initialising")
         except Exception as e:
             exci = sys.exc_info()[2]
@@ -83,6 +136,90 @@ class SDApi:
             log.error(msg)
             raise
 
+    def makeSession(self):
+        """Build the pooled, keep-alive http session shared by every route.
+
+        urllib3 only retries connection errors, responses from SD are
+        retried by callApi which understands the SD response codes.
+        """
+        try:
+            retry = Retry(
+                total=self.retries,
+                connect=self.retries,
+                read=0,
+                status=0,
+                backoff_factor=self.backoff,
+                allowed_methods=["GET", "POST", "PUT"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=self.poolsize,
+                pool_maxsize=self.poolsize,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            return session
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def connectionStats(self):
+        """Count the requests made and connections opened by the session pool.
+
+        Returns:
+            dict: requests, connections and reused counts
+        """
+        try:
+            nreq = nconn = 0
+            for adapter in set(self.session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    nreq += pool.num_requests
+                    nconn += pool.num_connections
+            return {
+                "requests": nreq,
+                "connections": nconn,
+                "reused": max(0, nreq - nconn),
+            }
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def close(self):
+        """Log the request metrics and connection reuse, close the session pool."""
+        try:
+            self.metrics.logSummary()
+            stats = self.connectionStats()
+            log.info(
+                f"""SDApi made {stats["requests"]} requests over """
+                f"""{stats["connections"]} connections ({stats["reused"]} reused)"""
+            )
+            self.session.close()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
     def showResponse(self, jresp, force=False):
         """Pretty print json responses."""
         try:
@@ -120,7 +257,7 @@ class SDApi:
         def callFunc(*args, **kwargs):
             res = None
             try:
-                res = func(*args, **kwargs)
+                res = self.callApi(lambda: func(*args, **kwargs), func.__name__)
             except Exception as e:
                 log.error(f"{type(e).__name__} Exception in {func.__name__}:\n{e}")
                 raise
@@ -138,33 +275,273 @@ class SDApi:
 
         return callFunc
 
+    # Decorator function to stream the API response
+    def apiStream(self, func):
+        """Call the API, handle any errors, return an iterator of the JSON array.
+
+        The response body is parsed as it arrives, one array element at a time.
+        The request's throttle slot is held until the body has been read, so
+        the iterator must be read, or closed, straight away.
+        """
+
+        def callFunc(*args, **kwargs):
+            res = None
+            try:
+                res = self.callApi(
+                    lambda: func(*args, **kwargs), func.__name__, hold=True
+                )
+                res.raise_for_status()
+            except Exception as e:
+                log.error(f"{type(e).__name__} Exception in {func.__name__}:\n{e}")
+                if res is not None:
+                    res.close()
+                raise
+            return self.iterResponse(res, func.__name__)
+
+        return callFunc
+
+    def callApi(self, func, funcname, hold=False):
+        """Make the request in func, retrying it while SD says to try again.
+
+        Throttled responses (http 429/503, SD offline or queued) shrink the
+        number of requests in flight, server errors are retried after a
+        jittered exponential backoff and an expired token is renewed. The
+        last response is returned, successful or not, once the retries are
+        used up or the error is not one that a retry would fix. A request
+        that times out, or loses its connection, is retried like a server
+        error (urllib3 reports a read timeout as a connection error).
+
+        With hold the throttle slot of a successful response is kept for the
+        caller to release once it has read the body.
+        """
+        attempt = 0
+        while True:
+            token = self.token
+            self.throttle.acquire()
+            outcome = FATAL
+            try:
+                res = func()
+                outcome = classify(res.status_code, self.responseCode(res))
+            except (requests.Timeout, requests.ConnectionError) as e:
+                outcome = RETRY
+                if attempt >= self.retries:
+                    raise
+                res = None
+                timedout = e
+            finally:
+                if not (hold and outcome == OK):
+                    self.throttle.release(outcome)
+            if outcome in (OK, FATAL) or attempt >= self.retries:
+                return res
+            attempt += 1
+            if res is None:
+                route = funcname
+                if timedout.request is not None:
+                    route = self.routeOf(timedout.request)
+                self.metrics.retry(route, outcome)
+                log.warning(
+                    f"{funcname}: {timedout}, retry {attempt} of {self.retries}"
+                )
+                self.throttle.wait(attempt - 1)
+                continue
+            self.metrics.retry(self.routeOf(res), outcome)
+            log.warning(
+                f"{funcname}: http {res.status_code}: {outcome}, "
+                f"retry {attempt} of {self.retries}"
+            )
+            retryafter = res.headers.get("Retry-After")
+            res.close()
+            if outcome == TOKEN:
+                self.renewToken(token)
+            else:
+                self.throttle.wait(attempt - 1, retryafter)
+
+    def responseCode(self, res):
+        """Returns the SD code from the body of an error response, or None."""
+        if res.status_code < 400:
+            return None
+        try:
+            return int(res.json()["code"])
+        except Exception:
+            return None
+
+    def renewToken(self, expired):
+        """Replace the expired token, unless another thread already has."""
+        try:
+            with self.tokenlock:
+                if self.token == expired:
+                    log.info("token has expired, asking for a new one")
+                    self.metrics.tokenRenewal()
+                    self.apiToken()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def iterResponse(self, res, funcname):
+        """Yield each element of a streamed JSON array response.
+
+        The throttle slot held for the response is released when the body has
+        been read, or the reading stops.
+        """
+        # seconds spent waiting for the body and bytes received
+        tally = [0.0, 0]
+        outcome = OK
+        try:
+            chunks = self.timedChunks(res.iter_content(chunk_size=65536), tally)
+            for obj in iterJsonArray(chunks):
+                self.showResponse(obj)
+                yield obj
+        except Exception as e:
+            log.error(
+                f"Reading json response: {type(e).__name__} Exception in {funcname}:\n{e}"
+            )
+            outcome = FATAL
+            raise
+        finally:
+            self.throttle.release(outcome)
+            res.close()
+            nbytes = res.headers.get("Content-Length", tally[1])
+            self.metrics.observeBody(self.routeOf(res), tally[0], int(nbytes))
+
+    def timedChunks(self, chunks, tally):
+        """Yield the chunks, adding the time spent waiting for them to the tally."""
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            tally[0] += time.perf_counter() - start
+            if chunk is None:
+                return
+            tally[1] += len(chunk)
+            yield chunk
+
     # Decorator function to call the SD API with token
     def apiTokenRequired(self, func):
-        """Set the "token" header, call the api then remove the header."""
+        """Send the "token" header with the calls made by this thread."""
+        return self.tokenWrapper(func, self.apiNoToken)
+
+    # Decorator function to stream the SD API response with token
+    def apiTokenStream(self, func):
+        """Send the "token" header and stream the response."""
+        return self.tokenWrapper(func, self.apiStream)
+
+    def tokenWrapper(self, func, apicall):
+        """Wrap func in apicall, sending the token header from this thread."""
 
         def callFunc(*args, **kwargs):
-            if not self.token or self.tokenexpires < time.time():
-                self.apiToken()
-            self.headers["token"] = self.token
+            self.checkToken()
 
-            @self.apiNoToken
+            @apicall
+            @functools.wraps(func)
             def callAPI():
                 return func(*args, **kwargs)
 
-            jresp = callAPI()
-            del self.headers["token"]
+            self.local.usetoken = True
+            try:
+                jresp = callAPI()
+            finally:
+                self.local.usetoken = False
             return jresp
 
         return callFunc
 
-    def apiPost(self, route, postdict):
+    def checkToken(self):
+        """Obtain a new token if needed, only one thread will ever ask for it."""
+        try:
+            if not self.token or self.tokenexpires < time.time():
+                with self.tokenlock:
+                    if not self.token or self.tokenexpires < time.time():
+                        self.apiToken()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def requestHeaders(self):
+        """Returns the headers for a request, with the token if it is required."""
+        try:
+            headers = dict(self.headers)
+            if getattr(self.local, "usetoken", False):
+                headers["token"] = self.token
+            return headers
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def routeOf(self, res):
+        """Returns the SD route that a response, or a request, is for."""
+        url = res.url.split("?")[0]
+        if url.startswith(f"{self.url}/"):
+            return url[len(self.url) + 1 :]
+        return url
+
+    def logRequest(self, method, url, headers, params):
+        """Log a request at debug level without the token or password."""
+        xheaders = dict(headers)
+        if "token" in xheaders:
+            xheaders["token"] = "<redacted>"
+        if isinstance(params, dict) and "password" in params:
+            params = dict(params, password="<redacted>")
+        log.debug(f"{method} request to {url}, headers: {xheaders}, params: {params}")
+
+    def timedRequest(self, route, func, stream=False):
+        """Make the request in func, recording its time, status and bytes.
+
+        The bytes of a streamed response are recorded as its body is read.
+        """
+        start = time.perf_counter()
+        try:
+            res = func()
+        except Exception:
+            self.metrics.observe(route, "error", time.perf_counter() - start)
+            raise
+        seconds = time.perf_counter() - start
+        nbytes = 0
+        if not stream:
+            nbytes = int(res.headers.get("Content-Length", len(res.content)))
+        self.metrics.observe(route, res.status_code, seconds, nbytes)
+        return res
+
+    def countRequest(self):
+        """Count a request made to SD, for the daily request budget."""
+        with self.countlock:
+            self.requestcount += 1
+
+    def apiPost(self, route, postdict, stream=False):
         """Post data to the SD API."""
         try:
             url = f"{self.url}/{route}"
-            log.debug(
-                f"POST request to {url}, headers: {self.headers}, params: {postdict}"
+            headers = self.requestHeaders()
+            self.countRequest()
+            self.logRequest("POST", url, headers, postdict)
+            return self.timedRequest(
+                route,
+                lambda: self.session.post(
+                    url,
+                    headers=headers,
+                    data=json.dumps(postdict),
+                    stream=stream,
+                    timeout=self.timeout,
+                ),
+                stream,
             )
-            return requests.post(url, headers=self.headers, data=json.dumps(postdict))
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -179,10 +556,15 @@ class SDApi:
         """Get data from the SD API."""
         try:
             url = f"{self.url}/{route}"
-            log.debug(
-                f"GET request to {url}, headers: {self.headers}, params: {querydict}"
+            headers = self.requestHeaders()
+            self.countRequest()
+            self.logRequest("GET", url, headers, querydict)
+            return self.timedRequest(
+                route,
+                lambda: self.session.get(
+                    url, headers=headers, params=querydict, timeout=self.timeout
+                ),
             )
-            return requests.get(url, headers=self.headers, params=querydict)
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -197,10 +579,15 @@ class SDApi:
         """Put data to the SD API."""
         try:
             url = f"{self.url}/{route}"
-            log.debug(
-                f"PUT request to {url}, headers: {self.headers}, params: {querydict}"
+            headers = self.requestHeaders()
+            self.countRequest()
+            self.logRequest("PUT", url, headers, querydict)
+            return self.timedRequest(
+                route,
+                lambda: self.session.put(
+                    url, headers=headers, params=querydict, timeout=self.timeout
+                ),
             )
-            return requests.put(url, headers=self.headers, params=querydict)
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -223,6 +610,7 @@ class SDApi:
             if code == 0:
                 self.token = jres["token"]
                 self.tokenexpires = self.getTimeStamp(jres["datetime"]) + (3600 * 23)
+                self.metrics.token()
                 log.debug("Token obtained")
             else:
                 msg = f"code: {code}: "
@@ -255,6 +643,55 @@ class SDApi:
             if "lineups" in xstatus:
                 self.lineups = xstatus["lineups"]
                 # self.showResponse(xstatus["lineups"], force=True)
+            self.statustime = time.time()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def statusCache(self):
+        """Returns the token and API status as a dict for the status cache."""
+        return {
+            "username": self.username,
+            "token": self.token,
+            "tokenexpires": self.tokenexpires,
+            "online": self.online,
+            "statusmsg": self.statusmsg,
+            "lineups": self.lineups,
+            "statustime": self.statustime,
+        }
+
+    def loadStatusCache(self, status, ttl):
+        """Restore the token and API status from the status cache.
+
+        A cached token is used if it outlives the current one. The cached
+        status is only used if it is younger than ttl seconds.
+
+        Returns:
+            bool: True if the cached status can be used in place of apiOnline
+        """
+        try:
+            if status.get("username") != self.username:
+                return False
+            if status.get("token") and status["tokenexpires"] > self.tokenexpires:
+                self.token = status["token"]
+                self.tokenexpires = status["tokenexpires"]
+            statustime = status.get("statustime", 0)
+            if not status.get("online") or statustime + ttl < time.time():
+                return False
+            self.online = True
+            self.statusmsg = status["statusmsg"]
+            self.lineups = status["lineups"]
+            self.statustime = statustime
+            log.debug(
+                f"using the cached status from {int(time.time() - statustime)}s ago"
+            )
+            return True
         except Exception as e:
             exci = sys.exc_info()[2]
             lineno = exci.tb_lineno
@@ -384,3 +821,367 @@ class SDApi:
             # print(msg)
             log.error(msg)
             raise
+
+    def makeBatches(self, items, size):
+        """Split the list of items into lists of at most size items.
+
+        When fetching concurrently the items are spread over at least
+        concurrency batches so that every worker has something to do.
+        """
+        try:
+            if self.concurrency > 1:
+                size = min(size, max(1, -(-len(items) // self.concurrency)))
+            return [items[i : i + size] for i in range(0, len(items), size)]
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def fetchBatches(self, func, batches):
+        """Call func for each batch, up to concurrency calls at a time.
+
+        Returns:
+            list: the results of func, in the same order as the batches
+        """
+        try:
+            if self.concurrency == 1 or len(batches) < 2:
+                return [func(batch) for batch in batches]
+            nworkers = min(self.concurrency, len(batches))
+            with ThreadPoolExecutor(max_workers=nworkers) as pool:
+                return list(pool.map(func, batches))
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def getScheduleMd5s(self, stationids, dates=None):
+        """Retrieve the per station, per day schedule MD5s from SD.
+
+        Args:
+            stationids: list: station ids to retrieve the MD5s for
+            dates: list: "YYYY-MM-DD" dates to restrict to, default: all available
+
+        Returns:
+            dict: stationid: {date: md5}, days that returned an error are omitted
+        """
+        try:
+            reqs = []
+            for sid in stationids:
+                req = {"stationID": sid}
+                if dates is not None:
+                    req["date"] = list(dates)
+                reqs.append(req)
+            md5s = {}
+            batches = self.makeBatches(reqs, self.schedulebatch)
+            for jresp in self.fetchBatches(self.scheduleMd5Batch, batches):
+                for sid in jresp:
+                    for date in jresp[sid]:
+                        xday = jresp[sid][date]
+                        if int(xday.get("code", 0)) == 0:
+                            md5s.setdefault(sid, {})[date] = xday["md5"]
+            return md5s
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def scheduleMd5Batch(self, batch):
+        """Request the schedule md5s for one batch of stations."""
+        try:
+
+            @self.apiTokenRequired
+            def sdschedulemd5():
+                return self.apiPost("schedules/md5", batch)
+
+            return sdschedulemd5()
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def getSchedules(self, stationids, dates=None, sdc=None, merge=False):
+        """Retrieve station schedules from SD in server maximum sized batches.
+
+        Each station's schedule is written to the cache as soon as its batch
+        has been received, rather than after the whole lineup has arrived.
+
+        Args:
+            stationids: list: station ids, or dict of stationid: list of dates
+            dates: list: "YYYY-MM-DD" dates for every station, default: all available
+            sdc: SDCache: cache to write each station's schedule into
+            merge: bool: merge the days into the cached schedule, default: replace it
+
+        Returns:
+            dict: programID: md5 for every airing in the received schedules
+        """
+        try:
+            reqs = []
+            for sid in stationids:
+                req = {"stationID": sid}
+                if isinstance(stationids, dict):
+                    req["date"] = list(stationids[sid])
+                elif dates is not None:
+                    req["date"] = list(dates)
+                reqs.append(req)
+            progs = {}
+            batches = self.makeBatches(reqs, self.schedulebatch)
+            for xprogs in self.fetchBatches(
+                lambda batch: self.scheduleBatch(batch, sdc, merge), batches
+            ):
+                progs.update(xprogs)
+            return progs
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def scheduleBatch(self, batch, sdc=None, merge=False, attempt=0):
+        """Request one batch of schedules, halving it if the server refuses the size.
+
+        Stations whose schedules SD has queued are asked for again after a
+        backoff, up to retries times.
+        """
+        try:
+
+            if self.stream:
+
+                @self.apiTokenStream
+                def sdschedules():
+                    return self.apiPost("schedules", batch, stream=True)
+
+            else:
+
+                @self.apiTokenRequired
+                def sdschedules():
+                    return self.apiPost("schedules", batch)
+
+            try:
+                jresp = sdschedules()
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 413:
+                    if len(batch) > 1:
+                        half = len(batch) // 2
+                        log.info(f"schedule batch of {len(batch)} too large, splitting")
+                        progs = self.scheduleBatch(batch[:half], sdc, merge)
+                        progs.update(self.scheduleBatch(batch[half:], sdc, merge))
+                        return progs
+                raise
+            queued = set()
+            try:
+                progs = self.parseSchedules(jresp, sdc, merge, queued)
+            finally:
+                # a streamed response holds its throttle slot until it is closed
+                if self.stream:
+                    jresp.close()
+            if sdc is not None:
+                sdc.flush()
+            if len(queued) > 0:
+                retry = [x for x in batch if x["stationID"] in queued]
+                if attempt < self.retries:
+                    log.info(f"{len(retry)} schedules queued by SD, retrying")
+                    self.throttle.wait(attempt)
+                    progs.update(self.scheduleBatch(retry, sdc, True, attempt + 1))
+                else:
+                    log.warning(f"{len(retry)} schedules still queued by SD")
+            return progs
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def parseSchedules(self, jresp, sdc=None, merge=False, queued=None):
+        """Group the schedule days by station, write them to the cache.
+
+        SD returns a station's days together, so each station is written as
+        soon as the next station's days start and only one station's schedule
+        is held in memory at a time.
+
+        Returns:
+            dict: programID: md5 for every airing in the schedules, the
+                stations SD has queued are added to the queued set
+        """
+        try:
+            progs = {}
+            written = set()
+            sid = None
+            days = []
+            for day in jresp:
+                if "code" in day and int(day["code"]) == SCHEDULE_QUEUED:
+                    if queued is not None:
+                        queued.add(day["stationID"])
+                    continue
+                if "code" in day and int(day["code"]) != 0:
+                    log.warning(
+                        f"""schedule for {day.get("stationID")}: code {day["code"]}: """
+                        f"""{day.get("response")}"""
+                    )
+                    continue
+                for prog in day.get("programs", []):
+                    progs[prog["programID"]] = prog["md5"]
+                if day["stationID"] != sid:
+                    self.flushSchedule(sdc, sid, days, merge or sid in written)
+                    written.add(sid)
+                    sid = day["stationID"]
+                    days = []
+                days.append(day)
+            self.flushSchedule(sdc, sid, days, merge or sid in written)
+            return progs
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def flushSchedule(self, sdc, sid, days, merge):
+        """Write one station's schedule days to the cache."""
+        try:
+            if sdc is not None and len(days) > 0:
+                if merge:
+                    sdc.updateChannelScheduleCache(sid, days)
+                else:
+                    sdc.writeChannelScheduleToCache(sid, days)
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def getPrograms(self, programids, sdc=None):
+        """Retrieve program metadata from SD in server maximum sized batches.
+
+        Args:
+            programids: list: the program ids to retrieve
+            sdc: SDCache: cache to write each program into
+
+        Returns:
+            list: the program ids that were received
+        """
+        try:
+            received = []
+            batches = self.makeBatches(list(programids), self.programbatch)
+            for xreceived in self.fetchBatches(
+                lambda batch: self.programBatch(batch, sdc), batches
+            ):
+                received.extend(xreceived)
+            return received
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
+
+    def programBatch(self, batch, sdc=None, attempt=0):
+        """Request one batch of programs, halving it if the server refuses the size.
+
+        Each program is written to the cache. Programs that SD has queued
+        are asked for again after a backoff, up to retries times.
+
+        Returns:
+            list: the program ids that were received
+        """
+        try:
+
+            if self.stream:
+
+                @self.apiTokenStream
+                def sdprograms():
+                    return self.apiPost("programs", batch, stream=True)
+
+            else:
+
+                @self.apiTokenRequired
+                def sdprograms():
+                    return self.apiPost("programs", batch)
+
+            try:
+                jresp = sdprograms()
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 413:
+                    if len(batch) > 1:
+                        half = len(batch) // 2
+                        log.info(f"program batch of {len(batch)} too large, splitting")
+                        received = self.programBatch(batch[:half], sdc)
+                        received.extend(self.programBatch(batch[half:], sdc))
+                        return received
+                raise
+            received = []
+            queued = []
+            try:
+                for prog in jresp:
+                    if "code" in prog and int(prog["code"]) == PROGRAM_QUEUED:
+                        queued.append(prog["programID"])
+                        continue
+                    if "code" in prog and int(prog["code"]) != 0:
+                        log.warning(
+                            f"""program {prog.get("programID")}: code {prog["code"]}: """
+                            f"""{prog.get("response")}"""
+                        )
+                        continue
+                    if sdc is not None:
+                        sdc.writeProgramToCache(prog)
+                    received.append(prog["programID"])
+            finally:
+                # a streamed response holds its throttle slot until it is closed
+                if self.stream:
+                    jresp.close()
+            if sdc is not None:
+                sdc.flush()
+            if len(queued) > 0:
+                if attempt < self.retries:
+                    log.info(f"{len(queued)} programs queued by SD, retrying")
+                    self.throttle.wait(attempt)
+                    received.extend(self.programBatch(queued, sdc, attempt + 1))
+                else:
+                    log.warning(f"{len(queued)} programs still queued by SD")
+            return received
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            # print(msg)
+            log.error(msg)
+            raise
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""Adaptive request concurrency and backoff for the SD API.
+
+SDThrottle limits the requests in flight with an additive increase,
+multiplicative decrease (AIMD) window: every successful request grows the
+window by 1/window, so it grows by one after a window's worth of successes,
+and every throttled request halves it. Throttled and failed requests are
+retried after an exponential backoff with full jitter, and a throttle
+response with a Retry-After header pauses every worker, not just the one
+that received it.
+"""
+
+import random
+import sys
+import threading
+import time
+
+import ccalogging
+
+log = ccalogging.log
+
+# SD response codes
+SERVICE_OFFLINE = 3000
+TOKEN_EXPIRED = 4006
+PROGRAM_QUEUED = 6001
+SCHEDULE_QUEUED = 7100
+
+# outcomes of a request
+OK = "ok"
+RETRY = "retry"
+THROTTLED = "throttled"
+TOKEN = "token"
+FATAL = "fatal"
+
+
+def classify(status, code=None):
+    """Returns the outcome of a response from its http status and SD code.
+
+    Args:
+        status: int: the http status code
+        code: int: the SD "code" from the response body, if there was one
+    """
+    if code == TOKEN_EXPIRED:
+        return TOKEN
+    if code in (SERVICE_OFFLINE, PROGRAM_QUEUED, SCHEDULE_QUEUED):
+        return THROTTLED
+    if status < 400:
+        return OK
+    if status in (429, 503):
+        return THROTTLED
+    if status >= 500:
+        return RETRY
+    return FATAL
+
+
+class SDThrottle:
+    def __init__(self, maxinflight=1, mininflight=1, backoff=0.5, maxbackoff=60):
+        """Initialise the throttle.
+
+        Args:
+            maxinflight: int: the most requests to allow in flight, the window
+                starts here and never grows beyond it
+            mininflight: int: the window never shrinks below this, default: 1
+            backoff: float: base delay in seconds for the first retry, default: 0.5
+            maxbackoff: float: longest delay between retries, default: 60
+        """
+        try:
+            self.maxinflight = max(1, maxinflight)
+            self.mininflight = max(1, min(mininflight, self.maxinflight))
+            self.window = float(self.maxinflight)
+            self.backoff = backoff
+            self.maxbackoff = maxbackoff
+            self.inflight = 0
+            self.pauseuntil = 0
+            self.cond = threading.Condition()
+            self.stats = {OK: 0, RETRY: 0, THROTTLED: 0, TOKEN: 0, FATAL: 0}
+        except Exception as e:
+            exci = sys.exc_info()[2]
+            lineno = exci.tb_lineno
+            fname = exci.tb_frame.f_code.co_name
+            ename = type(e).__name__
+            msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+            log.error(msg)
+            raise
+
+    def acquire(self):
+        """Wait for a slot in the window and for any pause to end."""
+        with self.cond:
+            while True:
+                wait = self.pauseuntil - time.time()
+                if wait <= 0 and self.inflight < int(self.window):
+                    self.inflight += 1
+                    return
+                self.cond.wait(wait if wait > 0 else None)
+
+    def release(self, outcome):
+        """Free the request's slot and adjust the window for its outcome."""
+        with self.cond:
+            self.inflight -= 1
+            self.stats[outcome] += 1
+            if outcome == OK:
+                self.window = min(self.maxinflight, self.window + 1 / self.window)
+            elif outcome == THROTTLED:
+                window = max(self.mininflight, self.window / 2)
+                if int(window) != int(self.window):
+                    log.info(f"throttled, in flight requests cut to {int(window)}")
+                self.window = window
+            self.cond.notify_all()
+
+    def delay(self, attempt):
+        """Returns the jittered delay before retry number attempt (from 0)."""
+        cap = min(self.maxbackoff, self.backoff * (2**attempt))
+        return random.uniform(0, cap)
+
+    def pause(self, seconds):
+        """Hold back every request for seconds, e.g. from a Retry-After header."""
+        with self.cond:
+            self.pauseuntil = max(self.pauseuntil, time.time() + seconds)
+            self.cond.notify_all()
+
+    def wait(self, attempt, retryafter=None):
+        """Sleep before retry number attempt, honouring a Retry-After value."""
+        try:
+            seconds = self.delay(attempt)
+            if retryafter is not None:
+                seconds = max(seconds, min(float(retryafter), self.maxbackoff))
+                self.pause(seconds)
+            log.debug(f"retrying in {seconds:.2f}s")
+            time.sleep(seconds)
+        except ValueError:
+            # Retry-After can also be an http date, fall back to the backoff
+            time.sleep(self.delay(attempt))
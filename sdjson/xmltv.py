@@ -0,0 +1,498 @@
+#
+# Copyright (c) 2021, Christopher Allison
+#
+#     This file is part of ccasdtv.
+#
+#     ccasdtv is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     ccasdtv is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with ccasdtv.  If not, see <http://www.gnu.org/licenses/>.
+"""XMLTV export from the ccasdtv cache.
+
+The export is a pipeline of generators: the channels come from the cached
+lineups, the airings of each station in turn from its schedule.bin and each
+airing is joined to its cached program as it is written. Only one station's
+airings in the window and one program are held in memory at a time.
+
+The guide can also be kept as per-station fragment files, of which only
+the stations that the cache journal says have changed since the last
+export are regenerated, and then concatenated into the one guide. Without
+the journal every fragment is regenerated.
+"""
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+import ccalogging
+
+log = ccalogging.log
+
+XMLTVTIME = "%Y%m%d%H%M%S +0000"
+XMLTVHEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<!DOCTYPE tv SYSTEM "xmltv.dtd">\n'
+    '<tv source-info-name="Schedules Direct" generator-info-name="ccasdtv">\n'
+)
+XMLTVFOOTER = "</tv>\n"
+
+
+def channelId(stationid):
+    return f"I{stationid}.json.schedulesdirect.org"
+
+
+def xmltvTime(epoch):
+    return time.strftime(XMLTVTIME, time.gmtime(epoch))
+
+
+def element(name, text, **attrs):
+    """Returns one xml element with escaped text, "" if there is no text."""
+    if text is None or text == "":
+        return ""
+    xattrs = "".join([f" {k}={quoteattr(str(v))}" for k, v in attrs.items()])
+    return f"    <{name}{xattrs}>{escape(str(text))}</{name}>\n"
+
+
+def channelSortKey(chan):
+    """Sorts channel numbers numerically, including major.minor numbers."""
+    parts = str(chan.get("channelnumber", "")).replace("-", ".").split(".")
+    return ([int(x) if x.isdigit() else 0 for x in parts], chan["stationID"])
+
+
+def ddProgid(programid):
+    """Returns the programID in the dd_progid form, EP01234567.0001."""
+    if len(programid) == 14:
+        return f"{programid[:10]}.{programid[10:]}"
+    return programid
+
+
+def iterChannels(sdc, lineupids, stations=None):
+    """Yield each station of the cached lineups once, in channel number order.
+
+    Args:
+        sdc: SDCache: the cache
+        lineupids: list: the lineups to export
+        stations: set: station ids to restrict to, default: all
+    """
+    try:
+        seen = set()
+        for lineupid in lineupids:
+            ldata = sdc.readLineupData(lineupid)
+            if ldata is None:
+                log.warning(f"lineup {lineupid} is not cached")
+                continue
+            chans = list(ldata["channelsbyid"].values())
+            chans.sort(key=channelSortKey)
+            for chan in chans:
+                sid = chan["stationID"]
+                if sid in seen or (stations is not None and sid not in stations):
+                    continue
+                seen.add(sid)
+                yield chan
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def iterAirings(sdc, stationids, start, end):
+    """Yield the airings of each station in the window, station by station."""
+    try:
+        for sid in stationids:
+            reader = sdc.openScheduleReader(sid)
+            if reader is None:
+                continue
+            try:
+                yield from reader.airingsBetween(start, end)
+            finally:
+                reader.close()
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def iterProgrammes(sdc, airings, cachesize=4096):
+    """Yield (airing, body) pairs, body is the programme xml of its program.
+
+    Programs repeat across stations and days, so the bodies of the most
+    recently used cachesize programs are kept rather than reading and
+    rendering the program again for every airing.
+    """
+    try:
+        bodies = OrderedDict()
+        for airing in airings:
+            key = (airing["programID"], airing["md5"])
+            body = bodies.get(key)
+            if body is None:
+                prog = sdc.readProgramFromCache(airing["md5"])
+                body = programmeBody(airing["programID"], prog)
+                bodies[key] = body
+                if len(bodies) > cachesize:
+                    bodies.popitem(last=False)
+            else:
+                bodies.move_to_end(key)
+            yield (airing, body)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def channelXml(chan):
+    """Returns the <channel> element for a lineup station."""
+    try:
+        lines = [f"""  <channel id={quoteattr(channelId(chan["stationID"]))}>\n"""]
+        if "channelnumber" in chan:
+            lines.append(
+                element(
+                    "display-name",
+                    f"""{chan["channelnumber"]} {chan.get("callsign", "")}""".strip(),
+                )
+            )
+        lines.append(element("display-name", chan.get("name")))
+        lines.append(element("display-name", chan.get("callsign")))
+        logo = chan.get("stationLogo", [chan.get("logo")])
+        if logo and logo[0] is not None and "URL" in logo[0]:
+            lines.append(f"""    <icon src={quoteattr(logo[0]["URL"])}/>\n""")
+        lines.append("  </channel>\n")
+        return "".join(lines)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def programmeXml(airing, body):
+    """Returns the <programme> element for an airing and its programme body."""
+    start = airing["airtime"]
+    stop = start + airing["duration"]
+    return (
+        f"""  <programme start="{xmltvTime(start)}" stop="{xmltvTime(stop)}" """
+        f"""channel="{channelId(airing["stationID"])}">\n{body}  </programme>\n"""
+    )
+
+
+def programmeBody(programid, prog):
+    """Returns the elements inside <programme> for a cached program.
+
+    Args:
+        programid: str: the SD programID
+        prog: dict: the cached program, or None if it is not cached
+    """
+    try:
+        lines = []
+        prog = prog or {}
+        titles = prog.get("titles") or [{}]
+        lines.append(element("title", titles[0].get("title120", programid), lang="en"))
+        lines.append(element("sub-title", prog.get("episodeTitle150"), lang="en"))
+        descs = prog.get("descriptions", {})
+        for key in ("description1000", "description100"):
+            if key in descs and len(descs[key]) > 0:
+                lines.append(
+                    element("desc", descs[key][0].get("description"), lang="en")
+                )
+                break
+        credits = []
+        for person in prog.get("crew", []):
+            if person.get("role") == "Director":
+                credits.append(element("director", person.get("name")))
+        for person in prog.get("cast", []):
+            credits.append(element("actor", person.get("name")))
+        credits = [x for x in credits if x != ""]
+        if len(credits) > 0:
+            lines.append("    <credits>\n")
+            lines.extend(["  " + x for x in credits])
+            lines.append("    </credits>\n")
+        if "movie" in prog and "year" in prog["movie"]:
+            lines.append(element("date", prog["movie"]["year"]))
+        elif "originalAirDate" in prog:
+            lines.append(element("date", prog["originalAirDate"].replace("-", "")))
+        for genre in prog.get("genres", []):
+            lines.append(element("category", genre, lang="en"))
+        lines.append(element("episode-num", ddProgid(programid), system="dd_progid"))
+        for meta in prog.get("metadata", []):
+            gn = meta.get("Gracenote")
+            if gn is not None and "season" in gn:
+                season = int(gn["season"]) - 1
+                episode = int(gn["episode"]) - 1 if "episode" in gn else ""
+                lines.append(
+                    element("episode-num", f"{season}.{episode}.", system="xmltv_ns")
+                )
+                break
+        return "".join(lines)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def iterXmltv(sdc, lineupids, start, end, stations=None):
+    """Yield the XMLTV document for the window as a series of strings."""
+    try:
+        yield XMLTVHEADER
+        stationids = []
+        for chan in iterChannels(sdc, lineupids, stations):
+            stationids.append(chan["stationID"])
+            yield channelXml(chan)
+        airings = iterAirings(sdc, stationids, start, end)
+        for airing, body in iterProgrammes(sdc, airings):
+            yield programmeXml(airing, body)
+        yield XMLTVFOOTER
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def writeXmltv(out, sdc, lineupids, start, end, stations=None):
+    """Stream the XMLTV document to the text file out.
+
+    Returns:
+        int: the number of programmes written
+    """
+    try:
+        count = 0
+        for chunk in iterXmltv(sdc, lineupids, start, end, stations):
+            if chunk.startswith("  <programme"):
+                count += 1
+            out.write(chunk)
+        return count
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def fragmentFileNames(fragdir, stationid):
+    """Returns the (channel, programmes) fragment files of a station."""
+    return (
+        fragdir.joinpath(f"I{stationid}.channel.xml"),
+        fragdir.joinpath(f"I{stationid}.programmes.xml"),
+    )
+
+
+def writeText(filename, chunks):
+    """Write the chunks to filename via a temporary file.
+
+    Returns:
+        int: the number of programme chunks written
+    """
+    try:
+        count = 0
+        tmpfn = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+        with open(tmpfn, "w", encoding="utf-8") as ofn:
+            for chunk in chunks:
+                if chunk.startswith("  <programme"):
+                    count += 1
+                ofn.write(chunk)
+        os.replace(tmpfn, filename)
+        return count
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def readManifest(fragdir):
+    """Returns the fragment manifest from fragdir, None if there isn't one."""
+    manifestfn = fragdir.joinpath("manifest.json")
+    if not manifestfn.exists():
+        return None
+    with open(manifestfn, "r", encoding="utf-8") as ifn:
+        return json.load(ifn)
+
+
+def changedStations(sdc, changes, stationids, start, end):
+    """Returns the station ids whose fragments the journal changes affect.
+
+    A station is affected if its channel data changed, a changed schedule
+    day falls in the window, or one of its airings in the window is of a
+    changed program.
+    """
+    try:
+        first = datetime.datetime.utcfromtimestamp(start).date().isoformat()
+        last = datetime.datetime.utcfromtimestamp(end).date().isoformat()
+        changed = set()
+        for sid in stationids:
+            dates = changes["stations"].get(sid)
+            if dates is None:
+                continue
+            if len(dates) == 0 or any([first <= x <= last for x in dates]):
+                changed.add(sid)
+        if len(changes["programs"]) > 0:
+            rest = [x for x in stationids if x not in changed]
+            for airing in iterAirings(sdc, rest, start, end):
+                if airing["md5"] in changes["programs"]:
+                    changed.add(airing["stationID"])
+        return changed
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def writeFragments(sdc, lineupids, fragdir, start, end, stations=None):
+    """Bring the per-station fragments in fragdir up to date.
+
+    fragdir holds an I<stationid>.channel.xml and I<stationid>.programmes.xml
+    for each station and a manifest.json of the window and the stations in
+    channel order. Only the fragments of stations that have changed since
+    the last export are regenerated, unless the window has moved, which
+    changes every station's programmes.
+
+    Args:
+        sdc: SDCache: the cache, its journal, if on, records what has changed
+        lineupids: list: the lineups to export
+        fragdir: Path: the fragment directory
+        start: int: epoch start of the window
+        end: int: epoch end of the window
+        stations: set: station ids to restrict to, default: all
+
+    Returns:
+        dict: "stations" all the station ids in channel order, "written"
+            the station ids regenerated and "programmes" the programmes
+            written
+    """
+    try:
+        fragdir.mkdir(parents=True, exist_ok=True)
+        manifestfn = fragdir.joinpath("manifest.json")
+        manifest = readManifest(fragdir) or {}
+        if sdc.journal is None:
+            log.info("the cache journal is off (cachejournal), regenerating all")
+            changes = {"all": True}
+        else:
+            changes = sdc.journal.consume()
+        # if this export fails part way through, the changes it has consumed
+        # are lost, so the next export must regenerate everything
+        if manifestfn.exists():
+            manifestfn.unlink()
+        chans = list(iterChannels(sdc, lineupids, stations))
+        stationids = [x["stationID"] for x in chans]
+        if manifest.get("start") != start or manifest.get("end") != end:
+            log.info("xmltv window has moved, regenerating all fragments")
+            todo = set(stationids)
+        elif changes["all"]:
+            todo = set(stationids)
+        else:
+            todo = changedStations(sdc, changes, stationids, start, end)
+            for sid in stationids:
+                if not all([x.exists() for x in fragmentFileNames(fragdir, sid)]):
+                    todo.add(sid)
+        count = 0
+        for chan in chans:
+            sid = chan["stationID"]
+            if sid not in todo:
+                continue
+            chanfn, progfn = fragmentFileNames(fragdir, sid)
+            writeText(chanfn, [channelXml(chan)])
+            airings = iterAirings(sdc, [sid], start, end)
+            count += writeText(
+                progfn,
+                (programmeXml(a, b) for a, b in iterProgrammes(sdc, airings)),
+            )
+        keep = set(stationids)
+        for sid in manifest.get("stations", []):
+            if sid not in keep:
+                for fn in fragmentFileNames(fragdir, sid):
+                    if fn.exists():
+                        fn.unlink()
+        writeText(
+            manifestfn,
+            [json.dumps({"start": start, "end": end, "stations": stationids})],
+        )
+        log.info(
+            f"{len(todo)} of {len(stationids)} xmltv fragments regenerated, "
+            f"{count} programmes"
+        )
+        return {"stations": stationids, "written": todo, "programmes": count}
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
+
+
+def concatFragments(fragdir, out):
+    """Copy the fragments in fragdir into the one XMLTV document, out.
+
+    The fragments are copied as they are, in the manifest's channel order,
+    so this costs no more than copying the files.
+
+    Args:
+        fragdir: Path: the fragment directory
+        out: file: text file to write to
+    """
+    try:
+        manifest = readManifest(fragdir)
+        if manifest is None:
+            raise Exception(f"there is no xmltv fragment manifest in {fragdir}")
+        stationids = manifest["stations"]
+        out.write(XMLTVHEADER)
+        for i in (0, 1):
+            for sid in stationids:
+                fn = fragmentFileNames(fragdir, sid)[i]
+                with open(fn, "r", encoding="utf-8") as ifn:
+                    shutil.copyfileobj(ifn, out)
+        out.write(XMLTVFOOTER)
+    except Exception as e:
+        exci = sys.exc_info()[2]
+        lineno = exci.tb_lineno
+        fname = exci.tb_frame.f_code.co_name
+        ename = type(e).__name__
+        msg = f"{ename} Exception at line {lineno} in function {fname}: {e}"
+        log.error(msg)
+        raise
@@ -0,0 +1,230 @@
+import base64
+import calendar
+import hashlib
+import random
+import time
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+from sdjson.airings import AIRING  # noqa: E402
+from sdjson.airings import MAGIC  # noqa: E402
+from sdjson.airings import packAirings  # noqa: E402
+from sdjson.airings import SDAiringIndex  # noqa: E402
+from sdjson.airings import scheduleAirings  # noqa: E402
+from sdjson.airings import SDScheduleReader  # noqa: E402
+from sdjson.cache import SDCache  # noqa: E402
+
+DAY = calendar.timegm(time.strptime("2021-03-01", "%Y-%m-%d"))
+
+
+def sdMd5(text):
+    """Returns an md5 the way SD sends them, base64 with the padding removed."""
+    return base64.b64encode(hashlib.md5(text.encode()).digest()).decode()[:22]
+
+
+def scheduleDay(stationid, start, slots, length=1800):
+    """Returns an SD schedule day of back to back airings from start."""
+    programs = []
+    for i in range(slots):
+        airtime = start + i * length
+        programs.append(
+            {
+                "programID": f"EP{stationid}{i:06d}",
+                "airDateTime": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(airtime)
+                ),
+                "duration": length,
+                "md5": sdMd5(f"{stationid}.{i}"),
+            }
+        )
+    return {
+        "stationID": stationid,
+        "programs": programs,
+        "metadata": {
+            "startDate": time.strftime("%Y-%m-%d", time.gmtime(start)),
+            "md5": sdMd5(f"{stationid}.{start}"),
+        },
+    }
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache()
+    xsdc.setupCache()
+    return xsdc
+
+
+def test_round_trip(sdc):
+    # written out of order, the airings file is sorted by air time
+    sched = [scheduleDay("20001", DAY + 86400, 48), scheduleDay("20001", DAY, 48)]
+    sdc.writeChannelScheduleToCache("20001", sched)
+    reader = sdc.openScheduleReader("20001")
+    assert len(reader) == 96
+    expected = scheduleAirings(sched, sdc.programKey)
+    assert [reader.record(i) for i in range(len(reader))] == expected
+    assert reader.record(0)[0] == DAY
+    first = sched[1]["programs"][0]
+    assert reader.airing(0) == {
+        "stationID": "20001",
+        "airtime": DAY,
+        "duration": 1800,
+        "programID": first["programID"],
+        "md5": sdc.programKey(first["md5"]),
+    }
+    reader.close()
+
+
+def test_md5_hex_encoding(tmp_path):
+    # SD's base64 md5 is kept as hex, the same key the program cache uses
+    key = hashlib.md5(b"a program").hexdigest()
+    assert SDCache().programKey(sdMd5("a program")) == key
+    day = scheduleDay("20001", DAY, 1)
+    day["programs"][0]["md5"] = sdMd5("a program")
+    airings = scheduleAirings([day], SDCache().programKey)
+    assert airings == [(DAY, 1800, "EP20001000000", key)]
+    binfn = tmp_path.joinpath("schedule.bin")
+    binfn.write_bytes(packAirings(airings))
+    # and is stored as its 16 raw bytes
+    assert binfn.read_bytes()[-16:] == bytes.fromhex(key)
+    reader = SDScheduleReader(binfn, "20001")
+    assert reader.record(0) == airings[0]
+    reader.close()
+
+
+def test_window_and_now_next(sdc):
+    sdc.writeChannelScheduleToCache("20001", [scheduleDay("20001", DAY, 48)])
+    reader = sdc.openScheduleReader("20001")
+    airings = reader.airingsBetween(DAY + 900, DAY + 3600)
+    assert [x["airtime"] for x in airings] == [DAY, DAY + 1800]
+    assert reader.airingsBetween(DAY - 3600, DAY) == []
+    now, nxt = reader.nowNext(DAY + 1800)
+    assert (now["airtime"], nxt["airtime"]) == (DAY + 1800, DAY + 3600)
+    reader.close()
+
+
+def test_empty_schedule(tmp_path):
+    binfn = tmp_path.joinpath("schedule.bin")
+    binfn.write_bytes(packAirings([]))
+    reader = SDScheduleReader(binfn)
+    assert len(reader) == 0
+    assert reader.airingsBetween(DAY, DAY + 86400) == []
+    assert reader.nowNext(DAY) == []
+    reader.close()
+
+
+def test_bad_magic(tmp_path):
+    binfn = tmp_path.joinpath("schedule.bin")
+    data = packAirings([(DAY, 60, "EP000000000001", "00" * 16)])
+    binfn.write_bytes(b"SDAIR999" + data[len(MAGIC) :])
+    with pytest.raises(Exception, match="not a schedule airings file"):
+        SDScheduleReader(binfn)
+    binfn.write_bytes(b"")
+    with pytest.raises(Exception, match="not a schedule airings file"):
+        SDScheduleReader(binfn)
+
+
+def test_truncated(tmp_path):
+    binfn = tmp_path.joinpath("schedule.bin")
+    data = packAirings(
+        [(DAY + i * 60, 60, "EP000000000001", "00" * 16) for i in range(3)]
+    )
+    assert len(data) == len(MAGIC) + 3 * AIRING.size
+    binfn.write_bytes(data[:-5])
+    with pytest.raises(Exception, match="truncated"):
+        SDScheduleReader(binfn)
+    binfn.write_bytes(data[: len(MAGIC) - 2])
+    with pytest.raises(Exception, match="not a schedule airings file"):
+        SDScheduleReader(binfn)
+
+
+def indexed(index, start, end, stations=None):
+    return [
+        (x["stationID"], x["airtime"], x["duration"])
+        for x in index.airingsBetween(start, end, stations)
+    ]
+
+
+def test_index_airing_across_bucket_edge():
+    index = SDAiringIndex()
+    index.updateStation("20001", [(DAY + 3000, 1200, "EP1", "00" * 16)])
+    assert index.stationbuckets["20001"] == {DAY // 3600, DAY // 3600 + 1}
+    expected = [("20001", DAY + 3000, 1200)]
+    # reported once, whichever buckets the window covers
+    assert indexed(index, DAY, DAY + 7200) == expected
+    assert indexed(index, DAY, DAY + 3600) == expected
+    assert indexed(index, DAY + 3600, DAY + 7200) == expected
+    assert indexed(index, DAY + 4100, DAY + 4101) == expected
+    assert indexed(index, DAY + 4200, DAY + 7200) == []
+    assert indexed(index, DAY, DAY + 3000) == []
+
+
+def test_index_stop_on_the_hour():
+    index = SDAiringIndex()
+    airings = [
+        (DAY + 1800, 1800, "EP1", "00" * 16),
+        (DAY + 3600, 3600, "EP2", "00" * 16),
+    ]
+    index.updateStation("20001", airings)
+    # an airing that ends on the hour is only in the bucket before it
+    assert index.stationbuckets["20001"] == {DAY // 3600, DAY // 3600 + 1}
+    assert indexed(index, DAY, DAY + 3600) == [("20001", DAY + 1800, 1800)]
+    assert indexed(index, DAY + 3600, DAY + 7200) == [("20001", DAY + 3600, 3600)]
+    assert indexed(index, DAY + 3599, DAY + 3601) == [
+        ("20001", DAY + 1800, 1800),
+        ("20001", DAY + 3600, 3600),
+    ]
+
+
+def test_index_empty_range():
+    index = SDAiringIndex()
+    index.updateStation("20001", [(DAY, 7200, "EP1", "00" * 16)])
+    assert indexed(index, DAY + 100, DAY + 100) == []
+    assert indexed(index, DAY + 3600, DAY) == []
+    assert SDAiringIndex().airingsBetween(DAY, DAY + 86400) == []
+
+
+def test_index_stations_and_updates(sdc):
+    for sid in ("20001", "20002"):
+        sdc.writeChannelScheduleToCache(sid, [scheduleDay(sid, DAY, 48)])
+    index = sdc.getAiringIndex()
+    assert len(indexed(index, DAY, DAY + 86400)) == 96
+    assert indexed(index, DAY + 900, DAY + 1000) == [
+        ("20001", DAY, 1800),
+        ("20002", DAY, 1800),
+    ]
+    assert indexed(index, DAY + 900, DAY + 1000, ["20002"]) == [("20002", DAY, 1800)]
+    # a rewritten schedule replaces the station's airings
+    sdc.writeChannelScheduleToCache("20001", [scheduleDay("20001", DAY, 2, 3600)])
+    assert sorted(indexed(index, DAY + 900, DAY + 1000)) == [
+        ("20001", DAY, 3600),
+        ("20002", DAY, 1800),
+    ]
+    assert len(indexed(index, DAY, DAY + 86400, ["20001"])) == 2
+    sdc.removeChannelFromCache("20001")
+    assert indexed(index, DAY, DAY + 86400, ["20001"]) == []
+    assert "20001" not in index.stationbuckets
+
+
+def test_index_matches_a_scan():
+    rng = random.Random(7)
+    index = SDAiringIndex()
+    everything = []
+    for s in range(5):
+        sid = f"2000{s}"
+        airtime = DAY - rng.randrange(0, 20000)
+        airings = []
+        while airtime < DAY + 86400:
+            # mostly short, a few running over several buckets
+            duration = rng.choice([300, 900, 1800, 3600, 5400, 4 * 3600])
+            airings.append((airtime, duration, f"EP{s}{airtime}", "00" * 16))
+            everything.append((sid, airtime, duration))
+            airtime += duration
+        index.updateStation(sid, airings)
+    for i in range(300):
+        start = DAY + rng.randrange(-3600, 86400)
+        end = start + rng.choice([1, 60, 1800, 3600, 3601, 7200, 20000])
+        expected = [x for x in everything if x[1] < end and x[1] + x[2] > start]
+        assert sorted(indexed(index, start, end)) == sorted(expected)
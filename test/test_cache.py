@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+import sdjson.cache as cache  # noqa: E402
+from sdjson.cache import SDCache  # noqa: E402
+
+
+def makeCache(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache(**kwargs)
+    xsdc.setupCache()
+    return xsdc
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    return makeCache(tmp_path, monkeypatch)
+
+
+def leftovers(xdir):
+    return [x.name for x in xdir.iterdir() if x.name.endswith(".tmp")]
+
+
+@pytest.mark.parametrize("fails", ["write", "fsync", "replace"])
+def test_failed_write_keeps_the_original(sdc, monkeypatch, fails):
+    fn = sdc.getCacheDir().joinpath("data.bin")
+    sdc.writeBytes(fn, b"original")
+
+    def failing(*args, **kwargs):
+        raise OSError(f"{fails} failed")
+
+    if fails == "write":
+        # a full disk part way through the data
+        monkeypatch.setattr(cache, "open", FailingFile, raising=False)
+    else:
+        monkeypatch.setattr(os, fails, failing)
+    with pytest.raises(OSError):
+        sdc.writeBytes(fn, b"new data")
+    monkeypatch.undo()
+    assert fn.read_bytes() == b"original"
+    assert leftovers(fn.parent) == []
+
+
+class FailingFile:
+    """An open temporary file that fails after writing part of the data."""
+
+    def __init__(self, filename, mode):
+        self.xf = open(filename, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.xf.close()
+
+    def write(self, data):
+        self.xf.write(data[:3])
+        raise OSError("No space left on device")
+
+
+def fsyncs(monkeypatch, sdc):
+    """Record the files and the directories that are fsynced."""
+    synced = {"files": 0, "dirs": []}
+    fsync = os.fsync
+
+    def countFsync(fd):
+        synced["files"] += 1
+        fsync(fd)
+
+    def countSyncDir(dirname):
+        synced["dirs"].append(dirname)
+
+    monkeypatch.setattr(os, "fsync", countFsync)
+    monkeypatch.setattr(sdc, "syncDir", countSyncDir)
+    return synced
+
+
+def test_batch_fsync(sdc, monkeypatch):
+    synced = fsyncs(monkeypatch, sdc)
+    xdir = sdc.getCacheDir()
+    for i in range(5):
+        sdc.writeBytes(xdir.joinpath(f"data{i}.bin"), b"x")
+    # every file is synced as it is written, the directory once at flush
+    assert synced == {"files": 5, "dirs": []}
+    sdc.flush()
+    assert synced == {"files": 5, "dirs": [xdir]}
+    sdc.flush()
+    assert synced == {"files": 5, "dirs": [xdir]}
+
+
+@pytest.mark.parametrize("mode, expected", [("always", 3), ("none", 0)])
+def test_fsync_modes(tmp_path, monkeypatch, mode, expected):
+    sdc = makeCache(tmp_path, monkeypatch, fsync=mode)
+    synced = fsyncs(monkeypatch, sdc)
+    xdir = sdc.getCacheDir()
+    for i in range(3):
+        sdc.writeBytes(xdir.joinpath(f"data{i}.bin"), b"x")
+    sdc.flush()
+    assert synced == {"files": expected, "dirs": [xdir] * expected}
+    assert leftovers(xdir) == []
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip", "zstd"])
+def test_codec_round_trip(tmp_path, monkeypatch, codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    sdc = makeCache(tmp_path, monkeypatch, codec=codec)
+    fn = sdc.getCacheDir().joinpath("data.json")
+    data = {"programID": "EP000000000001", "titles": [{"title120": "Café"}]}
+    sdc.writeJson(fn, data)
+    assert [x.name for x in fn.parent.glob("data.json*")] == [
+        "data.json" + cache.CODECS[codec]
+    ]
+    assert sdc.readJson(fn) == data
+    # and the other codecs read it too
+    for other in ("none", "gzip"):
+        sdc.setCodec(other)
+        assert sdc.readJson(fn) == data
+
+
+def test_codec_switch_reads_the_newest(sdc):
+    fn = sdc.getCacheDir().joinpath("L.json")
+    sdc.writeJson(fn, {"version": 1})
+    sdc.setCodec("gzip")
+    sdc.writeJson(fn, {"version": 2})
+    # the older uncompressed copy is gone
+    assert [x.name for x in fn.parent.glob("L.json*")] == ["L.json.gz"]
+    sdc.setCodec("none")
+    assert sdc.readJson(fn) == {"version": 2}
+    sdc.writeJson(fn, {"version": 3})
+    assert [x.name for x in fn.parent.glob("L.json*")] == ["L.json"]
+    assert sdc.readJson(fn) == {"version": 3}
+
+
+def test_recompress_keeps_the_newest_copy(sdc):
+    xdir = sdc.getCacheDir()
+    # copies left by a version that did not remove them, the newer compressed
+    older = xdir.joinpath("L.json")
+    older.write_bytes(b'{"version":1}')
+    os.utime(older, (1000, 1000))
+    xdir.joinpath("L.json.gz").write_bytes(cache.gzip.compress(b'{"version":2}'))
+    newer = xdir.joinpath("M.json")
+    newer.write_bytes(b'{"version":2}')
+    xdir.joinpath("M.json.gz").write_bytes(cache.gzip.compress(b'{"version":1}'))
+    os.utime(xdir.joinpath("M.json.gz"), (1000, 1000))
+    assert sdc.findCacheFile(older, newest=True)[1] == ".gz"
+    assert sdc.findCacheFile(older)[1] == ""
+    assert sdc.recompressCache("gzip") == 1
+    assert sorted([x.name for x in xdir.glob("[LM].json*")]) == [
+        "L.json.gz",
+        "M.json.gz",
+    ]
+    assert sdc.readJson(older) == {"version": 2}
+    assert sdc.readJson(newer) == {"version": 2}
+    assert sdc.recompressCache("none") == 2
+    assert sorted([x.name for x in xdir.glob("[LM].json*")]) == ["L.json", "M.json"]
+    assert sdc.readJson(older) == {"version": 2}
+    assert sdc.readJson(newer) == {"version": 2}
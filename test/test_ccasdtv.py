@@ -1 +1,93 @@
+import os
+from pathlib import Path
+import subprocess
+import sys
+
 import pytest
+
+pytest.importorskip("click")
+pytest.importorskip("ccalogging")
+
+# microseconds the CLI module may take to import, including its imports
+IMPORTBUDGET = 80000
+# modules that only the commands that need them should import
+HEAVYMODULES = [
+    "requests",
+    "yaml",
+    "sqlite3",
+    "sdjson.sdapi",
+    "sdjson.cache",
+    "sdjson.db",
+    "sdjson.daemon",
+]
+
+PKGDIR = str(Path(__file__).resolve().parent.parent)
+
+
+def runPython(args, home):
+    env = dict(os.environ)
+    env["HOME"] = str(home)
+    env["PYTHONPATH"] = PKGDIR
+    return subprocess.run(
+        [sys.executable] + args, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def test_import_time_budget(tmp_path):
+    res = runPython(["-X", "importtime", "-c", "import sdjson.ccasdtv"], tmp_path)
+    for line in res.stderr.splitlines():
+        fields = [x.strip() for x in line.split("|")]
+        if len(fields) == 3 and fields[2] == "sdjson.ccasdtv":
+            cumulative = int(fields[1])
+            break
+    else:
+        pytest.fail("sdjson.ccasdtv not found in the -X importtime output")
+    assert cumulative < IMPORTBUDGET
+
+
+def test_import_is_lazy(tmp_path):
+    code = "import sys, sdjson.ccasdtv; print(' '.join(sys.modules))"
+    res = runPython(["-c", code], tmp_path)
+    loaded = set(res.stdout.split())
+    assert [x for x in HEAVYMODULES if x in loaded] == []
+
+
+def test_help_does_not_log(tmp_path):
+    res = runPython(["-c", "from sdjson.ccasdtv import cli; cli()", "--help"], tmp_path)
+    assert "Usage" in res.stdout
+    assert not tmp_path.joinpath(".ccasdtv.log").exists()
+
+
+def writeLineup(sdc, lineupid, stationids):
+    chans = {sid: {"stationID": sid, "channelnumber": sid} for sid in stationids}
+    sdc.writeLineupData(lineupid, {"channelsbyid": chans})
+
+
+def test_refresh_lineups_without_status(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+
+    from sdjson.cache import SDCache
+    from sdjson.ccasdtv import refreshLineups
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    sdc = SDCache()
+    sdc.setupCache()
+    writeLineup(sdc, "GBR-1000001-DEFAULT", ["20001", "20002"])
+    writeLineup(sdc, "GBR-1000002-DEFAULT", ["20002", "20003"])
+    for sid in ("20001", "20002", "20003"):
+        sdc.setupChannelDir(sid)
+    lineups = [
+        {"lineupid": "GBR-1000001-DEFAULT"},
+        {"lineupid": "GBR-1000002-DEFAULT"},
+    ]
+    cfg = {"lineups": list(lineups)}
+    # no status from SD, so nothing is known to have changed
+    sd = SimpleNamespace(lineups=None)
+    assert refreshLineups(sd, sdc, cfg) == ["20001", "20002", "20003"]
+    assert cfg == {"lineups": lineups}
+    # an account with no lineups left drops them and their stations
+    sd = SimpleNamespace(lineups=[])
+    assert refreshLineups(sd, sdc, cfg) == []
+    assert cfg == {"lineups": [], "amdirty": True}
+    assert sdc.readLineupData("GBR-1000001-DEFAULT") is None
+    assert list(sdc.cachedict["chandir"].iterdir()) == []
@@ -0,0 +1,221 @@
+import base64
+import calendar
+import hashlib
+import sqlite3
+import time
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+import sdjson.db as db  # noqa: E402
+from sdjson.cache import SDCache  # noqa: E402
+from sdjson.db import SDDb  # noqa: E402
+
+DAY = calendar.timegm(time.strptime("2021-03-01", "%Y-%m-%d"))
+
+
+def haveFts5():
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("create virtual table x using fts5 (y)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+needsfts5 = pytest.mark.skipif(not haveFts5(), reason="SQLite has no FTS5")
+
+
+def sdMd5(text):
+    """Returns an md5 the way SD sends them, base64 with the padding removed."""
+    return base64.b64encode(hashlib.md5(text.encode()).digest()).decode()[:22]
+
+
+def scheduleDay(stationid, start, lengths):
+    """Returns an SD schedule day of back to back airings of these lengths."""
+    programs = []
+    airtime = start
+    for i, length in enumerate(lengths):
+        programs.append(
+            {
+                "programID": f"EP{stationid}{i:06d}",
+                "airDateTime": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(airtime)
+                ),
+                "duration": length,
+                "md5": sdMd5(f"{stationid}.{i}"),
+            }
+        )
+        airtime += length
+    return {
+        "stationID": stationid,
+        "programs": programs,
+        "metadata": {
+            "startDate": time.strftime("%Y-%m-%d", time.gmtime(start)),
+            "md5": sdMd5(f"{stationid}.{start}"),
+        },
+    }
+
+
+def program(airing, title, cast=()):
+    return {
+        "programID": airing["programID"],
+        "md5": airing["md5"],
+        "titles": [{"title120": title}],
+        "descriptions": {"description100": [{"description": f"{title}, a programme"}]},
+        "cast": [{"name": x} for x in cast],
+    }
+
+
+TITLES = ["Doctor Who", "The News", "Doctor Foster", "Weather"]
+
+
+def fill(xdb, stationid="20001"):
+    """Write a day of one hour airings starting at DAY, with programs."""
+    day = scheduleDay(stationid, DAY, [3600] * 4)
+    xdb.writeChannelScheduleToCache(stationid, [day])
+    for airing, title in zip(day["programs"], TITLES):
+        cast = ["David Tennant"] if title == "Doctor Who" else []
+        xdb.writeProgramToCache(program(airing, title, cast))
+    xdb.flush()
+    return day
+
+
+@pytest.fixture
+def searchdb(tmp_path):
+    xdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"), search=True)
+    yield xdb
+    xdb.close()
+
+
+def times(rows):
+    return [row["airdatetime"] - DAY for row in rows]
+
+
+def test_get_airings_window(tmp_path):
+    xdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"))
+    fill(xdb)
+    assert times(xdb.getAirings("20001", DAY, DAY + 4 * 3600)) == [
+        0,
+        3600,
+        7200,
+        10800,
+    ]
+    # an airing that ends at the window start, or starts at its end, is out
+    assert times(xdb.getAirings("20001", DAY + 3600, DAY + 7200)) == [3600]
+    # one already on at the window start is in
+    assert times(xdb.getAirings("20001", DAY + 3599, DAY + 3601)) == [0, 3600]
+    assert xdb.getAirings("20001", DAY + 100, DAY + 100) == []
+    assert xdb.getAirings("20002", DAY, DAY + 86400) == []
+    rows = xdb.getAirings("20001", DAY, DAY + 1)
+    assert "Doctor Who" in rows[0]["program"]
+    xdb.close()
+
+
+def test_get_airings_without_program(tmp_path):
+    xdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"))
+    day = scheduleDay("20001", DAY, [3600])
+    xdb.writeChannelScheduleToCache("20001", [day])
+    rows = xdb.getAirings("20001", DAY, DAY + 3600)
+    assert len(rows) == 1
+    assert rows[0]["program"] is None
+    xdb.close()
+
+
+@needsfts5
+def test_search_programs(searchdb):
+    fill(searchdb)
+    rows = searchdb.searchPrograms("doctor", DAY, DAY + 86400)
+    assert [x["title"] for x in rows] == ["Doctor Who", "Doctor Foster"]
+    rows = searchdb.searchPrograms('"doctor who"', DAY, DAY + 86400)
+    assert [x["title"] for x in rows] == ["Doctor Who"]
+    rows = searchdb.searchPrograms("cast:tennant", DAY, DAY + 86400)
+    assert [x["title"] for x in rows] == ["Doctor Who"]
+    rows = searchdb.searchPrograms("doctor", DAY, DAY + 86400, limit=1)
+    assert [x["title"] for x in rows] == ["Doctor Who"]
+    assert searchdb.searchPrograms("nothing", DAY, DAY + 86400) == []
+    assert searchdb.searchPrograms("doctor", DAY + 100, DAY + 100) == []
+
+
+@needsfts5
+def test_search_window_edges(searchdb):
+    fill(searchdb)
+    # Doctor Who airs from DAY to DAY + 3600, Doctor Foster from 7200 to 10800
+    assert times(searchdb.searchPrograms("doctor", DAY + 3600, DAY + 7200)) == []
+    assert times(searchdb.searchPrograms("doctor", DAY + 3599, DAY + 7201)) == [
+        0,
+        7200,
+    ]
+    assert times(searchdb.searchPrograms("doctor", DAY + 5000, DAY + 86400)) == [7200]
+
+
+@needsfts5
+def test_search_text_is_replaced(searchdb):
+    day = fill(searchdb)
+    searchdb.writeProgramToCache(program(day["programs"][0], "Something Else"))
+    searchdb.flush()
+    assert searchdb.searchPrograms('"doctor who"', DAY, DAY + 86400) == []
+    rows = searchdb.searchPrograms("something", DAY, DAY + 86400)
+    assert [x["title"] for x in rows] == ["Something Else"]
+
+
+def test_search_disabled(tmp_path):
+    xdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"))
+    fill(xdb)
+    with pytest.raises(Exception, match="not enabled"):
+        xdb.searchPrograms("doctor", DAY, DAY + 86400)
+    tables = [x[0] for x in xdb.doSql("select name from sqlite_master", (), False)]
+    assert "programsearch" not in tables
+    xdb.close()
+
+
+def test_search_without_fts5(tmp_path, monkeypatch):
+    # as an SQLite built without FTS5 would fail
+    monkeypatch.setattr(
+        db,
+        "SEARCHSCHEMA",
+        "create virtual table if not exists programsearch using nosuchmodule (x)",
+    )
+    xdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"), search=True)
+    fill(xdb)
+    assert not xdb.search
+    assert len(xdb.getAirings("20001", DAY, DAY + 86400)) == 4
+    with pytest.raises(Exception, match="not enabled"):
+        xdb.searchPrograms("doctor", DAY, DAY + 86400)
+    xdb.close()
+
+
+@needsfts5
+@pytest.mark.parametrize("programstore", ["tree", "pack"])
+def test_rebuild_search_index(tmp_path, monkeypatch, programstore):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # listings cached before the search index was turned on
+    sdc = SDCache(programstore=programstore)
+    sdc.setupCache()
+    fill(sdc)
+    fill(sdc, "20002")
+    if sdc.packstore is not None:
+        sdc.packstore.closeFiles()
+    searchdb = SDDb(dbpath=tmp_path.joinpath("ccasdtv.db"), search=True)
+    sdc = SDCache(programstore=programstore, searchdb=searchdb)
+    sdc.setupCache()
+    assert searchdb.searchPrograms("doctor", DAY, DAY + 86400) == []
+    assert sdc.rebuildSearchIndex() == (2, 8)
+    rows = searchdb.searchPrograms('"doctor who"', DAY, DAY + 86400)
+    assert sorted([x["stationid"] for x in rows]) == ["20001", "20002"]
+    # and again does not duplicate anything
+    assert sdc.rebuildSearchIndex() == (2, 8)
+    assert len(searchdb.searchPrograms('"doctor who"', DAY, DAY + 86400)) == 2
+    assert len(searchdb.getAirings("20001", DAY, DAY + 86400)) == 4
+    searchdb.close()
+
+
+def test_rebuild_needs_the_search_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    sdc = SDCache()
+    sdc.setupCache()
+    with pytest.raises(Exception, match="not enabled"):
+        sdc.rebuildSearchIndex()
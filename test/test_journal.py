@@ -0,0 +1,288 @@
+import base64
+import calendar
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+from sdjson.cache import SDCache  # noqa: E402
+from sdjson.journal import SDJournal  # noqa: E402
+from sdjson.xmltv import concatFragments  # noqa: E402
+from sdjson.xmltv import writeFragments  # noqa: E402
+from sdjson.xmltv import writeXmltv  # noqa: E402
+
+DAY = calendar.timegm(time.strptime("2021-03-01", "%Y-%m-%d"))
+
+
+def sdMd5(text):
+    """Returns an md5 the way SD sends them, base64 with the padding removed."""
+    return base64.b64encode(hashlib.md5(text.encode()).digest()).decode()[:22]
+
+
+def scheduleDay(stationid, start, slots, version=0):
+    """Returns an SD schedule day of back to back half hours from start."""
+    programs = []
+    for i in range(slots):
+        programs.append(
+            {
+                "programID": f"EP{stationid}{i:06d}",
+                "airDateTime": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(start + i * 1800)
+                ),
+                "duration": 1800,
+                "md5": sdMd5(f"{stationid}.{i}.{version}"),
+            }
+        )
+    return {
+        "stationID": stationid,
+        "programs": programs,
+        "metadata": {
+            "startDate": time.strftime("%Y-%m-%d", time.gmtime(start)),
+            "md5": sdMd5(f"{stationid}.{start}.{version}"),
+        },
+    }
+
+
+def programs(day):
+    """Returns the programs of a schedule day, as SD sends them."""
+    return [
+        {
+            "programID": x["programID"],
+            "md5": x["md5"],
+            "titles": [{"title120": f"""{x["programID"]} {x["md5"]}"""}],
+        }
+        for x in day["programs"]
+    ]
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache(journal=True)
+    xsdc.setupCache()
+    return xsdc
+
+
+def consumeAll(sdc):
+    # the first consume after the journal is turned on says everything changed
+    assert sdc.journal.consume()["all"]
+
+
+def test_round_trip(sdc):
+    consumeAll(sdc)
+    sdc.journal.recordStation("20001", ["2021-03-01"])
+    sdc.journal.recordStation("20001", ["2021-03-02"])
+    sdc.journal.recordRemoved("20002")
+    sdc.journal.recordProgram("00" * 16)
+    sdc.journal.save()
+    assert not sdc.journal.dirty
+    # another process sees what this one saved
+    changes = SDJournal(sdc, sdc.journal.filename).consume()
+    assert changes == {
+        "all": False,
+        "stations": {"20001": {"2021-03-01", "2021-03-02"}},
+        "removed": {"20002"},
+        "programs": {"00" * 16},
+    }
+    # and it is consumed only once
+    assert sdc.journal.consume() == {
+        "all": False,
+        "stations": {},
+        "removed": set(),
+        "programs": set(),
+    }
+
+
+def test_journal_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache(journal=True)
+    xsdc.setupCache()
+    consumeAll(xsdc)
+    assert xsdc.journal.filename.exists()
+    xsdc = SDCache()
+    xsdc.setupCache()
+    assert xsdc.journal is None
+    # changes made while it was off are not known, so the old journal goes
+    assert not xsdc.getCacheDir().joinpath("journal.json").exists()
+    xsdc = SDCache(journal=True)
+    xsdc.setupCache()
+    consumeAll(xsdc)
+
+
+def test_removed_then_readded(sdc):
+    consumeAll(sdc)
+    sdc.journal.recordStation("20001", ["2021-03-01"])
+    sdc.journal.save()
+    sdc.journal.recordRemoved("20001")
+    sdc.journal.save()
+    changes = sdc.journal.consume()
+    assert (changes["stations"], changes["removed"]) == ({}, {"20001"})
+    # removed by one run and put back by the next
+    sdc.journal.recordRemoved("20001")
+    sdc.journal.save()
+    sdc.journal.recordStation("20001", ["2021-03-02"])
+    sdc.journal.save()
+    changes = sdc.journal.consume()
+    assert changes["stations"] == {"20001": {"2021-03-02"}}
+    assert changes["removed"] == set()
+    # and within the one run
+    sdc.journal.recordRemoved("20001")
+    sdc.journal.recordStation("20001", [])
+    changes = sdc.journal.consume()
+    assert (changes["stations"], changes["removed"]) == ({"20001": set()}, set())
+
+
+def test_too_many_programs(sdc):
+    consumeAll(sdc)
+    sdc.journal.maxprograms = 10
+    for i in range(8):
+        sdc.journal.recordProgram(f"{i:032x}")
+    sdc.journal.save()
+    for i in range(8, 16):
+        sdc.journal.recordProgram(f"{i:032x}")
+    sdc.journal.recordStation("20001", ["2021-03-01"])
+    sdc.journal.save()
+    # the journal stops listing them and says everything changed
+    data = sdc.readJson(sdc.journal.filename)
+    assert data["all"]
+    assert (data["programs"], data["stations"]) == ([], {})
+    # until it is consumed
+    assert sdc.journal.consume()["all"]
+    sdc.journal.recordProgram("00" * 16)
+    sdc.journal.save()
+    assert sdc.journal.consume()["programs"] == {"00" * 16}
+
+
+def test_failed_save_keeps_changes(sdc, monkeypatch):
+    consumeAll(sdc)
+    sdc.journal.recordStation("20001", ["2021-03-01"])
+    sdc.journal.recordProgram("00" * 16)
+    writeJson = sdc.writeJson
+
+    def failingWrite(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sdc, "writeJson", failingWrite)
+    with pytest.raises(OSError):
+        sdc.journal.save()
+    with pytest.raises(OSError):
+        sdc.journal.consume()
+    # changes recorded after the failure are kept with them
+    sdc.journal.recordStation("20001", ["2021-03-02"])
+    monkeypatch.setattr(sdc, "writeJson", writeJson)
+    sdc.journal.save()
+    changes = sdc.journal.consume()
+    assert changes["stations"] == {"20001": {"2021-03-01", "2021-03-02"}}
+    assert changes["programs"] == {"00" * 16}
+
+
+def test_concurrent_saves(sdc):
+    consumeAll(sdc)
+    journals = [SDJournal(sdc, sdc.journal.filename) for i in range(4)]
+
+    def worker(n, journal):
+        for i in range(25):
+            journal.recordStation(f"{n}{i:04d}", ["2021-03-01"])
+            journal.save()
+
+    threads = [
+        threading.Thread(target=worker, args=(n, x)) for n, x in enumerate(journals)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(sdc.journal.consume()["stations"]) == 100
+
+
+def test_died_before_saving(sdc):
+    consumeAll(sdc)
+    sdc.journal.begin()
+    sdc.journal.recordStation("20001", ["2021-03-01"])
+    # the run is still going, so what it has not saved yet stays with it
+    other = SDJournal(sdc, sdc.journal.filename)
+    assert not other.consume()["all"]
+    sdc.journal.save()
+    assert other.consume()["stations"] == {"20001": {"2021-03-01"}}
+    # a run that died before it saved
+    proc = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    pid = int(proc.stdout)
+    data = sdc.readJson(sdc.journal.filename)
+    data["running"] = [pid, os.getpid()]
+    sdc.writeJson(sdc.journal.filename, data)
+    assert sdc.journal.consume()["all"]
+    # this process is still running and is kept
+    assert sdc.readJson(sdc.journal.filename)["running"] == [os.getpid()]
+
+
+def writeLineup(sdc, stationids):
+    chans = {
+        sid: {"stationID": sid, "channelnumber": str(i + 1), "name": f"Station {sid}"}
+        for i, sid in enumerate(stationids)
+    }
+    sdc.writeLineupData("GBR-1000001-DEFAULT", {"channelsbyid": chans})
+
+
+def writeSchedule(sdc, sid, version=0):
+    day = scheduleDay(sid, DAY, 4, version)
+    sdc.writeChannelScheduleToCache(sid, [day])
+    for prog in programs(day):
+        sdc.writeProgramToCache(prog)
+
+
+def test_only_changed_fragments(sdc, tmp_path):
+    sids = ["20001", "20002", "20003"]
+    writeLineup(sdc, sids)
+    for sid in sids:
+        writeSchedule(sdc, sid)
+    sdc.journal.save()
+    fragdir = tmp_path.joinpath("fragments")
+    args = (sdc, ["GBR-1000001-DEFAULT"], fragdir, DAY, DAY + 86400)
+    result = writeFragments(*args)
+    assert result["stations"] == sids
+    assert result["written"] == set(sids)
+    assert result["programmes"] == 12
+    # nothing changed
+    assert writeFragments(*args)["written"] == set()
+    # a new schedule for one station
+    writeSchedule(sdc, "20002", 1)
+    sdc.journal.save()
+    result = writeFragments(*args)
+    assert result["written"] == {"20002"}
+    assert result["programmes"] == 4
+    # a changed program only changes the stations it airs on
+    day = scheduleDay("20003", DAY, 4)
+    prog = programs(day)[0]
+    prog["titles"] = [{"title120": "changed"}]
+    sdc.writeProgramToCache(prog)
+    sdc.journal.save()
+    assert writeFragments(*args)["written"] == {"20003"}
+    # the fragments make the same guide as a full export
+    joined = io.StringIO()
+    concatFragments(fragdir, joined)
+    full = io.StringIO()
+    writeXmltv(full, sdc, ["GBR-1000001-DEFAULT"], DAY, DAY + 86400)
+    assert joined.getvalue() == full.getvalue()
+    assert "changed" in full.getvalue()
+
+
+def test_fragments_without_journal(sdc, tmp_path):
+    writeLineup(sdc, ["20001", "20002"])
+    for sid in ("20001", "20002"):
+        writeSchedule(sdc, sid)
+    sdc.journal = None
+    args = (sdc, ["GBR-1000001-DEFAULT"], tmp_path, DAY, DAY + 86400)
+    assert writeFragments(*args)["written"] == {"20001", "20002"}
+    assert writeFragments(*args)["written"] == {"20001", "20002"}
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+from sdjson.jsonstream import iterJsonArray  # noqa: E402
+
+DOC = [
+    {"programID": "EP000000010001", "title": 'say "hello"\\', "n": 12345},
+    {"programID": "EP000000010002", "title": "café ☃ \U0001f4fa", "n": -1.5},
+    [1, 2, 3],
+    "text",
+    True,
+    None,
+    678,
+]
+
+
+def chunked(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def splitAt(data, *offsets):
+    chunks = []
+    last = 0
+    for offset in offsets:
+        chunks.append(data[last:offset])
+        last = offset
+    chunks.append(data[last:])
+    return chunks
+
+
+def test_whole_document():
+    data = json.dumps(DOC).encode()
+    assert list(iterJsonArray([data])) == DOC
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_every_chunk_size(size):
+    data = json.dumps(DOC, ensure_ascii=False).encode()
+    assert list(iterJsonArray(chunked(data, size))) == DOC
+
+
+def test_split_inside_string():
+    data = json.dumps(DOC).encode()
+    offset = data.index(b"hello") + 2
+    assert list(iterJsonArray(splitAt(data, offset))) == DOC
+
+
+def test_split_inside_escape():
+    data = json.dumps(DOC).encode()
+    # between the backslash and the quote of \"hello
+    offset = data.index(b'\\"hello') + 1
+    assert list(iterJsonArray(splitAt(data, offset))) == DOC
+    # inside a \uXXXX escape
+    data = json.dumps(DOC, ensure_ascii=True).encode()
+    offset = data.index(b"\\u00e9") + 3
+    assert list(iterJsonArray(splitAt(data, offset))) == DOC
+
+
+def test_split_inside_multibyte_utf8():
+    data = json.dumps(DOC, ensure_ascii=False).encode()
+    tv = "\U0001f4fa".encode()
+    offset = data.index(tv)
+    assert list(iterJsonArray(splitAt(data, offset + 1, offset + 2, offset + 3))) == DOC
+
+
+def test_split_between_elements():
+    data = b'[{"a": 1} ,\n {"b": 2}, 3]'
+    offsets = [data.index(b","), data.index(b",") + 1, data.index(b"\n")]
+    assert list(iterJsonArray(splitAt(data, *offsets))) == [{"a": 1}, {"b": 2}, 3]
+
+
+def test_number_at_chunk_end():
+    assert list(iterJsonArray([b"[12", b"34, 5", b"6]"])) == [1234, 56]
+
+
+def test_empty_array():
+    assert list(iterJsonArray([b"[", b"  ", b"]"])) == []
+    assert list(iterJsonArray([b" [ ] "])) == []
+
+
+def test_not_an_array():
+    data = json.dumps({"code": 4006, "response": "TOKEN_EXPIRED"}).encode()
+    assert list(iterJsonArray(chunked(data, 5))) == [
+        {"code": 4006, "response": "TOKEN_EXPIRED"}
+    ]
+
+
+def test_whitespace_only():
+    with pytest.raises(ValueError):
+        list(iterJsonArray([b"  ", b"\n"]))
+    with pytest.raises(ValueError):
+        list(iterJsonArray([]))
+
+
+def test_truncated():
+    data = json.dumps(DOC).encode()
+    with pytest.raises(ValueError):
+        list(iterJsonArray(chunked(data[:-1], 8)))
+    with pytest.raises(ValueError):
+        list(iterJsonArray(chunked(data[: len(data) // 2], 8)))
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        list(iterJsonArray([b'[{"a": 1}, {"b": }]']))
+    with pytest.raises(ValueError):
+        list(iterJsonArray([b"[1, ", b"nope]"]))
@@ -0,0 +1,173 @@
+import hashlib
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+from sdjson.cache import PACKINDEX  # noqa: E402
+from sdjson.cache import SDCache  # noqa: E402
+from sdjson.cache import SDPackStore  # noqa: E402
+
+
+def program(pid, version=0):
+    md5 = hashlib.md5(f"{pid}.{version}".encode()).hexdigest()
+    return {"programID": pid, "md5": md5, "titles": [{"title120": f"{pid} v{version}"}]}
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache(programstore="pack")
+    xsdc.setupCache()
+    yield xsdc
+    xsdc.packstore.closeFiles()
+
+
+def reopen(sdc):
+    sdc.packstore.closeFiles()
+    return SDPackStore(sdc, sdc.packstore.packdir)
+
+
+def test_round_trip(sdc):
+    progs = [program(f"EP{i:012d}") for i in range(50)]
+    for prog in progs:
+        sdc.writeProgramToCache(prog)
+    sdc.flush()
+    store = reopen(sdc)
+    for prog in progs:
+        assert store.have(prog["md5"])
+        assert store.read(prog["md5"]) == prog
+    assert store.read(program("EP999999999999")["md5"]) is None
+    store.closeFiles()
+
+
+def test_round_trip_across_packs(sdc):
+    sdc.packstore.maxpacksize = 1024
+    progs = [program(f"EP{i:012d}") for i in range(50)]
+    for prog in progs:
+        sdc.writeProgramToCache(prog)
+    assert sdc.packstore.packno > 0
+    store = reopen(sdc)
+    assert [store.read(x["md5"]) for x in progs] == progs
+    store.closeFiles()
+
+
+def test_overwrite_key(sdc):
+    prog = program("EP000000000001")
+    sdc.writeProgramToCache(prog)
+    # the same md5 is only stored once
+    sdc.writeProgramToCache(prog)
+    assert len(sdc.packstore.index) == 1
+    # an append with the key of a stored program replaces it
+    key = sdc.packstore.indexKey(prog["md5"])
+    changed = dict(prog, titles=[{"title120": "changed"}])
+    sdc.packstore.append(
+        key,
+        prog["programID"],
+        0,
+        sdc.encode(
+            b'{"programID":"EP000000000001","titles":[{"title120":"changed"}]}', "none"
+        ),
+    )
+    assert sdc.packstore.read(prog["md5"])["titles"] == changed["titles"]
+    store = reopen(sdc)
+    assert len(store.index) == 1
+    assert store.read(prog["md5"])["titles"] == changed["titles"]
+    store.closeFiles()
+
+
+def test_partial_index_record_is_dropped(sdc):
+    progs = [program(f"EP{i:012d}") for i in range(3)]
+    for prog in progs:
+        sdc.writeProgramToCache(prog)
+    store = sdc.packstore
+    store.closeFiles()
+    with open(store.indexfn, "ab") as ifn:
+        ifn.write(b"\1" * 10)
+    store = SDPackStore(sdc, store.packdir)
+    assert [store.read(x["md5"]) for x in progs] == progs
+    # the partial record is cut off, so later records line up
+    more = [program(f"EP{i:012d}") for i in range(3, 6)]
+    for prog in more:
+        store.write(prog)
+    store.closeFiles()
+    store = SDPackStore(sdc, store.packdir)
+    assert [store.read(x["md5"]) for x in progs + more] == progs + more
+    store.closeFiles()
+
+
+def test_crash_then_append(sdc):
+    progs = [program(f"EP{i:012d}") for i in range(3)]
+    for prog in progs:
+        sdc.writeProgramToCache(prog)
+    store = sdc.packstore
+    store.closeFiles()
+    # a crash where the index record reached the disk but the data did not
+    ghost = program("EP999999999999")
+    packfn = store.packFileName(store.packno)
+    packsize = packfn.stat().st_size
+    record = PACKINDEX.pack(
+        store.indexKey(ghost["md5"]), b"EP999999999999", 0, store.packno, packsize, 60
+    )
+    with open(store.indexfn, "ab") as ifn:
+        ifn.write(record)
+    store = SDPackStore(sdc, store.packdir)
+    assert not store.have(ghost["md5"])
+    assert store.indexfn.stat().st_size == 3 * PACKINDEX.size
+    # later appends grow the pack past where the ghost pointed
+    more = [program(f"EP{i:012d}") for i in range(3, 8)]
+    for prog in more:
+        store.write(prog)
+    assert packfn.stat().st_size > packsize + 60
+    store.closeFiles()
+    store = SDPackStore(sdc, store.packdir)
+    assert not store.have(ghost["md5"])
+    assert store.read(ghost["md5"]) is None
+    assert [store.read(x["md5"]) for x in progs + more] == progs + more
+    store.closeFiles()
+
+
+def test_compact(sdc):
+    sdc.packstore.maxpacksize = 2048
+    old = [program(f"EP{i:012d}") for i in range(20)]
+    new = [program(f"EP{i:012d}", 1) for i in range(10)]
+    for prog in old + new:
+        sdc.writeProgramToCache(prog)
+    store = sdc.packstore
+    assert len(store.index) == 30
+    oldpacks = set(store.packdir.glob("pack-*.dat"))
+    assert store.compact() == 20
+    # the newest version of each program is kept, the replaced ones dropped
+    for prog in new + old[10:]:
+        assert store.read(prog["md5"]) == prog
+    for prog in old[:10]:
+        assert not store.have(prog["md5"])
+    assert oldpacks.isdisjoint(store.packdir.glob("pack-*.dat"))
+    assert not store.packdir.joinpath(".index.compact").exists()
+    store = reopen(sdc)
+    assert len(store.index) == 20
+    for prog in new + old[10:]:
+        assert store.read(prog["md5"]) == prog
+    store.closeFiles()
+
+
+def test_compact_discards_stale_compact_index(sdc):
+    progs = [program(f"EP{i:012d}") for i in range(10)]
+    for prog in progs:
+        sdc.writeProgramToCache(prog)
+    store = sdc.packstore
+    store.closeFiles()
+    # what a compaction that crashed before replacing the index leaves
+    stale = SDPackStore(sdc, store.packdir, indexname=".index.compact")
+    stale.packno = store.packno + 1
+    ghost = program("EP999999999999")
+    stale.write(ghost)
+    stale.write(progs[0])
+    stale.closeFiles()
+    assert store.compact() == 10
+    assert not store.have(ghost["md5"])
+    assert [store.read(x["md5"]) for x in progs] == progs
+    store = reopen(sdc)
+    assert len(store.index) == 10
+    assert [store.read(x["md5"]) for x in progs] == progs
+    store.closeFiles()
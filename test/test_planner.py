@@ -0,0 +1,143 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+from sdjson.cache import SDCache  # noqa: E402
+from sdjson.planner import SDPlanner  # noqa: E402
+
+DAY = datetime.datetime(2021, 3, 1)
+
+
+class FakeSD:
+    """The SDApi attributes the planner uses."""
+
+    def __init__(self):
+        self.requestcount = 0
+        self.concurrency = 1
+        # one schedules call per station and one programs call per station day
+        self.schedulebatch = 1
+        self.programbatch = 20
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache()
+    xsdc.setupCache()
+    return xsdc
+
+
+def changedDays(nstations, ndays, start=DAY):
+    dates = [
+        (start + datetime.timedelta(days=i)).date().isoformat() for i in range(ndays)
+    ]
+    return {str(20000 + i): list(dates) for i in range(nstations)}
+
+
+def planner(sdc, sd=None, budget=100):
+    # one run a day, so each run may spend all that is left
+    return SDPlanner(sd or FakeSD(), sdc, budget=budget, interval=86400, neardays=0)
+
+
+def ndays(days):
+    return sum([len(x) for x in days.values()])
+
+
+def test_spend_within_budget(sdc):
+    sd = FakeSD()
+    xplanner = planner(sdc, sd)
+    xplan = xplanner.plan(changedDays(2, 3), now=DAY)
+    assert (xplan["used"], xplan["remaining"], xplan["share"]) == (0, 100, 100)
+    assert ndays(xplan["now"]) == 6
+    assert xplan["deferred"] == {}
+    assert xplan["calls"] == {"schedules": 2, "programs": 6}
+    sd.requestcount += 9
+    xplanner.record(now=DAY)
+    ledger = sdc.readJson(sdc.getCacheDir().joinpath("budget.json"))
+    assert (ledger["day"], ledger["used"], ledger["runs"]) == ("2021-03-01", 9, 1)
+    # a later run starts from the ledger
+    xplan = planner(sdc).plan(changedDays(1, 1), now=DAY + datetime.timedelta(hours=6))
+    assert (xplan["used"], xplan["remaining"]) == (9, 91)
+
+
+def test_share_limits_the_run(sdc):
+    xplanner = planner(sdc, budget=10)
+    xplan = xplanner.plan(changedDays(4, 3), now=DAY)
+    # the nearest days first: all 4 stations' first day cost 4 + 4 calls,
+    # then the second day of 2 stations 1 call each
+    assert xplan["calls"] == {"schedules": 4, "programs": 6}
+    assert ndays(xplan["now"]) + ndays(xplan["deferred"]) == 12
+    assert [len(x) for x in xplan["now"].values()] == [2, 2, 1, 1]
+    assert "2021-03-03" in xplan["deferred"]["20000"]
+
+
+def test_refused_once_exhausted(sdc):
+    sd = FakeSD()
+    xplanner = planner(sdc, sd)
+    sd.requestcount += 100
+    xplanner.record(now=DAY)
+    xplan = planner(sdc).plan(changedDays(2, 3), now=DAY + datetime.timedelta(hours=1))
+    assert (xplan["used"], xplan["remaining"], xplan["share"]) == (100, 0, 0)
+    assert xplan["now"] == {}
+    assert ndays(xplan["deferred"]) == 6
+    # requests this run has made count against the budget before they are recorded
+    sd = FakeSD()
+    xplanner = planner(sdc, sd, budget=200)
+    sd.requestcount += 100
+    xplan = xplanner.plan(changedDays(2, 3), now=DAY + datetime.timedelta(hours=1))
+    assert (xplan["used"], xplan["remaining"]) == (200, 0)
+    assert xplan["now"] == {}
+
+
+def test_reset_on_a_new_utc_day(sdc):
+    sd = FakeSD()
+    xplanner = planner(sdc, sd)
+    xplanner.plan(changedDays(2, 3), now=DAY)
+    sd.requestcount += 100
+    xplanner.record(nprograms=600, now=DAY + datetime.timedelta(hours=23, minutes=59))
+    ledger = planner(sdc).readLedger(DAY + datetime.timedelta(hours=23))
+    assert (ledger["used"], ledger["runs"]) == (100, 1)
+    ppd = ledger["programsperday"]
+    assert ppd == pytest.approx(0.8 * 20 + 0.2 * 100)
+    tomorrow = DAY + datetime.timedelta(days=1, minutes=1)
+    xplan = planner(sdc).plan(changedDays(2, 3, tomorrow), now=tomorrow)
+    assert (xplan["day"], xplan["used"], xplan["remaining"]) == ("2021-03-02", 0, 100)
+    assert ndays(xplan["now"]) == 6
+    # the programs per day estimate is carried over to the new day
+    ledger = planner(sdc).readLedger(tomorrow)
+    assert (ledger["used"], ledger["runs"], ledger["programsperday"]) == (0, 0, ppd)
+    # the same planner rolls over too, a daemon runs across midnight
+    sd.requestcount += 5
+    xplanner.record(now=tomorrow)
+    ledger = sdc.readJson(sdc.getCacheDir().joinpath("budget.json"))
+    assert (ledger["day"], ledger["used"], ledger["runs"]) == ("2021-03-02", 5, 1)
+
+
+def test_missing_ledger(sdc):
+    assert not sdc.getCacheDir().joinpath("budget.json").exists()
+    ledger = planner(sdc).readLedger(DAY)
+    assert ledger == {"day": "2021-03-01", "used": 0, "runs": 0, "programsperday": 20}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        b"{not json",
+        b"",
+        b"[1, 2, 3]",
+        b'{"day": "2021-03-01", "used": "lots", "runs": 0, "programsperday": 20}',
+        b'{"day": "2021-03-01"}',
+    ],
+)
+def test_corrupt_ledger(sdc, text):
+    sdc.getCacheDir().joinpath("budget.json").write_bytes(text)
+    sd = FakeSD()
+    xplanner = planner(sdc, sd)
+    xplan = xplanner.plan(changedDays(2, 3), now=DAY)
+    assert (xplan["used"], xplan["remaining"]) == (0, 100)
+    sd.requestcount += 9
+    xplanner.record(now=DAY)
+    ledger = sdc.readJson(sdc.getCacheDir().joinpath("budget.json"))
+    assert (ledger["day"], ledger["used"], ledger["runs"]) == ("2021-03-01", 9, 1)
@@ -0,0 +1,245 @@
+from pathlib import Path
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("ccalogging")
+requests = pytest.importorskip("requests")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("bench")))
+
+from fakesd import FakeSD  # noqa: E402
+from sdjson.sdapi import SDApi  # noqa: E402
+
+
+class StallingSD(FakeSD):
+    """A FakeSD that stalls its first few answers, as a dead connection would."""
+
+    def __init__(self, stalls=0, stall=1.0, **kwargs):
+        self.stalls = stalls
+        self.stall = stall
+        super().__init__(**kwargs)
+
+    def stalled(self):
+        with self.lock:
+            stall = self.stalls > 0
+            self.stalls -= 1 if stall else 0
+        if stall:
+            time.sleep(self.stall)
+
+    def schedules(self, body):
+        self.stalled()
+        return super().schedules(body)
+
+    def programs(self, body):
+        self.stalled()
+        return super().programs(body)
+
+
+def serve(fake):
+    url = fake.start()
+    return SDApi(
+        url=url,
+        username="user",
+        password="password",
+        token=fake.newToken(),
+        tokenexpires=time.time() + 3600,
+        backoff=0.01,
+    )
+
+
+@pytest.fixture
+def stalling():
+    fake = StallingSD(stations=2, days=1, airings=4)
+    yield fake
+    fake.stop()
+
+
+def test_timeout_is_retried(stalling):
+    sd = serve(stalling)
+    sd.timeout = (1, 0.2)
+    stalling.stalls = 2
+    pids = [stalling.programId("20000", stalling.dates()[0], i) for i in range(4)]
+    assert sorted(sd.getPrograms(pids)) == sorted(pids)
+    assert sd.requestcount == 3
+    assert sd.throttle.inflight == 0
+    sd.close()
+
+
+def test_timeout_gives_up(stalling):
+    sd = serve(stalling)
+    sd.timeout = (1, 0.2)
+    sd.retries = 1
+    stalling.stalls = 5
+    with pytest.raises(requests.ConnectionError):
+        sd.getPrograms(["EP000000000001"])
+    assert sd.requestcount == 2
+    assert sd.throttle.inflight == 0
+    sd.close()
+
+
+def test_timeout_from_config_list():
+    assert SDApi(timeout=[5, 120]).timeout == (5, 120)
+    assert SDApi(timeout=30).timeout == 30
+
+
+@pytest.fixture
+def fake():
+    xfake = FakeSD(stations=5, days=2, airings=4, unique=1)
+    yield xfake
+    xfake.stop()
+
+
+@pytest.fixture
+def sdc(tmp_path, monkeypatch):
+    from sdjson.cache import SDCache
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    xsdc = SDCache()
+    xsdc.setupCache()
+    return xsdc
+
+
+def statuses(fake, route):
+    return fake.stats.get(route, {}).get("status", {})
+
+
+def test_make_batches():
+    sd = SDApi()
+    items = list(range(10))
+    assert sd.makeBatches(items, 4) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert sd.makeBatches([], 4) == []
+    # spread over at least concurrency batches
+    sd.concurrency = 3
+    assert [len(x) for x in sd.makeBatches(items, 100)] == [4, 4, 2]
+    assert [len(x) for x in sd.makeBatches(items, 2)] == [2, 2, 2, 2, 2]
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_schedule_and_program_batches(fake, sdc, stream):
+    sd = serve(fake)
+    sd.stream = stream
+    sd.schedulebatch = 2
+    sd.programbatch = 15
+    progs = sd.getSchedules(fake.stationIds(), sdc=sdc)
+    assert statuses(fake, "schedules") == {"200": 3}
+    for sid in fake.stationIds():
+        assert len(sdc.openScheduleReader(sid)) == 8
+    assert len(progs) == 40
+    received = sd.getPrograms(sorted(progs), sdc=sdc)
+    assert sorted(received) == sorted(progs)
+    assert statuses(fake, "programs") == {"200": 3}
+    assert all([sdc.haveProgram(x) for x in progs.values()])
+    sd.close()
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_413_splits_the_batch(fake, sdc, stream):
+    fake.maxbatch = 2
+    sd = serve(fake)
+    sd.stream = stream
+    progs = sd.getSchedules(fake.stationIds(), sdc=sdc)
+    # 5 is split into 2 and 3, and 3 into 1 and 2
+    assert statuses(fake, "schedules") == {"413": 2, "200": 3}
+    assert len(progs) == 40
+    pids = sorted(progs)[:6]
+    assert sorted(sd.getPrograms(pids, sdc=sdc)) == pids
+    # 6 is split into 3 and 3, each of those into 1 and 2
+    assert statuses(fake, "programs") == {"413": 3, "200": 4}
+    assert sd.throttle.inflight == 0
+    sd.close()
+
+
+def test_413_on_a_single_item_is_raised(fake, sdc):
+    fake.maxbatch = 0
+    sd = serve(fake)
+    with pytest.raises(requests.HTTPError):
+        sd.getPrograms(["EP000000000001"], sdc=sdc)
+    assert statuses(fake, "programs") == {"413": 1}
+    sd.close()
+
+
+def test_concurrent_batches(fake, sdc):
+    sd = serve(fake)
+    sd.concurrency = 3
+    sd.throttle.maxinflight = sd.throttle.window = 3
+    sd.schedulebatch = 1
+    progs = sd.getSchedules(fake.stationIds(), sdc=sdc)
+    assert statuses(fake, "schedules") == {"200": 5}
+    assert len(progs) == 40
+    received = sd.getPrograms(sorted(progs), sdc=sdc)
+    assert sorted(received) == sorted(progs)
+    assert statuses(fake, "programs") == {"200": 3}
+    # the results come back in batch order, whatever order they finish in
+    assert sd.fetchBatches(lambda x: x[0], [[i] for i in range(20)]) == list(range(20))
+    sd.close()
+
+
+def test_unchanged_md5s_are_skipped(fake, sdc):
+    from sdjson.schedule import refreshPrograms
+    from sdjson.schedule import refreshSchedules
+
+    sd = serve(fake)
+    progs = refreshSchedules(sd, sdc, fake.stationIds())
+    assert len(progs) == 40
+    assert len(refreshPrograms(sd, sdc, progs)) == 40
+    fake.resetStats()
+    # nothing has changed
+    progs = refreshSchedules(sd, sdc, fake.stationIds())
+    assert progs == {}
+    assert "schedules" not in fake.stats
+    assert statuses(fake, "schedules/md5") == {"200": 1}
+    # one station day changes, only that day is fetched
+    fake.versions[("20001", fake.dates()[1])] = 1
+    progs = refreshSchedules(sd, sdc, fake.stationIds())
+    assert statuses(fake, "schedules") == {"200": 1}
+    assert len(progs) == 4
+    # its programs are repeats of ones already cached, so none are fetched
+    assert all([sdc.haveProgram(x) for x in progs.values()])
+    fake.resetStats()
+    assert refreshPrograms(sd, sdc, progs) == []
+    assert "programs" not in fake.stats
+    assert len(sdc.openScheduleReader("20001")) == 8
+    sd.close()
+
+
+def inflightWhileWriting(monkeypatch, sd, sdc):
+    """Record the requests in flight as each program is written."""
+    seen = []
+    write = sdc.writeProgramToCache
+
+    def recordingWrite(prog):
+        seen.append(sd.throttle.inflight)
+        write(prog)
+
+    monkeypatch.setattr(sdc, "writeProgramToCache", recordingWrite)
+    return seen
+
+
+@pytest.mark.parametrize("stream, expected", [(True, 1), (False, 0)])
+def test_stream_holds_its_slot(fake, sdc, monkeypatch, stream, expected):
+    sd = serve(fake)
+    sd.stream = stream
+    progs = sd.getSchedules(fake.stationIds(), sdc=sdc)
+    seen = inflightWhileWriting(monkeypatch, sd, sdc)
+    assert sorted(sd.getPrograms(sorted(progs), sdc=sdc)) == sorted(progs)
+    # a streamed body is read while its request is still in flight
+    assert seen == [expected] * len(progs)
+    assert sd.throttle.inflight == 0
+    assert sd.throttle.stats["ok"] == 2
+    sd.close()
+
+
+def test_stream_slot_is_released_on_error(fake, sdc, monkeypatch):
+    sd = serve(fake)
+    progs = sd.getSchedules(fake.stationIds(), sdc=sdc)
+
+    def failingWrite(prog):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sdc, "writeProgramToCache", failingWrite)
+    with pytest.raises(OSError):
+        sd.getPrograms(sorted(progs), sdc=sdc)
+    assert sd.throttle.inflight == 0
+    sd.close()
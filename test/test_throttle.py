@@ -0,0 +1,182 @@
+import random
+import threading
+
+import pytest
+
+pytest.importorskip("ccalogging")
+
+import sdjson.throttle as throttle  # noqa: E402
+from sdjson.throttle import classify  # noqa: E402
+from sdjson.throttle import SDThrottle  # noqa: E402
+
+
+class FakeClock:
+    """Stands in for the time module, sleeping only moves the clock on."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TopRandom:
+    """A random whose uniform always returns the top of the range."""
+
+    def uniform(self, lo, hi):
+        return hi
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    xclock = FakeClock()
+    monkeypatch.setattr(throttle, "time", xclock)
+    return xclock
+
+
+def test_classify():
+    assert classify(200) == throttle.OK
+    assert classify(429) == throttle.THROTTLED
+    assert classify(503) == throttle.THROTTLED
+    assert classify(500) == throttle.RETRY
+    assert classify(413) == throttle.FATAL
+    assert classify(400, throttle.SERVICE_OFFLINE) == throttle.THROTTLED
+    assert classify(200, throttle.SCHEDULE_QUEUED) == throttle.THROTTLED
+    assert classify(403, throttle.TOKEN_EXPIRED) == throttle.TOKEN
+
+
+def test_window_halves_on_throttle():
+    xthrottle = SDThrottle(maxinflight=8)
+    assert xthrottle.window == 8
+    windows = []
+    for i in range(5):
+        xthrottle.acquire()
+        xthrottle.release(throttle.THROTTLED)
+        windows.append(xthrottle.window)
+    assert windows == [4, 2, 1, 1, 1]
+    assert xthrottle.stats[throttle.THROTTLED] == 5
+
+
+def test_window_grows_on_success():
+    xthrottle = SDThrottle(maxinflight=8)
+    xthrottle.acquire()
+    xthrottle.release(throttle.THROTTLED)
+    assert xthrottle.window == 4
+    # 1/window for each success, one more slot per window's worth
+    for i in range(4):
+        xthrottle.acquire()
+        xthrottle.release(throttle.OK)
+    assert 4.9 < xthrottle.window < 5
+    for i in range(5):
+        xthrottle.acquire()
+        xthrottle.release(throttle.OK)
+    assert int(xthrottle.window) == 5
+    # retries and fatal errors leave the window alone
+    window = xthrottle.window
+    for outcome in (throttle.RETRY, throttle.FATAL, throttle.TOKEN):
+        xthrottle.acquire()
+        xthrottle.release(outcome)
+    assert xthrottle.window == window
+
+
+def test_window_stays_between_min_and_max():
+    xthrottle = SDThrottle(maxinflight=6, mininflight=3)
+    for i in range(1000):
+        xthrottle.acquire()
+        xthrottle.release(throttle.OK)
+    assert xthrottle.window == 6
+    for i in range(10):
+        xthrottle.acquire()
+        xthrottle.release(throttle.THROTTLED)
+    assert xthrottle.window == 3
+    # the minimum is never above the maximum and neither is below 1
+    assert SDThrottle(maxinflight=2, mininflight=5).mininflight == 2
+    assert SDThrottle(maxinflight=0, mininflight=0).window == 1
+    assert xthrottle.inflight == 0
+
+
+def test_acquire_waits_for_a_slot():
+    xthrottle = SDThrottle(maxinflight=2)
+    xthrottle.acquire()
+    xthrottle.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        xthrottle.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    assert not acquired.wait(0.2)
+    xthrottle.release(throttle.OK)
+    assert acquired.wait(5)
+    thread.join(5)
+    assert xthrottle.inflight == 2
+
+
+def test_backoff_is_exponential_and_capped(monkeypatch):
+    monkeypatch.setattr(throttle, "random", TopRandom())
+    xthrottle = SDThrottle(backoff=0.5, maxbackoff=10)
+    assert [xthrottle.delay(i) for i in range(7)] == [0.5, 1, 2, 4, 8, 10, 10]
+
+
+def test_backoff_is_jittered(monkeypatch):
+    monkeypatch.setattr(throttle, "random", random.Random(42))
+    xthrottle = SDThrottle(backoff=0.5, maxbackoff=10)
+    delays = [xthrottle.delay(3) for i in range(100)]
+    assert all([0 <= x <= 4 for x in delays])
+    assert len(set(delays)) == 100
+    monkeypatch.setattr(throttle, "random", random.Random(42))
+    assert [xthrottle.delay(3) for i in range(100)] == delays
+
+
+def test_wait_sleeps_the_backoff(clock, monkeypatch):
+    monkeypatch.setattr(throttle, "random", TopRandom())
+    xthrottle = SDThrottle(backoff=0.5, maxbackoff=10)
+    xthrottle.wait(2)
+    assert clock.sleeps == [2]
+    assert xthrottle.pauseuntil == 0
+
+
+def test_retry_after_is_honoured(clock, monkeypatch):
+    monkeypatch.setattr(throttle, "random", TopRandom())
+    xthrottle = SDThrottle(maxinflight=4, backoff=0.5, maxbackoff=30)
+    start = clock.now
+    xthrottle.wait(0, "5")
+    # longer than the backoff, and every other request is held back too
+    assert clock.sleeps == [5]
+    assert xthrottle.pauseuntil == start + 5
+    # a Retry-After shorter than the backoff does not shorten it
+    xthrottle.wait(3, "1")
+    assert clock.sleeps[-1] == 4
+    # nor is a long one waited beyond the longest backoff
+    xthrottle.wait(0, "3600")
+    assert clock.sleeps[-1] == 30
+    # an http date falls back to the backoff
+    xthrottle.wait(1, "Wed, 21 Oct 2015 07:28:00 GMT")
+    assert clock.sleeps[-1] == 1
+
+
+def test_pause_holds_back_acquire(clock):
+    xthrottle = SDThrottle(maxinflight=4)
+    xthrottle.pause(10)
+    waits = []
+
+    def fakeWait(timeout=None):
+        # instead of blocking, let the time pass
+        waits.append(timeout)
+        clock.now += timeout
+
+    xthrottle.cond.wait = fakeWait
+    xthrottle.acquire()
+    assert waits == [10]
+    assert xthrottle.inflight == 1
+    # a shorter pause does not cut a longer one short
+    xthrottle.pause(20)
+    xthrottle.pause(5)
+    assert xthrottle.pauseuntil == clock.now + 20